@@ -0,0 +1,87 @@
+"""Compare per-invoice saving with the batched append mode.
+
+Usage: python benchmarks/bench_batch_append.py [--invoices 10] [--items 20] [--sizes 0 500 2000]
+
+For every report size a pre-filled report is generated, then the same batch of
+synthetic invoices is written once through ``save_with_formatting`` per invoice
+and once through the batched ``process_invoices``. The time per invoice
+of the batch mode should stay flat as the report grows.
+"""
+import argparse
+import importlib.util
+import logging
+import queue
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+from synthetic import make_invoice, make_report
+
+ROOT = Path(__file__).resolve().parent.parent
+
+
+def load_processor_module():
+    sys.path.insert(0, str(ROOT))
+    spec = importlib.util.spec_from_file_location("invoice_processor", ROOT / "invoice-processor.py")
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def make_processor(module, output_file):
+    """Build an InvoiceProcessor without a Tk root"""
+    processor = object.__new__(module.InvoiceProcessor)
+    processor.logger = logging.getLogger("bench")
+    processor.config = dict(module.DEFAULT_CONFIG, ledger_enabled=False, show_review_dialog=False,
+                            preflight=False)
+    processor.output_file = str(output_file)
+    processor.events = queue.Queue()
+    processor.cancel_event = threading.Event()
+    processor.log_message = lambda message, level=logging.INFO: None
+    return processor
+
+
+def run(args):
+    module = load_processor_module()
+    workdir = Path(tempfile.mkdtemp(prefix="bench_batch_"))
+    try:
+        invoices = []
+        for number in range(1, args.invoices + 1):
+            path = workdir / f"invoice_{number}.xlsx"
+            make_invoice(path, number, args.items)
+            invoices.append(str(path))
+
+        print(f"{'report rows':>12} {'per-invoice s/inv':>18} {'batch s/inv':>12}")
+        for size in args.sizes:
+            template = workdir / f"report_{size}.xlsx"
+            make_report(template, size)
+
+            single_report = workdir / "single.xlsx"
+            shutil.copy(template, single_report)
+            processor = make_processor(module, single_report)
+            started = time.perf_counter()
+            for invoice_file in invoices:
+                processor.process_single_invoice(invoice_file)
+            single_time = (time.perf_counter() - started) / len(invoices)
+
+            batch_report = workdir / "batch.xlsx"
+            shutil.copy(template, batch_report)
+            processor = make_processor(module, batch_report)
+            started = time.perf_counter()
+            processor.process_invoices(list(invoices))
+            batch_time = (time.perf_counter() - started) / len(invoices)
+
+            print(f"{size:>12} {single_time:>18.3f} {batch_time:>12.3f}")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--invoices", type=int, default=10)
+    parser.add_argument("--items", type=int, default=20)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[0, 500, 2000])
+    run(parser.parse_args())
@@ -0,0 +1,84 @@
+"""Compare the pandas and the read-only openpyxl extraction backends.
+
+Usage: python benchmarks/bench_extraction_backends.py [--items 500 5000] [--width 30] [--repeat 3]
+
+Invoices are generated with the DEFAULT_CONFIG layout, padded with filler columns
+up to --width and a block of rows below the items (totals, signatures), like real
+supplier invoices. For each backend the best time per file and the peak memory
+traced by tracemalloc are reported.
+"""
+import argparse
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+import openpyxl
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+import invoice_core  # noqa: E402
+
+
+def make_wide_invoice(path, items, width):
+    book = openpyxl.Workbook()
+    sheet = book.active
+    sheet.cell(row=9, column=6, value='ООО "Поставщик"')
+    sheet.cell(row=2, column=9, value="125")
+    sheet.cell(row=2, column=10, value="15.03.2024")
+    for col in range(1, width + 1):
+        sheet.cell(row=19, column=col, value=f"Графа {col}")
+    for i in range(items):
+        row = 20 + i
+        for col in range(1, width + 1):
+            sheet.cell(row=row, column=col, value=i * col)
+        sheet.cell(row=row, column=3, value=f"Болт М{i % 20 + 1} x {i}")
+        sheet.cell(row=row, column=18, value=round(i * 0.37 % 10, 3))
+        sheet.cell(row=row, column=20, value=round(i * 1.37 % 100, 2))
+    for i in range(50):
+        sheet.cell(row=21 + items + i, column=2, value=f"Итого / подпись {i}")
+    book.save(path)
+
+
+def measure(invoice_file, config, repeat):
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        invoice_core.parse_invoice_file(invoice_file, config)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+
+    tracemalloc.start()
+    extracted_data, _ = invoice_core.parse_invoice_file(invoice_file, config)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return best, peak, extracted_data
+
+
+def run(args):
+    workdir = Path(tempfile.mkdtemp(prefix="bench_extract_"))
+    try:
+        print(f"{'items':>6} {'backend':>8} {'s/file':>8} {'peak MiB':>9}")
+        for items in args.items:
+            invoice_file = str(workdir / f"invoice_{items}.xlsx")
+            make_wide_invoice(invoice_file, items, args.width)
+            results = {}
+            for backend in ("pandas", "openpyxl"):
+                config = dict(invoice_core.DEFAULT_CONFIG, extraction_backend=backend)
+                seconds, peak, results[backend] = measure(invoice_file, config, args.repeat)
+                print(f"{items:>6} {backend:>8} {seconds:>8.3f} {peak / 2 ** 20:>9.1f}")
+            if results["pandas"] != results["openpyxl"]:
+                print(f"{items:>6} ВНИМАНИЕ: результаты бэкендов различаются")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--items", type=int, nargs="+", default=[500, 5000])
+    parser.add_argument("--width", type=int, default=30)
+    parser.add_argument("--repeat", type=int, default=3)
+    run(parser.parse_args())
@@ -0,0 +1,47 @@
+"""Microbenchmark of extract_invoice_data on an invoice that is already in memory.
+
+Usage: python benchmarks/bench_extraction_plan.py [--items 5000] [--repeat 5]
+
+The invoice is read once with each backend; only extraction is timed, so the
+numbers show the cost of cell addressing and the item loop, not of xlsx parsing.
+"""
+import argparse
+import shutil
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+import invoice_core  # noqa: E402
+from bench_extraction_backends import make_wide_invoice  # noqa: E402
+
+
+def run(args):
+    workdir = Path(tempfile.mkdtemp(prefix="bench_plan_"))
+    try:
+        invoice_file = str(workdir / "invoice.xlsx")
+        make_wide_invoice(invoice_file, args.items, 30)
+        print(f"{'backend':>8} {'ms/invoice':>11} {'us/item':>8}")
+        for backend in ("pandas", "openpyxl"):
+            config = dict(invoice_core.DEFAULT_CONFIG, extraction_backend=backend)
+            invoice_data = invoice_core.read_invoice(invoice_file, config)
+            best = None
+            for _ in range(args.repeat):
+                started = time.perf_counter()
+                extracted_data = invoice_core.extract_invoice_data(invoice_data, config, lambda message: None)
+                elapsed = time.perf_counter() - started
+                best = elapsed if best is None else min(best, elapsed)
+            assert len(extracted_data['items']) == args.items
+            print(f"{backend:>8} {best * 1000:>11.1f} {best / args.items * 1e6:>8.1f}")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--items", type=int, default=5000)
+    parser.add_argument("--repeat", type=int, default=5)
+    run(parser.parse_args())
@@ -0,0 +1,41 @@
+"""Time appending one invoice to reports of different sizes.
+
+Usage: python benchmarks/bench_single_append.py [--items 20] [--sizes 0 5000 50000]
+
+The append-only writer should take about the same time on a 50k-row report as
+on an empty one.
+"""
+import argparse
+import shutil
+import tempfile
+import time
+from pathlib import Path
+
+from bench_batch_append import load_processor_module, make_processor
+from synthetic import make_invoice, make_report
+
+
+def run(args):
+    module = load_processor_module()
+    workdir = Path(tempfile.mkdtemp(prefix="bench_single_"))
+    try:
+        invoice_file = workdir / "invoice.xlsx"
+        make_invoice(invoice_file, 1, args.items)
+
+        print(f"{'report rows':>12} {'append s':>10}")
+        for size in args.sizes:
+            report = workdir / f"report_{size}.xlsx"
+            make_report(report, size)
+            processor = make_processor(module, report)
+            started = time.perf_counter()
+            processor.process_single_invoice(str(invoice_file))
+            print(f"{size:>12} {time.perf_counter() - started:>10.3f}")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--items", type=int, default=20)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[0, 5000, 50000])
+    run(parser.parse_args())
@@ -0,0 +1,63 @@
+"""Peak memory and time of the streaming report rewrite for growing reports.
+
+Usage: python benchmarks/bench_stream_writer.py [--items 20] [--sizes 1000 10000 50000]
+
+Each measurement runs in a fresh process, so the peak resident size belongs to
+one rewrite only. It should stay about the same as the report grows.
+"""
+import argparse
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from bench_batch_append import ROOT
+from synthetic import make_invoice, make_report
+
+
+def measure(report, invoice_file):
+    """Rewrite the report once in this process and print seconds and peak RSS in MB"""
+    sys.path.insert(0, str(ROOT))
+    import invoice_core
+    import invoice_report
+
+    config = invoice_core.DEFAULT_CONFIG
+    new_df = invoice_core.build_invoice_rows(invoice_core.parse_invoice_file(invoice_file, config)[0])
+    started = time.perf_counter()
+    invoice_report.save_with_formatting(report, new_df, lambda message: None, report_writer="stream")
+    elapsed = time.perf_counter() - started
+    print(f"{elapsed:.3f} {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f}")
+
+
+def run(args):
+    workdir = Path(tempfile.mkdtemp(prefix="bench_stream_"))
+    try:
+        invoice_file = workdir / "invoice.xlsx"
+        make_invoice(invoice_file, 1, args.items)
+
+        print(f"{'report rows':>12} {'rewrite s':>10} {'peak MB':>8}")
+        for size in args.sizes:
+            report = workdir / f"report_{size}.xlsx"
+            make_report(report, size)
+            output = subprocess.run(
+                [sys.executable, __file__, "--measure", str(report), str(invoice_file)],
+                check=True, capture_output=True, text=True
+            ).stdout.split()
+            print(f"{size:>12} {float(output[0]):>10.3f} {float(output[1]):>8.1f}")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--items", type=int, default=20)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 50000])
+    parser.add_argument("--measure", nargs=2, metavar=("REPORT", "INVOICE"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.measure:
+        measure(*args.measure)
+    else:
+        run(args)
@@ -0,0 +1,292 @@
+"""Benchmark suite: parse, single append and batch append, compared with a baseline.
+
+Usage:
+    python benchmarks/bench_suite.py [--quick] [--items 10 100 1000] [--report-sizes 1000 10000 100000]
+                                     [--invoices 20] [--repeat 3] [--workdir DIR]
+                                     [--save-baseline FILE] [--compare FILE] [--tolerance 0.2]
+
+Synthetic invoices and reports come from synthetic.py with fixed seeds, so runs
+are comparable between machines and commits. Every scenario runs in a fresh
+process; the reported peak memory is the peak resident size of that process
+(on Windows the peak working set when psutil is installed, otherwise the peak of
+the Python allocations traced by tracemalloc).
+Generated reports are kept in --workdir between runs, since a 100k-row report
+takes a while to generate.
+
+Scenarios:
+    parse          read + extract one invoice of N items (invoice_core.parse_invoice_file)
+    single_append  append one invoice to a report of N rows (invoice_report.save_with_formatting)
+    batch_append   append --invoices invoices to a report of N rows in one run (invoice_cli.run_batch)
+    store_append   the same with "report_export": "on_demand": rows go to the report store only
+    preflight      pre-flight check of the --invoices invoices (invoice_preflight.preflight)
+
+Baselines depend on the machine, so none is kept in the repository: save one
+locally with --save-baseline before a change and compare against it after.
+With --compare, a scenario whose seconds per invoice or peak memory grew by more
+than --tolerance against the baseline is marked as a regression and the exit
+code is 1.
+"""
+import argparse
+import json
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+try:
+    import resource
+except ImportError:
+    # Windows has no resource module
+    resource = None
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+from synthetic import make_invoice, make_report
+
+ROOT = Path(__file__).resolve().parent.parent
+
+QUICK_ITEMS = [10, 100]
+QUICK_REPORT_SIZES = [1000, 10000]
+
+
+def peak_rss_mb() -> float:
+    if resource is not None:
+        # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / 1024 / 1024 if sys.platform == "darwin" else peak / 1024
+    if psutil is not None:
+        memory = psutil.Process().memory_info()
+        return getattr(memory, "peak_wset", memory.rss) / 1024 / 1024
+    return tracemalloc.get_traced_memory()[1] / 1024 / 1024
+
+
+def latency_stats(latencies):
+    ordered = sorted(latencies)
+    return {
+        "seconds_per_invoice": statistics.median(ordered),
+        "p95_seconds": ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))],
+        "invoices_per_second": 1 / statistics.median(ordered) if statistics.median(ordered) else 0.0,
+    }
+
+
+def run_parse(invoice_file, repeat):
+    import invoice_core
+
+    latencies = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        invoice_core.parse_invoice_file(invoice_file, invoice_core.DEFAULT_CONFIG)
+        latencies.append(time.perf_counter() - started)
+    return latency_stats(latencies)
+
+
+def run_single_append(report, invoice_file, repeat):
+    import invoice_core
+    import invoice_report
+
+    new_df = invoice_core.build_invoice_rows(
+        invoice_core.parse_invoice_file(invoice_file, invoice_core.DEFAULT_CONFIG)[0]
+    )
+    latencies = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        invoice_report.save_with_formatting(report, new_df, lambda message: None)
+        latencies.append(time.perf_counter() - started)
+    return latency_stats(latencies)
+
+
+def run_batch_append(report, invoice_files, store=False):
+    import invoice_cli
+    import invoice_core
+    import invoice_store
+
+    # The pre-flight check is timed on its own (run_preflight)
+    config = dict(invoice_core.DEFAULT_CONFIG, ledger_enabled=False, commit_every=0, report_store=store,
+                  report_export="on_demand", preflight=False)
+    if store:
+        # Building the store from the report is a one-time cost, not part of an append
+        invoice_store.open_store(report, config, lambda message: None).close()
+    started = time.perf_counter()
+    summary = invoice_cli.run_batch(report, invoice_files, config, log=lambda message: None, use_cache=False)
+    elapsed = time.perf_counter() - started
+    return {
+        "seconds_per_invoice": elapsed / len(invoice_files),
+        "p95_seconds": elapsed,
+        "invoices_per_second": len(invoice_files) / elapsed,
+        "rows": summary["rows"],
+    }
+
+
+def run_preflight(invoice_files):
+    import invoice_core
+    import invoice_preflight
+
+    started = time.perf_counter()
+    checked = invoice_preflight.preflight(invoice_files, invoice_core.DEFAULT_CONFIG)
+    elapsed = time.perf_counter() - started
+    return {
+        "seconds_per_invoice": elapsed / len(invoice_files),
+        "p95_seconds": elapsed,
+        "invoices_per_second": len(invoice_files) / elapsed,
+        "ok": len(checked.ok),
+    }
+
+
+def run_scenario(spec):
+    """Child process: run one scenario described by spec and print its result as JSON"""
+    sys.path.insert(0, str(ROOT))
+    if resource is None and psutil is None:
+        tracemalloc.start()
+    kind = spec["kind"]
+    if kind == "parse":
+        result = run_parse(spec["invoice"], spec["repeat"])
+    elif kind == "single_append":
+        result = run_single_append(spec["report"], spec["invoice"], spec["repeat"])
+    elif kind == "preflight":
+        result = run_preflight(spec["invoices"])
+    else:
+        result = run_batch_append(spec["report"], spec["invoices"], kind == "store_append")
+    result["peak_mb"] = peak_rss_mb()
+    print(json.dumps(result))
+
+
+def launch(spec):
+    output = subprocess.run(
+        [sys.executable, __file__, "--scenario", json.dumps(spec)],
+        check=True, capture_output=True, text=True
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def cached_report(workdir: Path, rows: int) -> Path:
+    report = workdir / f"report_{rows}.xlsx"
+    if not report.exists():
+        print(f"  generating report with {rows} rows...", file=sys.stderr)
+        make_report(report, rows)
+    return report
+
+
+def fresh_copy(source: Path, scratch: Path) -> str:
+    target = scratch / source.name
+    shutil.copy(source, target)
+    return str(target)
+
+
+def run(args):
+    items_sizes = QUICK_ITEMS if args.quick and args.items is None else (args.items or [10, 100, 1000])
+    report_sizes = QUICK_REPORT_SIZES if args.quick and args.report_sizes is None else (
+        args.report_sizes or [1000, 10000, 100000]
+    )
+    workdir = Path(args.workdir or Path(tempfile.gettempdir()) / "invoice_bench")
+    workdir.mkdir(parents=True, exist_ok=True)
+    scratch = Path(tempfile.mkdtemp(prefix="bench_suite_"))
+
+    results = {}
+    try:
+        for items in items_sizes:
+            invoice = workdir / f"invoice_{items}.xlsx"
+            if not invoice.exists():
+                make_invoice(invoice, 1, items, seed=items)
+            results[f"parse/items={items}"] = launch(
+                {"kind": "parse", "invoice": str(invoice), "repeat": args.repeat}
+            )
+            print_result(f"parse/items={items}", results[f"parse/items={items}"])
+
+        append_invoice = workdir / "invoice_20.xlsx"
+        if not append_invoice.exists():
+            make_invoice(append_invoice, 1, 20, seed=20)
+        batch_invoices = []
+        for number in range(1, args.invoices + 1):
+            path = workdir / f"batch_invoice_{number}.xlsx"
+            if not path.exists():
+                make_invoice(path, number, 20)
+            batch_invoices.append(str(path))
+        results["preflight"] = launch({"kind": "preflight", "invoices": batch_invoices})
+        print_result("preflight", results["preflight"])
+
+        for rows in report_sizes:
+            report = cached_report(workdir, rows)
+            name = f"single_append/report={rows}"
+            results[name] = launch({
+                "kind": "single_append", "report": fresh_copy(report, scratch),
+                "invoice": str(append_invoice), "repeat": args.repeat,
+            })
+            print_result(name, results[name])
+
+            name = f"batch_append/report={rows}"
+            results[name] = launch({
+                "kind": "batch_append", "report": fresh_copy(report, scratch), "invoices": batch_invoices,
+            })
+            print_result(name, results[name])
+
+            name = f"store_append/report={rows}"
+            results[name] = launch({
+                "kind": "store_append", "report": fresh_copy(report, scratch), "invoices": batch_invoices,
+            })
+            print_result(name, results[name])
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+    run_info = {"python": platform.python_version(), "platform": platform.platform(), "results": results}
+    if args.save_baseline:
+        with open(args.save_baseline, "w", encoding="utf-8") as f:
+            json.dump(run_info, f, indent=2)
+        print(f"baseline saved to {args.save_baseline}")
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)["results"]
+        return compare(results, baseline, args.tolerance)
+    return 0
+
+
+def print_result(name, result):
+    print(f"{name:<30} {result['seconds_per_invoice'] * 1000:>10.1f} ms/inv "
+          f"{result['invoices_per_second']:>8.1f} inv/s {result['peak_mb']:>7.1f} MB")
+
+
+def compare(results, baseline, tolerance) -> int:
+    print(f"\n{'scenario':<30} {'ms/inv':>10} {'baseline':>10} {'delta':>8} {'MB':>7} {'baseline':>9} {'delta':>8}")
+    regressions = 0
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None:
+            print(f"{name:<30} {result['seconds_per_invoice'] * 1000:>10.1f} {'-':>10}")
+            continue
+        time_delta = result["seconds_per_invoice"] / base["seconds_per_invoice"] - 1
+        memory_delta = result["peak_mb"] / base["peak_mb"] - 1
+        regressed = time_delta > tolerance or memory_delta > tolerance
+        regressions += regressed
+        print(
+            f"{name:<30} {result['seconds_per_invoice'] * 1000:>10.1f} {base['seconds_per_invoice'] * 1000:>10.1f} "
+            f"{time_delta:>+8.1%} {result['peak_mb']:>7.1f} {base['peak_mb']:>9.1f} {memory_delta:>+8.1%}"
+            f"{'  REGRESSION' if regressed else ''}"
+        )
+    print(f"\n{regressions} regression(s) over {tolerance:.0%}")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--quick", action="store_true", help="small sizes for a fast check")
+    parser.add_argument("--items", type=int, nargs="+", default=None)
+    parser.add_argument("--report-sizes", type=int, nargs="+", default=None)
+    parser.add_argument("--invoices", type=int, default=20)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--workdir", default=None)
+    parser.add_argument("--save-baseline", default=None)
+    parser.add_argument("--compare", default=None)
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    parser.add_argument("--scenario", default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.scenario:
+        run_scenario(json.loads(args.scenario))
+    else:
+        sys.exit(run(args))
@@ -0,0 +1,61 @@
+"""Seeded generators of synthetic invoices and pre-filled reports for the benchmarks.
+
+Invoices follow the DEFAULT_CONFIG layout: contractor in R9C6, number in R2C9,
+date in R2C10 and items from row 20 with names in C, weights in R and prices in T.
+Reports have the four header rows and data from row 5 like real ones, and are
+written in write-only mode so that 100k-row reports are generated quickly.
+"""
+import random
+
+import openpyxl
+from openpyxl.cell import WriteOnlyCell
+
+CONTRACTORS = ['ООО "Поставщик"', 'АО "Металлторг"', 'ООО "Крепеж-Снаб"', 'ИП Иванов']
+ITEM_NAMES = ["Болт М", "Гайка М", "Шайба ", "Винт М", "Шпилька М"]
+
+
+def make_invoice(path, number, items, seed=None):
+    """Invoice with `items` item rows; the same seed gives the same file contents"""
+    rng = random.Random(number if seed is None else seed)
+    book = openpyxl.Workbook()
+    sheet = book.active
+    sheet.cell(row=9, column=6, value=rng.choice(CONTRACTORS))
+    sheet.cell(row=2, column=9, value=str(number))
+    sheet.cell(row=2, column=10, value=f"{rng.randint(1, 28):02d}.{rng.randint(1, 12):02d}.2024")
+    for i in range(items):
+        row = 20 + i
+        sheet[f"C{row}"] = f"{rng.choice(ITEM_NAMES)}{i % 20 + 1} x {i}"
+        sheet[f"R{row}"] = round(rng.random() * 10, 3)
+        sheet[f"T{row}"] = round(rng.random() * 100, 2)
+    book.save(path)
+
+
+def make_report(path, rows, items_per_invoice=10, seed=0):
+    """Report with `rows` data rows grouped into invoices of items_per_invoice rows"""
+    rng = random.Random(seed)
+    book = openpyxl.Workbook(write_only=True)
+    sheet = book.create_sheet("Sheet1")
+    sheet.append(["Отчет"])
+    for _ in range(3):
+        sheet.append([])
+
+    for i in range(rows):
+        number = i // items_per_invoice + 1
+        first = i % items_per_invoice == 0
+        weight = WriteOnlyCell(sheet, value=round(rng.random() * 10, 3))
+        weight.number_format = "0.000"
+        sheet.append([
+            number if first else None,
+            rng.choice(CONTRACTORS).strip('"') if first else None,
+            "15.03.2024" if first else None,
+            "Э" if first else None,
+            rng.choice(ITEM_NAMES).strip(),
+            None,
+            f"{i % 20}x {i}",
+            weight,
+            round(rng.random() * 100, 2),
+            None,
+            None,
+            f"{number} от 15.03.2024" if first else None,
+        ])
+    book.save(path)
@@ -1,28 +1,34 @@
 import tkinter as tk
 from tkinter import filedialog, messagebox, simpledialog, ttk
 import pandas as pd
-import re
 from pathlib import Path
-import openpyxl
-from datetime import datetime
 import json
 import os
 from typing import List, Dict, Tuple, Optional
 import logging
+import queue
+import threading
+import time
+
+import invoice_cache
+import invoice_core
+import invoice_ledger
+import invoice_log
+import invoice_metrics
+import invoice_preflight
+import invoice_report
+import invoice_selection
+import invoice_store
+from invoice_core import CONFIG_FILE, DEFAULT_CONFIG
+
+# How often the Tk loop picks up progress and GUI requests from the processing thread
+EVENT_POLL_MS = 100
+# Files found by a folder scan are added to the list in chunks of this size
+SCAN_CHUNK_FILES = 500
+
+# How often buffered log lines are written to the log widget
+LOG_FLUSH_MS = 200
 
-CONFIG_FILE = "invoice_config.json"
-
-DEFAULT_CONFIG = {
-    "contractor_cell": "R9C6",
-    "number_cell": "R2C9",
-    "date_cell": "R2C10",
-    "items_start_cell": "R20C3",
-    "items_cell_text_part": "C",
-    "items_cell_numeric_part": "C",
-    "items_cell_weight": "R",
-    "items_cell_price": "T",
-    "show_review_dialog": True
-}
 
 class InvoiceProcessor:
     def __init__(self, root):
@@ -30,37 +36,80 @@ class InvoiceProcessor:
         self.root.title("Обработка счетов-фактур")
         self.root.geometry("1000x700")
         self.output_file = None
-        self.selected_invoices: List[str] = []
+        # Kept in the order of the invoice list, see invoice_selection
+        self.selected_invoices = invoice_selection.InvoiceSelection()
+
+        # Background processing state, see process_selected_invoices
+        self.events = queue.Queue()
+        self.worker: Optional[threading.Thread] = None
+        self.cancel_event = threading.Event()
+        self.close_requested = False
+        self.polling = False
+        # A folder scan adds files from a thread of its own, see select_invoice_folder
+        self.scanning = False
+        self.progress_started = 0.0
+        self.root.protocol("WM_DELETE_WINDOW", self.on_close)
         
         # Setup logging first
         self.setup_logging()
         
         # Then load config (which uses logging)
         self.config = self.load_config()
+        self.apply_log_settings()
         
         # Finally create widgets
         self.create_widgets()
+        self.schedule_log_flush()
 
     def setup_logging(self):
         # Configure logging
         logging.basicConfig(
             level=logging.INFO,
-            format='%(asctime)s - %(levelname)s - %(message)s',
+            format=invoice_log.LOG_FORMAT,
             handlers=[
                 logging.StreamHandler()
             ]
         )
         self.logger = logging.getLogger(__name__)
+        self.log_buffer = invoice_log.LogBuffer(DEFAULT_CONFIG['gui_log_lines'])
+        self.log_level = logging.INFO
+
+    def apply_log_settings(self):
+        """Log level, rotating log file and widget line limit from the loaded config"""
+        invoice_log.add_file_handler(self.config)
+        invoice_log.apply_log_level(self.config)
+        self.log_level = invoice_core.log_level(self.config)
+        self.log_buffer.set_max_lines(self.max_log_lines())
 
-    def log_message(self, message: str):
-        """Log a message both to the logger and the GUI text widget"""
+    def max_log_lines(self) -> int:
+        return max(1, int(self.config.get('gui_log_lines', DEFAULT_CONFIG['gui_log_lines'])))
+
+    def log_message(self, message: str, level: int = logging.INFO):
+        """Log a message to the logger and queue it for the GUI text widget; safe from any thread"""
         if hasattr(self, 'logger'):
-            self.logger.info(message)
-        if hasattr(self, 'log_text'):
-            self.log_text.insert(tk.END, f"{message}\n")
-            self.log_text.see(tk.END)
-        else:
-            print(message)  # Fallback if GUI not yet initialized
+            self.logger.log(level, message)
+        if level >= self.log_level:
+            # Tk widgets may only be touched from the main thread; flush_log writes the lines
+            self.log_buffer.append(message)
+
+    def schedule_log_flush(self):
+        self.flush_log()
+        self.root.after(LOG_FLUSH_MS, self.schedule_log_flush)
+
+    def flush_log(self):
+        """Write buffered lines in one insert and keep only the last gui_log_lines lines in the widget"""
+        lines, dropped = self.log_buffer.drain()
+        if not lines:
+            return
+        if dropped:
+            lines.insert(0, f"... пропущено строк лога: {dropped} (полный лог в файле)")
+        self.log_text.insert(tk.END, "".join(f"{line}\n" for line in lines))
+        max_lines = self.max_log_lines()
+        # Every line ends with a newline, so the text ends on an empty line
+        line_count = int(self.log_text.index("end-1c").split(".")[0]) - 1
+        if line_count > max_lines:
+            self.log_text.delete("1.0", f"{line_count - max_lines + 1}.0")
+        self.log_text.see(tk.END)
 
     def create_widgets(self):
         # Main container with padding
@@ -86,6 +135,12 @@ class InvoiceProcessor:
         
         ttk.Label(self.invoice_frame, text="Счета-фактуры:").pack(side=tk.LEFT, padx=5)
         ttk.Button(self.invoice_frame, text="Добавить", command=self.select_invoice_files).pack(side=tk.LEFT, padx=5)
+        self.folder_button = ttk.Button(
+            self.invoice_frame, text="Добавить папку", command=self.select_invoice_folder
+        )
+        self.folder_button.pack(side=tk.LEFT, padx=5)
+        self.invoice_count_label = ttk.Label(self.invoice_frame, text="")
+        self.invoice_count_label.pack(side=tk.LEFT, padx=5)
 
         # Settings frame
         self.settings_frame = ttk.LabelFrame(self.main_frame, text="Настройки", padding="5")
@@ -121,11 +176,20 @@ class InvoiceProcessor:
         self.buttons_frame = ttk.Frame(self.main_frame)
         self.buttons_frame.pack(fill=tk.X, pady=(0, 10))
 
-        ttk.Button(
+        self.process_button = ttk.Button(
             self.buttons_frame,
             text="Обработать выбранные",
             command=self.process_selected_invoices
-        ).pack(side=tk.LEFT, padx=5)
+        )
+        self.process_button.pack(side=tk.LEFT, padx=5)
+
+        self.cancel_button = ttk.Button(
+            self.buttons_frame,
+            text="Отмена",
+            command=self.cancel_processing,
+            state=tk.DISABLED
+        )
+        self.cancel_button.pack(side=tk.LEFT, padx=5)
 
         ttk.Button(
             self.buttons_frame,
@@ -133,6 +197,15 @@ class InvoiceProcessor:
             command=self.remove_selected_invoices
         ).pack(side=tk.LEFT, padx=5)
 
+        # Progress of the running batch
+        self.progress_frame = ttk.Frame(self.main_frame)
+        self.progress_frame.pack(fill=tk.X, pady=(0, 10))
+
+        self.progress_bar = ttk.Progressbar(self.progress_frame, mode="determinate")
+        self.progress_bar.pack(side=tk.LEFT, fill=tk.X, expand=True, padx=5)
+        self.progress_label = ttk.Label(self.progress_frame, text="", width=28)
+        self.progress_label.pack(side=tk.LEFT, padx=5)
+
         # Log frame
         self.log_frame = ttk.LabelFrame(self.main_frame, text="Лог", padding="5")
         self.log_frame.pack(fill=tk.BOTH, expand=True)
@@ -163,31 +236,75 @@ class InvoiceProcessor:
     def select_invoice_files(self):
         filenames = filedialog.askopenfilenames(filetypes=[("Excel files", "*.xlsx")])
         if filenames:
-            for filename in filenames:
-                if filename not in self.selected_invoices:
-                    self.selected_invoices.append(filename)
+            self.add_invoice_files(filenames)
+
+    def select_invoice_folder(self):
+        """Add the invoices of a folder and its subfolders; the folder is listed on a background thread"""
+        if self.scanning:
+            return
+        directory = filedialog.askdirectory()
+        if not directory:
+            return
+        self.scanning = True
+        self.folder_button.config(state=tk.DISABLED)
+        self.log_message(f"Поиск счетов-фактур в папке: {directory}")
+        threading.Thread(target=self.scan_invoice_folder, args=(directory,), daemon=True).start()
+        self.start_polling()
+
+    def scan_invoice_folder(self, directory: str):
+        """Runs on the scan thread: send the files found to the GUI thread in chunks"""
+        found = 0
+        chunk = []
+        try:
+            for path in invoice_selection.walk_invoice_files(
+                directory, on_error=lambda e: self.log_message(f"Папка недоступна: {e}", logging.WARNING)
+            ):
+                if self.close_requested:
+                    break
+                chunk.append(path)
+                if len(chunk) >= SCAN_CHUNK_FILES:
+                    self.events.put(("files", chunk))
+                    found += len(chunk)
+                    chunk = []
+        except OSError as e:
+            self.log_message(f"Ошибка при чтении папки {directory}: {e}")
+        finally:
+            if chunk:
+                self.events.put(("files", chunk))
+                found += len(chunk)
+            self.events.put(("scan_done", directory, found))
+
+    def add_invoice_files(self, filenames):
+        """Add files to the selection and insert only the new rows into the list"""
+        positions = self.selected_invoices.add_many(filenames)
+        if len(positions) * 2 > len(self.selected_invoices):
+            # Mostly new rows: one call refilling the list is cheaper than many inserts
             self.update_invoice_listbox()
+        else:
+            for index in positions:
+                self.invoice_listbox.insert(index, Path(self.selected_invoices[index]).name)
+        self.show_invoice_count()
 
     def update_invoice_listbox(self):
         self.invoice_listbox.delete(0, tk.END)
-        # Sort invoices by number in filename
-        sorted_invoices = sorted(
-            self.selected_invoices,
-            key=lambda x: self.extract_invoice_number_from_filename(x)
-        )
-        for invoice in sorted_invoices:
-            self.invoice_listbox.insert(tk.END, Path(invoice).name)
+        if len(self.selected_invoices):
+            self.invoice_listbox.insert(tk.END, *(Path(invoice).name for invoice in self.selected_invoices))
+        self.show_invoice_count()
+
+    def show_invoice_count(self):
+        count = len(self.selected_invoices)
+        self.invoice_count_label.config(text=f"выбрано: {count}" if count else "")
 
     def extract_invoice_number_from_filename(self, filename: str) -> str:
-        # Extract numbers from filename
-        numbers = re.findall(r'\d+', Path(filename).stem)
-        return numbers[0] if numbers else ""
+        return invoice_core.extract_invoice_number_from_filename(filename)
 
     def remove_selected_invoices(self):
+        # The list shows the selection in its own order, so list positions are selection positions
         selected_indices = self.invoice_listbox.curselection()
-        for index in reversed(selected_indices):
-            del self.selected_invoices[index]
-        self.update_invoice_listbox()
+        self.selected_invoices.remove_indices(selected_indices)
+        for index in sorted(selected_indices, reverse=True):
+            self.invoice_listbox.delete(index)
+        self.show_invoice_count()
 
     def process_selected_invoices(self):
         if not self.output_file:
@@ -198,213 +315,399 @@ class InvoiceProcessor:
             messagebox.showerror("Ошибка", "Выберите счета-фактуры для обработки")
             return
 
+        if self.worker is not None and self.worker.is_alive():
+            return
+
+        # The selection is already in processing order; the worker gets a snapshot of it
+        sorted_invoices = list(self.selected_invoices)
+        self.cancel_event.clear()
+        self.process_button.config(state=tk.DISABLED)
+        self.cancel_button.config(state=tk.NORMAL)
+        self.progress_bar.config(maximum=len(sorted_invoices), value=0)
+        self.progress_label.config(text=f"0 / {len(sorted_invoices)}")
+        self.progress_started = time.perf_counter()
+
+        # The Tk main loop keeps running; the worker reports back through self.events
+        self.worker = threading.Thread(target=self.run_worker, args=(sorted_invoices,), daemon=True)
+        self.worker.start()
+        self.start_polling()
+
+    def run_worker(self, invoice_files: List[str]):
         try:
-            for invoice_file in sorted(
-                self.selected_invoices,
-                key=lambda x: self.extract_invoice_number_from_filename(x)
-            ):
-                self.process_single_invoice(invoice_file)
+            with invoice_metrics.profiled(self.config.get('profile_file')):
+                self.process_invoices(invoice_files)
         except Exception as e:
             self.log_message(f"Ошибка при обработке файлов: {str(e)}")
-            messagebox.showerror("Ошибка", f"Произошла ошибка при обработке файлов: {str(e)}")
+            self.events.put(("error", f"Произошла ошибка при обработке файлов: {str(e)}"))
+        finally:
+            self.events.put(("done",))
+
+    def process_invoices(self, sorted_invoices: List[str]):
+        """
+        Process invoices in order and append them to the report. Runs on the worker thread;
+        a cancel request stops it between invoices, before anything of the next one is written.
+        Broken files found by the pre-flight check and files that fail later are skipped and
+        listed in an error report at the end, the other files are added.
+        """
+        metrics_file = self.config.get('metrics_file')
+        metrics = invoice_metrics.BatchMetrics(
+            trace_memory=bool(metrics_file) and self.config.get('metrics_trace_memory', DEFAULT_CONFIG['metrics_trace_memory'])
+        )
+        metrics.start()
+        with metrics.stage("store_open"):
+            store = invoice_store.open_store(self.output_file, self.config, self.log_message)
+        with metrics.stage("ledger_open"):
+            ledger = invoice_ledger.open_ledger(self.output_file, self.config, self.log_message, store)
+        try:
+            with metrics.stage("ledger_check"):
+                pending_invoices, digests = invoice_ledger.skip_processed_files(
+                    ledger, sorted_invoices, self.log_message
+                )
+            errors = invoice_preflight.ErrorReport()
+            if pending_invoices and invoice_preflight.preflight_enabled(self.config):
+                with metrics.stage("preflight"):
+                    checked = invoice_preflight.preflight(pending_invoices, self.config)
+                checked.log_summary(self.log_message)
+                errors.add_preflight(checked)
+                pending_invoices = checked.runnable(pending_invoices)
+            done_count = len(sorted_invoices) - len(pending_invoices)
+            self.report_progress(done_count, len(sorted_invoices))
+
+            # Rows are saved in blocks of commit_every invoices; each block is journaled, so a
+            # crash or cancel loses at most the block in progress. With on-demand export the
+            # rows go to the report store only and the report is written by invoice_cli --export
+            save = self.save_with_formatting
+            if store is not None and not invoice_store.export_on_commit(self.config):
+                save = None
+            batch = invoice_ledger.PendingBatch(
+                ledger, save, invoice_ledger.commit_interval(self.config), metrics, store
+            )
+            review_mode = self.review_mode()
+            # Invoices that failed validation, reviewed after the batch:
+            # (invoice_file, sheet, extracted_data, file_digest, problems)
+            review_queue = []
+            failures = {}
+            for invoice_file, blocks in self.parse_invoices(pending_invoices, digests, metrics, failures):
+                if self.cancel_event.is_set():
+                    break
+                if invoice_file in failures:
+                    errors.add(invoice_file, invoice_preflight.STAGE_READ, failures[invoice_file])
+                    done_count += 1
+                    self.report_progress(done_count, len(sorted_invoices))
+                    continue
+                problems = [invoice_core.validate_invoice(extracted_data, self.config) for _, extracted_data in blocks]
+                # The file counts as processed with its last sheet, or its last sheet waiting for review,
+                # so a workbook cancelled halfway is read again and only its remaining sheets are added
+                queued = [index for index, found in enumerate(problems) if found] if review_mode == 'anomalies' else []
+                digest_index = queued[-1] if queued else len(blocks) - 1
+                file_failed = False
+                for index, (sheet, extracted_data) in enumerate(blocks):
+                    if self.cancel_event.is_set():
+                        break
+                    label = invoice_core.invoice_label(invoice_file, sheet)
+                    if batch.is_duplicate(invoice_core.invoice_key(extracted_data)):
+                        self.log_message(f"Счет-фактура уже есть в отчете, пропущен: {label}")
+                        continue
+                    # A workbook with a sheet that failed is not marked as processed, so it is read again next time
+                    file_digest = digests.get(invoice_file) if index == digest_index and not file_failed else None
+                    if problems[index]:
+                        self.log_message(f"Требует проверки {label}: {'; '.join(problems[index])}", logging.WARNING)
+                    if index in queued:
+                        review_queue.append((invoice_file, sheet, extracted_data, file_digest, problems[index]))
+                        continue
+                    if not self.add_invoice(batch, metrics, errors, invoice_file, sheet, extracted_data, file_digest,
+                                            review=review_mode == 'all', problems=problems[index]):
+                        file_failed = True
+                if self.cancel_event.is_set():
+                    break
+                done_count += 1
+                self.report_progress(done_count, len(sorted_invoices))
+
+            if review_queue and not self.cancel_event.is_set():
+                # Invoices that passed are saved before the user starts going through the queue
+                self.log_committed(batch.commit())
+                self.log_message(f"Счетов-фактур на проверку: {len(review_queue)}")
+                for invoice_file, sheet, extracted_data, file_digest, problems in review_queue:
+                    if self.cancel_event.is_set():
+                        break
+                    if batch.is_duplicate(invoice_core.invoice_key(extracted_data)):
+                        self.log_message(
+                            f"Счет-фактура уже есть в отчете, пропущен: {invoice_core.invoice_label(invoice_file, sheet)}"
+                        )
+                        continue
+                    self.add_invoice(batch, metrics, errors, invoice_file, sheet, extracted_data, file_digest,
+                                     review=True, problems=problems)
+            if self.cancel_event.is_set():
+                self.log_message("Обработка прервана пользователем")
+                if review_queue:
+                    self.log_message(f"Не проверены и не добавлены счета-фактуры: {len(review_queue)}")
+
+            # Invoices finished before a cancel are still written in one piece
+            self.log_committed(batch.commit())
+            self.report_errors(errors)
+        finally:
+            if ledger is not None:
+                ledger.close()
+            if store is not None:
+                store.close()
+            metrics.stop()
+            metrics.record_report(self.output_file)
+            if metrics_file:
+                self.log_message(metrics.summary_table())
+                metrics.write(metrics_file)
+
+    def review_mode(self) -> str:
+        """"all" shows every invoice, "anomalies" only those failing validation, "none" no dialogs"""
+        # The checkbox mirrors show_review_dialog (save_dialog_setting); Tk variables are not read off the main thread
+        if not self.config.get('show_review_dialog', True):
+            return 'none'
+        return 'all' if self.config.get('review_mode', DEFAULT_CONFIG['review_mode']) == 'all' else 'anomalies'
+
+    def add_invoice(self, batch, metrics, errors, invoice_file: str, sheet: Optional[str], extracted_data: Dict,
+                    file_digest: Optional[str], review: bool, problems: Optional[List[str]] = None) -> bool:
+        """
+        Build the rows of one invoice, after the review dialog when review is set, and add them to the batch.
+        An invoice that fails goes to errors (an invoice_preflight.ErrorReport); returns False then.
+        """
+        # Includes the time the review dialog is open
+        started = time.perf_counter()
+        try:
+            new_df = self.process_single_invoice(invoice_file, save=False, extracted_data=extracted_data,
+                                                 sheet=sheet, review=review, problems=problems)
+        except Exception as e:
+            # process_single_invoice has logged it; the batch goes on with the next invoice
+            errors.add(invoice_file, invoice_preflight.STAGE_PROCESS, invoice_core.error_text(e), sheet)
+            return False
+        metrics.add_invoice_time(invoice_file, "review_build", time.perf_counter() - started,
+                                 None if new_df is None else len(new_df))
+        if new_df is not None:
+            self.log_committed(batch.add(new_df, invoice_file, file_digest))
+        return True
+
+    def report_errors(self, errors):
+        """
+        List the files that failed in the log, write them next to the report and tell the user.
+        A run without errors removes the error report of an earlier run.
+        """
+        errors.log_summary(self.log_message)
+        try:
+            errors_file = errors.save(invoice_preflight.error_report_path(self.output_file))
+        except OSError as e:
+            self.log_message(f"Не удалось записать отчет об ошибках: {e}")
+            errors_file = None
+        if not errors:
+            return
+        where = ""
+        if errors_file is not None:
+            self.log_message(f"Отчет об ошибках: {errors_file}")
+            where = f"\nОтчет об ошибках: {errors_file}"
+        self.events.put(("warning", f"Не обработано файлов из-за ошибок: {len(errors.files())}.{where}"))
+
+    def log_committed(self, invoice_count: int):
+        if invoice_count > 1:
+            self.log_message(f"Пакетно добавлено счетов-фактур: {invoice_count}")
+
+    def report_progress(self, done: int, total: int):
+        self.events.put(("progress", done, total, time.perf_counter()))
+
+    def cancel_processing(self):
+        if self.worker is not None and self.worker.is_alive():
+            self.cancel_event.set()
+            self.cancel_button.config(state=tk.DISABLED)
+            self.log_message("Отмена: обработка остановится после текущего счета-фактуры")
+
+    def on_close(self):
+        """Let a running worker stop between invoices before the window is destroyed"""
+        # Also stops a folder scan that is still running
+        self.close_requested = True
+        if self.worker is not None and self.worker.is_alive():
+            self.cancel_processing()
+        else:
+            self.root.destroy()
+
+    def run_in_gui(self, func):
+        """Run func on the Tk thread and return its result; called from the worker thread"""
+        if threading.current_thread() is threading.main_thread():
+            return func()
+        result = {}
+        finished = threading.Event()
+        self.events.put(("call", func, result, finished))
+        finished.wait()
+        if "error" in result:
+            raise result["error"]
+        return result.get("value")
+
+    def start_polling(self):
+        if not self.polling:
+            self.polling = True
+            self.root.after(EVENT_POLL_MS, self.poll_events)
+
+    def poll_events(self):
+        """
+        Drain worker events: progress, calls into the GUI thread and the end of the batch,
+        and the files of a folder scan. Polling goes on while a batch or a scan is running.
+        """
+        progress = None
+        batch_done = False
+        while True:
+            try:
+                event = self.events.get_nowait()
+            except queue.Empty:
+                break
+            kind = event[0]
+            if kind == "progress":
+                progress = event[1:]
+            elif kind == "call":
+                _, func, result, finished = event
+                self.flush_log()
+                try:
+                    result["value"] = func()
+                except Exception as e:
+                    result["error"] = e
+                finally:
+                    finished.set()
+            elif kind == "error":
+                self.flush_log()
+                messagebox.showerror("Ошибка", event[1])
+            elif kind == "warning":
+                self.flush_log()
+                messagebox.showwarning("Предупреждение", event[1])
+            elif kind == "files":
+                self.add_invoice_files(event[1])
+            elif kind == "scan_done":
+                self.scanning = False
+                self.folder_button.config(state=tk.NORMAL)
+                self.log_message(f"Найдено счетов-фактур в папке {event[1]}: {event[2]}")
+            elif kind == "done":
+                batch_done = True
+        if progress is not None:
+            self.show_progress(*progress)
+
+        if batch_done:
+            self.process_button.config(state=tk.NORMAL)
+            self.cancel_button.config(state=tk.DISABLED)
+            if self.close_requested:
+                self.polling = False
+                self.root.destroy()
+                return
+        batch_running = not batch_done and self.worker is not None and self.worker.is_alive()
+        # The worker may have sent its last events after the queue was drained
+        if batch_running or self.scanning or not self.events.empty():
+            self.root.after(EVENT_POLL_MS, self.poll_events)
+        else:
+            self.polling = False
 
-    def process_single_invoice(self, invoice_file: str):
+    def show_progress(self, done: int, total: int, reported_at: float):
+        elapsed = reported_at - self.progress_started
+        rate = done / elapsed if elapsed > 0 else 0.0
+        self.progress_bar.config(value=done)
+        self.progress_label.config(text=f"{done} / {total}, {rate:.1f} файлов/с")
+
+    def parse_invoices(self, invoice_files: List[str], digests: Optional[Dict[str, str]] = None, metrics=None,
+                       failures: Optional[Dict[str, str]] = None):
+        """
+        Read and extract invoices in worker processes, yielding (invoice_file, blocks) in order,
+        with one (sheet, extracted_data) block per invoice of the workbook.
+        When the review dialog changes the cell settings, the results still pending in the
+        pool were parsed with the old ones: they are dropped and the remaining invoices are
+        submitted to a new pool with the new settings.
+        With a failures dict, files that cannot be read are yielded without blocks and their
+        errors stored there (see invoice_core.parse_invoices).
+        """
+        workers = invoice_core.resolve_parse_workers(self.config, len(invoice_files))
+        if workers > 1:
+            self.log_message(f"Разбор счетов-фактур в {workers} процессах")
+        cache = invoice_cache.open_cache(self.config)
+        parsed_count = 0
         try:
-            invoice_df = pd.read_excel(invoice_file, header=None)
-            extracted_data = self.extract_invoice_data(invoice_df)
+            while parsed_count < len(invoice_files):
+                remaining = invoice_files[parsed_count:]
+                parsed_settings = invoice_core.extraction_settings(self.config)
+                parsed = invoice_core.parse_invoices(
+                    remaining, self.config, min(workers, len(remaining)), cache, digests, metrics, failures
+                )
+                try:
+                    for invoice_file, blocks, messages in parsed:
+                        if invoice_core.extraction_settings(self.config) != parsed_settings:
+                            # Closing the generator cancels the pending results; this file is parsed again
+                            if failures is not None:
+                                failures.pop(invoice_file, None)
+                            self.log_message(
+                                f"Настройки ячеек изменены, разбираются заново счетов-фактур: {len(invoice_files) - parsed_count}"
+                            )
+                            break
+                        for message in messages:
+                            self.log_message(message)
+                        yield invoice_file, blocks
+                        parsed_count += 1
+                finally:
+                    parsed.close()
+        except Exception as e:
+            if parsed_count < len(invoice_files):
+                self.log_message(f"Ошибка обработки файла {Path(invoice_files[parsed_count]).name}: {str(e)}")
+            raise
+        finally:
+            if cache is not None:
+                self.log_message(cache.summary())
+
+    def process_single_invoice(self, invoice_file: str, save: bool = True, extracted_data: Optional[Dict] = None,
+                               sheet: Optional[str] = None, review: Optional[bool] = None,
+                               problems: Optional[List[str]] = None) -> Optional[pd.DataFrame]:
+        """
+        Extract one invoice and either save it right away or return its rows for a batch write.
+        The review dialog is shown when review is set, by default when show_review_dialog is on.
+        """
+        label = invoice_core.invoice_label(invoice_file, sheet)
+        try:
+            if extracted_data is None:
+                invoice_df = invoice_core.read_invoice(invoice_file, self.config)
+                extracted_data = self.extract_invoice_data(invoice_df)
             
-            if self.show_dialog_var.get():
-                dialog = DataReviewDialog(self.root, extracted_data, self.config)
+            if review is None:
+                review = self.review_mode() != 'none'
+            if review:
+                dialog = self.run_in_gui(lambda: DataReviewDialog(self.root, extracted_data, self.config, problems))
                 if dialog.result is None:
-                    self.log_message(f"Обработка отменена для файла: {invoice_file}")
-                    return
+                    self.log_message(f"Обработка отменена для файла: {label}")
+                    return None
                 extracted_data, updated_config = dialog.result
                 self.config = updated_config
                 self.save_config()
+                self.log_profile_rules(extracted_data.get('profile'))
             
-            # Create DataFrame for new invoice data
-            new_rows = []
-            for i, item in enumerate(extracted_data['items']):
-                row = {
-                    0: extracted_data['number']['value'] if i == 0 else '',
-                    1: extracted_data['contractor']['value'] if i == 0 else '',
-                    2: extracted_data['date']['value'].strftime('%d.%m.%Y') if isinstance(extracted_data['date']['value'], datetime) and i == 0 else str(extracted_data['date']['value']) if i == 0 else '',
-                    3: 'Э' if i == 0 else '',
-                    4: item['text_part']['value'],
-                    5: '',
-                    6: item['numeric_part']['value'],
-                    7: item['weight']['value'],
-                    8: item['price']['value'],
-                    9: '',
-                    10: '',
-                    11: f"{extracted_data['number']['value']} от {extracted_data['date']['value'].strftime('%d.%m.%Y')}" if isinstance(extracted_data['date']['value'], datetime) and i == 0 else f"{extracted_data['number']['value']} от {str(extracted_data['date']['value'])}" if i == 0 else ''
-                }
-                new_rows.append(row)
-
-            new_df = pd.DataFrame(new_rows)
-            self.save_with_formatting(new_df)
-            self.log_message(f"Успешно обработан файл: {Path(invoice_file).name}")
+            new_df = self.build_invoice_rows(extracted_data)
+            if save:
+                self.save_with_formatting(new_df)
+            self.log_message(f"Успешно обработан файл: {label}")
+            return new_df
 
         except Exception as e:
-            self.log_message(f"Ошибка обработки файла {Path(invoice_file).name}: {str(e)}")
+            self.log_message(f"Ошибка обработки файла {label}: {str(e)}")
             raise
 
-    def extract_invoice_data(self, invoice_df):
-        extracted_data = {
-            'contractor': {'value': "", 'cell': ""},
-            'number': {'value': "", 'cell': ""},
-            'date': {'value': None, 'cell': ""},
-            'items': []
-        }
-
-        # Extract contractor name
-        contractor_cell_location = self.config.get('contractor_cell', DEFAULT_CONFIG['contractor_cell'])
-        contractor_name_cell = self.get_cell_value(invoice_df, contractor_cell_location)
-        if contractor_name_cell:
-            # Extract text between quotes if present
-            quotes_match = re.search(r'"([^"]+)"', str(contractor_name_cell))
-            if quotes_match:
-                extracted_data['contractor']['value'] = quotes_match.group(1).strip()
-            else:
-                extracted_data['contractor']['value'] = str(contractor_name_cell).strip()
-            extracted_data['contractor']['cell'] = contractor_cell_location
-        self.log_message(f"Извлечен контрагент: {extracted_data['contractor']['value']} (ячейка: {contractor_cell_location})")
-
-        # Extract invoice number
-        invoice_number_cell_location = self.config.get('number_cell', DEFAULT_CONFIG['number_cell'])
-        invoice_number_cell = self.get_cell_value(invoice_df, invoice_number_cell_location)
-        if invoice_number_cell:
-            extracted_data['number']['value'] = str(invoice_number_cell).strip()
-            extracted_data['number']['cell'] = invoice_number_cell_location
-        self.log_message(f"Извлечен номер счета-фактуры: {extracted_data['number']['value']} (ячейка: {invoice_number_cell_location})")
-
-        # Extract date
-        invoice_date_cell_location = self.config.get('date_cell', DEFAULT_CONFIG['date_cell'])
-        invoice_date_str_cell = self.get_cell_value(invoice_df, invoice_date_cell_location)
-        if invoice_date_str_cell:
-            date_str = str(invoice_date_str_cell).strip()
-            try:
-                extracted_data['date']['value'] = datetime.strptime(date_str, '%d.%m.%Y').date()
-            except ValueError:
-                try:
-                    extracted_data['date']['value'] = datetime.strptime(date_str, '%d %B %Y').date()
-                except ValueError:
-                    try:
-                        extracted_data['date']['value'] = datetime.strptime(date_str, '%d %B %Y г.').date()
-                    except ValueError:
-                        extracted_data['date']['value'] = date_str
-                        self.log_message(f"Предупреждение: Формат даты не распознан в ячейке {invoice_date_cell_location}. Данные сохранены как текст.")
-        extracted_data['date']['cell'] = invoice_date_cell_location
-        self.log_message(f"Извлечена дата счета-фактуры: {extracted_data['date']['value']} (ячейка: {invoice_date_cell_location})")
-
-        # Extract items
-        items_data = []
-        start_row_index = None
-        items_start_cell_location = self.config.get('items_start_cell', DEFAULT_CONFIG['items_start_cell'])
-        start_row_index, start_col_index = self.excel_cell_to_index(items_start_cell_location)
-
-        if start_row_index is not None:
-            item_text_part_col_letter = self.config.get('items_cell_text_part', DEFAULT_CONFIG['items_cell_text_part'])
-            item_numeric_part_col_letter = self.config.get('items_cell_numeric_part', DEFAULT_CONFIG['items_cell_numeric_part'])
-            item_weight_col_letter = self.config.get('items_cell_weight', DEFAULT_CONFIG['items_cell_weight'])
-            item_price_col_letter = self.config.get('items_cell_price', DEFAULT_CONFIG['items_cell_price'])
-
-            row_offset = start_row_index
-            item_index = 0
-            while True:
-                current_row_index = row_offset + item_index
-
-                item_name_full_cell_location = f"{item_text_part_col_letter}{current_row_index + 1}"
-                item_name_full = self.get_cell_value(invoice_df, item_name_full_cell_location)
-
-                if not item_name_full:
-                    break
-
-                self.log_message(f"Чтение позиции из ячейки {item_name_full_cell_location}: Значение = '{item_name_full}'")
-
-                item_weight_cell_location = f"{item_weight_col_letter}{current_row_index + 1}"
-                item_weight = self.get_cell_value(invoice_df, item_weight_cell_location)
-                item_price_cell_location = f"{item_price_col_letter}{current_row_index + 1}"
-                item_price = self.get_cell_value(invoice_df, item_price_cell_location)
-
-                item_text_part = ""
-                item_numeric_part = ""
-                parts = re.split(r'(\d+)', str(item_name_full), 1)
-                item_text_part = parts[0].strip()
-                if len(parts) > 1:
-                    item_numeric_part = parts[1].strip() + "".join(parts[2:]).strip()
+    def log_profile_rules(self, profile: Optional[str]):
+        """Warn about a profile that is never selected automatically"""
+        layout = (self.config.get('profiles') or {}).get(profile) if profile else None
+        if layout is not None and not layout.get('match'):
+            self.log_message(
+                f"Профиль разметки «{profile}» сохранен без правил выбора (нет контрагента в ячейке "
+                f"{self.config.get('contractor_cell', DEFAULT_CONFIG['contractor_cell'])}); "
+                f"добавьте в {CONFIG_FILE} правило match по имени файла или ячейкам-якорям"
+            )
 
-                items_data.append({
-                    'text_part': {'value': item_text_part, 'cell': item_name_full_cell_location},
-                    'numeric_part': {'value': item_numeric_part, 'cell': item_name_full_cell_location},
-                    'weight': {'value': item_weight, 'cell': item_weight_cell_location},
-                    'price': {'value': item_price, 'cell': item_price_cell_location},
-                })
-                item_index += 1
+    def build_invoice_rows(self, extracted_data) -> pd.DataFrame:
+        """Create DataFrame with report rows for one invoice"""
+        return invoice_core.build_invoice_rows(extracted_data)
 
-        self.log_message(f"Извлечено позиций: {len(items_data)}")
-        extracted_data['items'] = items_data
-        return extracted_data
+    def extract_invoice_data(self, invoice_df):
+        return invoice_core.extract_invoice_data(invoice_df, self.config, self.log_message)
 
     def save_with_formatting(self, new_df):
-        try:
-            if not Path(self.output_file).exists():
-                with pd.ExcelWriter(self.output_file, engine='openpyxl') as writer:
-                    new_df.to_excel(writer, sheet_name='Sheet1', index=False, startrow=4)
-                return
-
-            # Load existing workbook
-            book = openpyxl.load_workbook(self.output_file)
-            sheet = book.active
-
-            # Read existing data for combining
-            existing_df = pd.read_excel(self.output_file, skiprows=4, header=None)
-            existing_df = existing_df.dropna(how='all')
-
-            # Combine data
-            combined_df = pd.concat([existing_df, new_df], ignore_index=True)
-            combined_df = combined_df.dropna(how='all')
-
-            # Store original formatting
-            cell_formats = {}
-            for row in range(5, sheet.max_row + 1):
-                for col in range(1, sheet.max_column + 1):
-                    cell = sheet.cell(row=row, column=col)
-                    cell_formats[(row, col)] = {
-                        'number_format': cell.number_format,
-                        'font': cell.font.copy(),
-                        'alignment': cell.alignment.copy(),
-                        'border': cell.border.copy(),
-                        'fill': cell.fill.copy()
-                    }
-
-            # Clear existing content while preserving header rows
-            for row in range(5, sheet.max_row + 1):
-                for col in range(1, sheet.max_column + 1):
-                    sheet.cell(row=row, column=col).value = None
-
-            # Write new data
-            for index, row in combined_df.iterrows():
-                for col_index, value in enumerate(row):
-                    if pd.notna(value):
-                        cell = sheet.cell(row=index + 5, column=col_index + 1)
-                        cell.value = value
-                        
-                        # Restore formatting if available
-                        if (index + 5, col_index + 1) in cell_formats:
-                            fmt = cell_formats[(index + 5, col_index + 1)]
-                            cell.number_format = fmt['number_format']
-                            cell.font = fmt['font']
-                            cell.alignment = fmt['alignment']
-                            cell.border = fmt['border']
-                            cell.fill = fmt['fill']
-
-            book.save(self.output_file)
-            self.log_message("Данные успешно сохранены с сохранением форматирования")
-
-        except Exception as e:
-            self.log_message(f"Ошибка при сохранении файла: {str(e)}")
-            raise
+        """Append new rows to the report without touching the rows already written"""
+        invoice_report.save_with_formatting(
+            self.output_file, new_df, self.log_message,
+            self.config.get('report_writer', DEFAULT_CONFIG['report_writer'])
+        )
 
     def process_invoice(self):
         if not self.output_file:
@@ -416,7 +719,7 @@ class InvoiceProcessor:
             return
 
         try:
-            invoice_df = pd.read_excel(invoice_file, header=None)
+            invoice_df = invoice_core.read_invoice(invoice_file, self.config)
             extracted_data_with_cells = self.extract_invoice_data(invoice_df)
             dialog = DataReviewDialog(self.root, extracted_data_with_cells, self.config)
             result_data, updated_config = dialog.result
@@ -425,26 +728,7 @@ class InvoiceProcessor:
                 self.config = updated_config
                 self.save_config()
 
-                # Create DataFrame for new invoice data only
-                new_rows = []
-                for i, item in enumerate(result_data['items']):
-                    row = {
-                        0: result_data['number']['value'] if i == 0 else '',  # Changed from 'C1' to 0
-                        1: result_data['contractor']['value'] if i == 0 else '',  # Changed from 'C2' to 1
-                        2: result_data['date']['value'].strftime('%d.%m.%Y') if isinstance(result_data['date']['value'], datetime) and i == 0 else (str(result_data['date']['value']) if i == 0 else ''),
-                        3: 'Э' if i == 0 else '',
-                        4: item['text_part']['value'],
-                        5: '',
-                        6: item['numeric_part']['value'],
-                        7: item['weight']['value'],
-                        8: item['price']['value'],
-                        9: '',
-                        10: '',
-                        11: f"{result_data['number']['value']} от {result_data['date']['value'].strftime('%d.%m.%Y')}" if isinstance(result_data['date']['value'], datetime) and i == 0 else (f"{result_data['number']['value']} от {str(result_data['date']['value'])}" if i == 0 else '')
-                    }
-                    new_rows.append(row)
-
-                new_df = pd.DataFrame(new_rows)
+                new_df = self.build_invoice_rows(result_data)
                 self.save_with_formatting(new_df)
                 self.log_message(f"Invoice processed successfully: {invoice_file}")
             else:
@@ -456,62 +740,14 @@ class InvoiceProcessor:
 
     def get_cell_value(self, df, cell_location):
         """Get value from cell in DataFrame"""
-        try:
-            row_index, col_index = self.excel_cell_to_index(cell_location)
-            if row_index >= 0 and col_index >= 0:
-                cell_value = df.iloc[row_index, col_index]
-                return str(cell_value) if not pd.isna(cell_value) else ""
-            return ""
-        except (IndexError, ValueError, TypeError) as e:
-            self.log_message(f"Ошибка при чтении ячейки {cell_location}: {e}")
-            return ""
-
-    def get_last_number(self, output_df):
-        """
-        Получает последний номер строки для вставки новых данных.
-        Ищет строку для добавления новой счет-фактуры в столбце 4 (колонка E, ранее C5).
-        Если файл пустой или колонка 4 не найдена, возвращает 0.
-        """
-        self.log_message("Вызвана функция get_last_number")
-        self.log_message(f"Колонны в output_df: {list(output_df.columns)}") # List для читабельности
-
-        if output_df.empty or 4 not in output_df.columns:
-            self.log_message("Файл отчета пуст или нет колонки 4, возвращаем 0")
-            return 0
+        return invoice_core.get_cell_value(df, cell_location, self.log_message)
 
-        c4_column = output_df[4].dropna()
-        self.log_message(f"Колонка 4 (dropna): {c4_column}")
-
-        if c4_column.empty:
-            self.log_message("Колонка 4 пуста после dropna, возвращаем 0")
-            return 0
-
-        last_index = c4_column.last_valid_index()
-        self.log_message(f"last_valid_index: {last_index}")
-
-        if last_index is None:
-            self.log_message("last_index is None, возвращаем 0")
-            return 0
-
-        next_row_index = last_index # Возвращаем индекс последней строки, а не следующую за ней, т.к. save_with_formatting добавляет +5 и +1
-        self.log_message(f"Последний индекс найден: {last_index}, строка для начала записи: {next_row_index + 1} (Excel нумерация)") # +1 для Excel нумерации
-        return next_row_index # Возвращаем индекс последней строки
+    def get_last_number(self, sheet) -> int:
+        """Получает номер первой пустой строки (нумерация Excel) для вставки новой счет-фактуры"""
+        return invoice_report.get_last_number(sheet)
 
     def load_config(self):
-        try:
-            with open(CONFIG_FILE, 'r') as f:
-                config = json.load(f)
-                self.log_message(f"Конфигурация загружена из файла: {CONFIG_FILE}")
-                return config
-        except FileNotFoundError:
-            self.log_message(f"Файл конфигурации не найден: {CONFIG_FILE}. Используется конфигурация по умолчанию. Файл будет создан при сохранении.")
-            return DEFAULT_CONFIG.copy()
-        except json.JSONDecodeError:
-            self.log_message(f"Файл конфигурации поврежден: {CONFIG_FILE}. Конфигурация сброшена к значениям по умолчанию.")
-            return DEFAULT_CONFIG.copy()
-        except Exception as e:
-            self.log_message(f"Непредвиденная ошибка при загрузке конфигурации: {str(e)}. Используется конфигурация по умолчанию.")
-            return DEFAULT_CONFIG.copy()
+        return invoice_core.load_config(CONFIG_FILE, self.log_message)
 
     def save_config(self):
         try:
@@ -533,23 +769,7 @@ class InvoiceProcessor:
 
     def excel_cell_to_index(self, cell_location):
         """Convert Excel cell reference to DataFrame indices"""
-        try:
-            if 'R' in cell_location and 'C' in cell_location:
-                parts = cell_location.upper().split('C')
-                row_index = int(parts[0].replace('R', '')) - 1
-                col_index = int(parts[1]) - 1
-            else:
-                column_letter = ''.join(filter(str.isalpha, cell_location.upper()))
-                row_number = int(''.join(filter(str.isdigit, cell_location)))
-                col_index = 0
-                for letter in column_letter:
-                    col_index = col_index * 26 + (ord(letter) - ord('A') + 1)
-                row_index = row_number - 1
-                col_index -= 1
-            return row_index, col_index
-        except Exception as e:
-            self.log_message(f"Ошибка при преобразовании адреса ячейки {cell_location}: {e}")
-            return None, None
+        return invoice_core.excel_cell_to_index(cell_location, self.log_message)
 
     def index_to_excel_cell(self, row_index, col_index):
         col_letter = ''
@@ -563,34 +783,94 @@ class InvoiceProcessor:
 
 
 class DataReviewDialog(simpledialog.Dialog):
-    def __init__(self, parent, data, config):
+    # Item fields and the config keys of their columns, in display order
+    ITEM_FIELDS = [('text_part', "Текст"), ('numeric_part', "Цифра"), ('weight', "Вес"), ('price', "Цена")]
+
+    def __init__(self, parent, data, config, problems: Optional[List[str]] = None):
         self.extracted_data = data
         self.config = config
+        self.problems = problems or []
+        # Corrected cells go to the layout profile the invoice was read with
+        self.profile = data.get('profile', "")
+        self.layout = invoice_core.profile_config(config, self.profile)
+        self.page_size = max(1, int(config.get('review_page_size', DEFAULT_CONFIG['review_page_size'])))
+        self.page = 0
         self.result = None
         super().__init__(parent, "Проверка и редактирование данных")
 
     def body(self, frame):
         tk.Label(frame, text="Проверьте и отредактируйте данные, при необходимости укажите ячейки вручную:").pack(anchor=tk.W)
+        if self.problems:
+            tk.Label(
+                frame, text="Замечания: " + "; ".join(self.problems), fg="red",
+                anchor=tk.W, justify=tk.LEFT, wraplength=700
+            ).pack(anchor=tk.W, padx=20)
         self.entries = {}
 
+        self.create_profile_row(frame)
         self.create_data_row(frame, 'contractor', "Контрагент:")
         self.create_data_row(frame, 'number', "Номер счета-фактуры:")
         self.create_data_row(frame, 'date', "Дата счета-фактуры:")
+        self.create_column_row(frame)
 
         tk.Label(frame, text="Позиции:").pack(anchor=tk.W)
-        items_frame = tk.Frame(frame, bd=1, relief=tk.SOLID, padx=5, pady=5)
-        items_frame.pack(fill=tk.X, expand=True, anchor=tk.W, padx=10, pady=5)
+        self.items_frame = tk.Frame(frame, bd=1, relief=tk.SOLID, padx=5, pady=5)
+        self.items_frame.pack(fill=tk.X, expand=True, anchor=tk.W, padx=10, pady=5)
+
+        # Only one page of items is built at a time, so invoices with hundreds of items open at once
+        pager = tk.Frame(frame)
+        pager.pack(anchor=tk.W, padx=10)
+        self.prev_button = tk.Button(pager, text="< Назад", command=lambda: self.show_page(self.page - 1))
+        self.prev_button.pack(side=tk.LEFT)
+        self.page_label = tk.Label(pager, padx=10)
+        self.page_label.pack(side=tk.LEFT)
+        self.next_button = tk.Button(pager, text="Вперед >", command=lambda: self.show_page(self.page + 1))
+        self.next_button.pack(side=tk.LEFT)
+        self.show_page(0)
+
+        return frame
 
-        for i, item in enumerate(self.extracted_data['items']):
-            item_label = tk.Label(items_frame, text=f"Позиция {i+1}:", anchor=tk.W)
-            item_label.grid(row=i, column=0, sticky=tk.W)
+    def show_page(self, page: int):
+        items = self.extracted_data['items']
+        page_count = max(1, -(-len(items) // self.page_size))
+        self.page = min(max(page, 0), page_count - 1)
+        for child in self.items_frame.winfo_children():
+            child.destroy()
+
+        start = self.page * self.page_size
+        page_items = items[start:start + self.page_size]
+        numeric = {key: items.numeric_mask(key)[start:start + self.page_size] for key in ('weight', 'price')}
+        for column, title in enumerate(["№"] + [title for _, title in self.ITEM_FIELDS]):
+            tk.Label(self.items_frame, text=title, anchor=tk.W).grid(row=0, column=column, sticky=tk.W, padx=5)
+        for row, item in enumerate(page_items, start=1):
+            tk.Label(self.items_frame, text=f"{start + row}", anchor=tk.W).grid(row=row, column=0, sticky=tk.W, padx=5)
+            for column, (item_key, _) in enumerate(self.ITEM_FIELDS, start=1):
+                # Weights and prices that are not numbers are shown in red
+                color = "red" if item_key in numeric and not numeric[item_key][row - 1] else "black"
+                tk.Label(
+                    self.items_frame, text=f"{getattr(item, item_key)} ({items.cell(item_key, start + row - 1)})",
+                    fg=color,
+                    anchor=tk.W, wraplength=180, justify=tk.LEFT
+                ).grid(row=row, column=column, sticky=tk.W, padx=5)
+
+        if items:
+            self.page_label.config(text=f"Позиции {start + 1}–{start + len(page_items)} из {len(items)}")
+        else:
+            self.page_label.config(text="Позиций нет")
+        self.prev_button.config(state=tk.NORMAL if self.page > 0 else tk.DISABLED)
+        self.next_button.config(state=tk.NORMAL if self.page < page_count - 1 else tk.DISABLED)
 
-            self.create_item_row(items_frame, item, 'text_part', i, 1, "Текст:")
-            self.create_item_row(items_frame, item, 'numeric_part', i, 2, "Цифра:")
-            self.create_item_row(items_frame, item, 'weight', i, 3, "Вес:")
-            self.create_item_row(items_frame, item, 'price', i, 4, "Цена:")
+    def create_profile_row(self, frame):
+        profile_frame = tk.Frame(frame)
+        profile_frame.pack(fill=tk.X, expand=True, anchor=tk.W, padx=20)
 
-        return frame
+        tk.Label(profile_frame, text="Профиль разметки:").pack(side=tk.LEFT, anchor=tk.W)
+        entry = tk.Entry(profile_frame, width=30)
+        entry.pack(side=tk.LEFT, padx=10)
+        # Without a matched profile, corrections start a new profile of this supplier
+        entry.insert(0, self.profile or self.extracted_data['contractor']['value'])
+        tk.Label(profile_frame, text="(пусто — общая разметка для всех поставщиков)", anchor=tk.W).pack(side=tk.LEFT)
+        self.entries['profile'] = entry
 
     def create_data_row(self, frame, data_key, label_text):
         data_frame = tk.Frame(frame)
@@ -604,41 +884,50 @@ class DataReviewDialog(simpledialog.Dialog):
 
         entry = tk.Entry(data_frame, width=10)
         entry.pack(side=tk.LEFT, padx=10)
-        entry.insert(0, self.config.get(f"{data_key}_cell", ""))
+        entry.insert(0, self.layout.get(f"{data_key}_cell", ""))
         self.entries[data_key] = entry
 
-    def create_item_row(self, frame, item, item_key, row_index, col_index, label_text):
-        item_frame = tk.Frame(frame)
-        item_frame.grid(row=row_index, column=col_index, sticky=tk.W + tk.E + tk.N + tk.S, padx=5)
-
-        tk.Label(item_frame, text=label_text, anchor=tk.W).pack(anchor=tk.W)
-        value_label = tk.Label(item_frame, text=f"Значение: {item[item_key]['value']}", anchor=tk.W, wraplength=150, justify=tk.LEFT)
-        value_label.pack(anchor=tk.W)
-        cell_label = tk.Label(item_frame, text=f"Ячейка: {item[item_key]['cell']}", anchor=tk.W)
-        cell_label.pack(anchor=tk.W)
-        entry = tk.Entry(item_frame, width=8)
-        entry.pack(anchor=tk.W)
-        config_key = f"items_cell_{item_key}"
-        entry.insert(0, self.config.get(config_key, ""))
-        self.entries[f"items_{row_index}_{item_key}"] = entry
+    def create_column_row(self, frame):
+        column_frame = tk.Frame(frame)
+        column_frame.pack(fill=tk.X, expand=True, anchor=tk.W, padx=20)
+
+        tk.Label(column_frame, text="Столбцы позиций:").pack(side=tk.LEFT, anchor=tk.W)
+        for item_key, title in self.ITEM_FIELDS:
+            tk.Label(column_frame, text=f"{title}:").pack(side=tk.LEFT, padx=(10, 2))
+            entry = tk.Entry(column_frame, width=6)
+            entry.pack(side=tk.LEFT)
+            entry.insert(0, self.layout.get(f"items_cell_{item_key}", ""))
+            self.entries[f"items_{item_key}"] = entry
 
     def apply(self):
-        updated_config = self.config.copy()
+        layout_changes = {}
         updated_data = self.extracted_data.copy()
+        contractor_anchor = (self.layout.get('contractor_cell', ""), self.extracted_data['contractor']['value'])
 
         for key in ['contractor', 'number', 'date']:
             cell_entry = self.entries[key].get().strip().upper()
             if cell_entry:
-                updated_config[f"{key}_cell"] = cell_entry
+                layout_changes[f"{key}_cell"] = cell_entry
                 updated_data[key]['cell'] = cell_entry
 
-        for i, item in enumerate(updated_data['items']):
-            for item_key in ['text_part', 'numeric_part', 'weight', 'price']:
-                cell_entry = self.entries[f"items_{i}_{item_key}"].get().strip().upper()
-                if cell_entry:
-                    config_key = f"items_cell_{item_key}"
-                    updated_config[config_key] = cell_entry
-                    item[item_key]['cell'] = cell_entry
+        item_columns = {}
+        for item_key, _ in self.ITEM_FIELDS:
+            cell_entry = self.entries[f"items_{item_key}"].get().strip().upper()
+            config_key = f"items_cell_{item_key}"
+            if cell_entry and cell_entry != self.layout.get(config_key):
+                layout_changes[config_key] = cell_entry
+                item_columns[item_key] = cell_entry
+        if item_columns:
+            updated_data['items'] = updated_data['items'].with_columns(item_columns)
+
+        # Only cells that differ from the layout used are stored, so confirming an
+        # invoice unchanged never creates or rewrites a profile
+        layout_changes = {key: value for key, value in layout_changes.items() if value != self.layout.get(key)}
+        profile = self.entries['profile'].get().strip()
+        updated_config = self.config.copy()
+        if layout_changes:
+            updated_config = invoice_core.update_profile_layout(self.config, profile, layout_changes, contractor_anchor)
+            updated_data['profile'] = profile
 
         self.result = updated_data, updated_config
         self.config = updated_config
@@ -0,0 +1,114 @@
+"""On-disk cache of extracted invoice data (the invoice blocks of each workbook).
+
+Entries are keyed by the SHA-256 of the invoice file content and a fingerprint
+of the extraction settings, so a re-run only parses new or changed invoices, and
+changing a cell in invoice_config.json never serves stale data. Entries are
+zlib-compressed pickles; when the cache grows over its size limit the least
+recently used entries are removed.
+"""
+import hashlib
+import json
+import logging
+import os
+import pickle
+import zlib
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import invoice_core
+
+CACHE_DIR = Path(__file__).resolve().parent / "invoice_cache"
+CACHE_SUFFIX = ".pkl.z"
+
+logger = logging.getLogger(__name__)
+
+
+class InvoiceCache:
+    def __init__(self, cache_dir, max_bytes: int):
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def settings_fingerprint(settings: Dict) -> str:
+        payload = json.dumps(
+            {"settings": settings, "version": invoice_core.EXTRACTION_VERSION},
+            sort_keys=True, ensure_ascii=False
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:16]
+
+    def key(self, invoice_file: str, settings: Dict, file_digest: Optional[str] = None) -> str:
+        """Cache key of an invoice: hash of the file content plus the settings fingerprint"""
+        file_digest = file_digest or invoice_core.file_digest(invoice_file)
+        return f"{file_digest}-{self.settings_fingerprint(settings)}"
+
+    def path(self, key: str) -> Path:
+        return self.cache_dir / f"{key}{CACHE_SUFFIX}"
+
+    def load(self, key: str) -> Optional[List]:
+        entry_path = self.path(key)
+        try:
+            with open(entry_path, "rb") as f:
+                extracted_data = pickle.loads(zlib.decompress(f.read()))
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        except Exception as e:
+            logger.warning(f"Поврежденная запись кэша {entry_path.name} удалена: {e}")
+            entry_path.unlink(missing_ok=True)
+            self.misses += 1
+            return None
+        # The modification time marks recent use for LRU eviction
+        os.utime(entry_path)
+        self.hits += 1
+        return extracted_data
+
+    def store(self, key: str, extracted_data: List):
+        entry_path = self.path(key)
+        temp_path = entry_path.with_suffix(".tmp")
+        try:
+            with open(temp_path, "wb") as f:
+                f.write(zlib.compress(pickle.dumps(extracted_data, protocol=pickle.HIGHEST_PROTOCOL), 6))
+            os.replace(temp_path, entry_path)
+        except OSError as e:
+            logger.warning(f"Не удалось записать кэш {entry_path.name}: {e}")
+            temp_path.unlink(missing_ok=True)
+
+    def evict(self) -> int:
+        """Remove least recently used entries until the cache fits max_bytes; returns the number removed"""
+        entries = []
+        total = 0
+        for entry_path in self.cache_dir.glob(f"*{CACHE_SUFFIX}"):
+            try:
+                stat = entry_path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry_path))
+            total += stat.st_size
+
+        removed = 0
+        for _, size, entry_path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            entry_path.unlink(missing_ok=True)
+            total -= size
+            removed += 1
+        return removed
+
+    def summary(self) -> str:
+        return f"Кэш разбора: попаданий {self.hits}, промахов {self.misses}"
+
+
+def open_cache(config: Dict) -> Optional[InvoiceCache]:
+    """Cache configured by "cache_enabled", "cache_dir" and "cache_max_mb", or None when disabled"""
+    if not config.get("cache_enabled", invoice_core.DEFAULT_CONFIG["cache_enabled"]):
+        return None
+    cache_dir = config.get("cache_dir") or CACHE_DIR
+    max_mb = config.get("cache_max_mb", invoice_core.DEFAULT_CONFIG["cache_max_mb"])
+    try:
+        return InvoiceCache(cache_dir, int(max_mb * 1024 * 1024))
+    except OSError as e:
+        logger.warning(f"Кэш разбора недоступен ({cache_dir}): {e}")
+        return None
@@ -0,0 +1,377 @@
+"""Headless batch processing of invoices for scheduled and unattended runs.
+
+Usage:
+    python invoice_cli.py REPORT.xlsx INVOICE [INVOICE ...] [-r] [--config PATH] [--workers N] [--per-invoice]
+                          [--no-cache] [--metrics FILE] [--profile FILE] [--rebuild-ledger] [--rebuild-store]
+                          [--no-preflight] [--errors FILE] [-v]
+    python invoice_cli.py REPORT.xlsx INVOICE [INVOICE ...] --preflight
+    python invoice_cli.py REPORT.xlsx [--export | --export-full] [--totals contractor|month|day]
+    python invoice_cli.py REPORT.xlsx [INVOICE ...] --summary SUMMARY.xlsx|SUMMARY.csv [--reconcile]
+
+Each INVOICE can be a file, a glob pattern (expanded here, so quoting works the
+same on every shell) or a directory, whose *.xlsx files are taken (with -r also
+those of its subdirectories). The review dialog is never shown. This module
+and everything it imports stay free of tkinter, so it runs on machines without
+a display.
+
+Before the run the files are checked (invoice_preflight, "preflight" in the
+config); broken files are left out, and files that fail later do not stop the
+run. The failures are listed at the end and written to REPORT.xlsx.errors.csv
+(or --errors FILE), and the exit status is 1. --preflight only runs the check.
+
+--export and --export-full write the report from its row store (invoice_store),
+which is how a report kept with "report_export": "on_demand" catches up;
+--totals prints per-contractor, per-month or per-day totals from the store.
+--summary writes totals per contractor, invoice and month computed from the
+report itself (invoice_summary); with --reconcile the INVOICE files are not
+added but compared with the report.
+"""
+import argparse
+import glob
+import logging
+import os
+import sys
+import time
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+import invoice_cache
+import invoice_core
+import invoice_ledger
+import invoice_log
+import invoice_metrics
+import invoice_preflight
+import invoice_report
+import invoice_selection
+import invoice_store
+import invoice_summary
+
+logger = logging.getLogger("invoice_cli")
+
+
+def collect_invoice_files(inputs: List[str], recursive: bool = False) -> List[str]:
+    """
+    Expand files, glob patterns and directories (with their subdirectories when recursive)
+    into a sorted list of invoice files
+    """
+    invoice_files = []
+    seen = set()
+    for pattern in inputs:
+        if os.path.isdir(pattern):
+            candidates = invoice_selection.walk_invoice_files(
+                pattern, recursive, lambda e: logger.warning(f"Папка недоступна: {e}")
+            )
+        elif glob.has_magic(pattern):
+            candidates = sorted(glob.glob(pattern))
+        else:
+            candidates = [pattern]
+        for candidate in candidates:
+            # Skip Excel lock files of workbooks that are currently open
+            if Path(candidate).name.startswith("~$"):
+                continue
+            key = os.path.abspath(candidate)
+            if key not in seen:
+                seen.add(key)
+                invoice_files.append(candidate)
+    return sorted(invoice_files, key=invoice_core.invoice_sort_key)
+
+
+def run_batch(output_file: str, invoice_files: List[str], config: Dict,
+              per_invoice: bool = False, workers: Optional[int] = None,
+              log: Optional[Callable[[str], None]] = None, use_cache: bool = True,
+              metrics: Optional[invoice_metrics.BatchMetrics] = None) -> Dict:
+    """
+    Extract the invoices and append them to the report without any dialogs.
+    Invoices already recorded in the report ledger are skipped. A workbook holding
+    several invoices ("invoice_sheets") adds one invoice block per sheet. With the
+    report store and "report_export": "on_demand" the rows go to the store only.
+    Files that are broken (see invoice_preflight) or fail to parse or build are left
+    out and collected in an invoice_preflight.ErrorReport; the other files are added.
+    Returns a summary with the number of invoices, skipped duplicates, invoices that failed
+    validation (written anyway), written rows, the error report, cache hits, elapsed time
+    and the per-stage metrics.
+    """
+    log = log or logger.info
+    started = time.perf_counter()
+    metrics = metrics or invoice_metrics.BatchMetrics()
+    metrics.start()
+    if workers is None:
+        workers = invoice_core.resolve_parse_workers(config, len(invoice_files))
+
+    cache = invoice_cache.open_cache(config) if use_cache else None
+    report_writer = config.get('report_writer', invoice_core.DEFAULT_CONFIG['report_writer'])
+    with metrics.stage("store_open"):
+        store = invoice_store.open_store(output_file, config, log)
+    with metrics.stage("ledger_open"):
+        ledger = invoice_ledger.open_ledger(output_file, config, log, store)
+    commit_every = 1 if per_invoice else invoice_ledger.commit_interval(config)
+    save = None
+    if store is None or invoice_store.export_on_commit(config):
+        save = lambda new_df: invoice_report.save_with_formatting(output_file, new_df, log, report_writer)
+    batch = invoice_ledger.PendingBatch(ledger, save, commit_every, metrics, store)
+    skipped = 0
+    needs_review = 0
+    errors = invoice_preflight.ErrorReport()
+    broken = []
+    try:
+        with metrics.stage("ledger_check"):
+            pending_files, digests = invoice_ledger.skip_processed_files(ledger, invoice_files, log)
+        skipped = len(invoice_files) - len(pending_files)
+        if pending_files and invoice_preflight.preflight_enabled(config):
+            with metrics.stage("preflight"):
+                checked = invoice_preflight.preflight(pending_files, config, workers)
+            checked.log_summary(log)
+            errors.add_preflight(checked)
+            broken = checked.broken
+            pending_files = checked.runnable(pending_files)
+        failures = {}
+        for invoice_file, blocks, messages in invoice_core.parse_invoices(
+            pending_files, config, workers, cache, digests, metrics, failures
+        ):
+            for message in messages:
+                log(message)
+            if invoice_file in failures:
+                errors.add(invoice_file, invoice_preflight.STAGE_READ, failures[invoice_file])
+                continue
+            file_failed = False
+            for index, (sheet, extracted_data) in enumerate(blocks):
+                label = invoice_core.invoice_label(invoice_file, sheet)
+                if batch.is_duplicate(invoice_core.invoice_key(extracted_data)):
+                    log(f"Счет-фактура уже есть в отчете, пропущен: {label}")
+                    skipped += 1
+                    continue
+                try:
+                    # Nobody reviews a headless run, so invoices failing validation are written and reported
+                    problems = invoice_core.validate_invoice(extracted_data, config)
+                    build_started = time.perf_counter()
+                    new_df = invoice_core.build_invoice_rows(extracted_data)
+                except Exception as e:
+                    log(f"Ошибка обработки файла {label}: {e}")
+                    errors.add(invoice_file, invoice_preflight.STAGE_PROCESS, invoice_core.error_text(e), sheet)
+                    file_failed = True
+                    continue
+                if problems:
+                    log(f"Требует проверки {label}: {'; '.join(problems)}")
+                    needs_review += 1
+                metrics.add_invoice_time(invoice_file, "build_rows", time.perf_counter() - build_started, len(new_df))
+                if new_df.empty:
+                    log(f"В файле нет позиций: {label}")
+                # The file is marked as processed with its last invoice, so a batch interrupted
+                # in the middle of a workbook parses it again and adds the remaining sheets;
+                # a workbook with a sheet that failed is not marked and is read again next time
+                last_block = index == len(blocks) - 1 and not file_failed
+                batch.add(new_df, invoice_file, digests.get(invoice_file) if last_block else None)
+                log(f"Успешно обработан файл: {label}")
+        batch.commit()
+    finally:
+        if ledger is not None:
+            ledger.close()
+        if store is not None:
+            store.close()
+        metrics.stop()
+        metrics.record_report(output_file)
+
+    if cache is not None:
+        log(cache.summary())
+    errors.log_summary(log)
+    return {
+        # Broken files the pre-flight check left out were not run
+        "invoices": len(invoice_files) - len(broken),
+        "skipped": skipped,
+        "needs_review": needs_review,
+        "failed": len(errors.files()),
+        "errors": errors,
+        "rows": batch.rows_written,
+        "seconds": time.perf_counter() - started,
+        "workers": workers,
+        "cache_hits": cache.hits if cache is not None else 0,
+        "cache_misses": cache.misses if cache is not None else 0,
+        "metrics": metrics,
+    }
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Обработка счетов-фактур без графического интерфейса")
+    parser.add_argument("report", help="файл отчета (.xlsx), создается при отсутствии")
+    parser.add_argument("invoices", nargs="*", help="файлы, шаблоны (*.xlsx) или папки со счетами-фактурами")
+    parser.add_argument("--config", default=str(Path(__file__).resolve().parent / invoice_core.CONFIG_FILE),
+                        help="файл настроек ячеек (по умолчанию invoice_config.json рядом со скриптом)")
+    parser.add_argument("-r", "--recursive", action="store_true",
+                        help="брать счета-фактуры из папок вместе с вложенными папками")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="число процессов для разбора (по умолчанию parse_workers из настроек)")
+    parser.add_argument("--per-invoice", action="store_true",
+                        help="сохранять отчет после каждого счета-фактуры, а не блоками по commit_every")
+    parser.add_argument("--no-cache", action="store_true", help="не использовать кэш разобранных счетов-фактур")
+    parser.add_argument("--metrics", default=None,
+                        help="записать метрики этапов в файл (.json или .csv) и вывести сводную таблицу")
+    parser.add_argument("--profile", default=None,
+                        help="профилировать запуск: .prof для cProfile, .html для pyinstrument")
+    parser.add_argument("--rebuild-ledger", action="store_true",
+                        help="перестроить журнал обработанных счетов-фактур по содержимому отчета")
+    parser.add_argument("--rebuild-store", action="store_true",
+                        help="перестроить хранилище строк отчета по содержимому отчета")
+    parser.add_argument("--export", action="store_true",
+                        help="дописать в отчет строки из хранилища, которые еще не выгружены")
+    parser.add_argument("--export-full", action="store_true",
+                        help="перезаписать строки отчета по хранилищу (шапка и оформление сохраняются)")
+    parser.add_argument("--totals", choices=sorted(invoice_store.TOTALS_GROUPS), default=None,
+                        help="вывести итоги по хранилищу: по контрагентам, месяцам или дням")
+    parser.add_argument("--summary", default=None,
+                        help="записать итоги по контрагентам, счетам и месяцам в файл (.xlsx или .csv)")
+    parser.add_argument("--reconcile", action="store_true",
+                        help="не добавлять счета-фактуры, а сверить их с отчетом (вместе с --summary)")
+    parser.add_argument("--preflight", action="store_true",
+                        help="только проверить файлы: в порядке, требуют проверки, повреждены")
+    parser.add_argument("--no-preflight", action="store_true",
+                        help="не проверять файлы перед обработкой")
+    parser.add_argument("--errors", default=None,
+                        help="файл отчета об ошибках (.csv, по умолчанию рядом с отчетом: REPORT.xlsx.errors.csv)")
+    parser.add_argument("-v", "--verbose", action="store_true", help="подробный лог")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(
+        level=logging.INFO if args.verbose else logging.WARNING,
+        format=invoice_log.LOG_FORMAT
+    )
+
+    if args.reconcile and not args.summary:
+        parser.error("--reconcile используется вместе с --summary")
+    store_actions = args.rebuild_store or args.export or args.export_full or args.totals or args.summary
+    invoice_files = collect_invoice_files(args.invoices, args.recursive)
+    if not invoice_files and (args.invoices or args.reconcile or not store_actions):
+        print("Счета-фактуры не найдены", file=sys.stderr)
+        return 2
+
+    config = invoice_core.load_config(args.config)
+    # The rotating log file gets the configured level, the console stays quiet without -v
+    invoice_log.add_file_handler(config)
+    invoice_log.apply_log_level(config, console_level=logging.INFO if args.verbose else logging.WARNING)
+    if args.preflight:
+        return preflight_command(args, invoice_files, config)
+    if args.no_preflight:
+        config["preflight"] = False
+    if args.rebuild_ledger and Path(args.report).exists():
+        ledger = invoice_ledger.InvoiceLedger.for_report(args.report)
+        try:
+            print(f"Журнал перестроен по отчету: {ledger.rebuild(args.report)} записей")
+        finally:
+            ledger.close()
+    if args.rebuild_store and Path(args.report).exists():
+        store = invoice_store.ReportStore.for_report(args.report)
+        try:
+            print(f"Хранилище перестроено по отчету: {store.rebuild(args.report)} строк")
+        finally:
+            store.close()
+    if invoice_files and not args.reconcile:
+        status = process(args, invoice_files, config)
+        if status:
+            return status
+    if args.export or args.export_full or args.totals:
+        status = store_command(args, config)
+        if status:
+            return status
+    if args.summary:
+        return summary_command(args, invoice_files, config)
+    return 0
+
+
+def process(args, invoice_files: List[str], config: Dict) -> int:
+    metrics_file = args.metrics or config.get('metrics_file')
+    profile_file = args.profile or config.get('profile_file')
+    metrics = invoice_metrics.BatchMetrics(
+        trace_memory=bool(metrics_file) and config.get('metrics_trace_memory', invoice_core.DEFAULT_CONFIG['metrics_trace_memory'])
+    )
+    try:
+        with invoice_metrics.profiled(profile_file):
+            summary = run_batch(args.report, invoice_files, config, per_invoice=args.per_invoice,
+                                workers=args.workers, use_cache=not args.no_cache, metrics=metrics)
+    except Exception as e:
+        print(f"Ошибка при обработке файлов: {e}", file=sys.stderr)
+        return 1
+
+    rate = summary["invoices"] / summary["seconds"] if summary["seconds"] else 0.0
+    print(f"Отчет: {args.report}")
+    print(f"Обработано счетов-фактур: {summary['invoices']} (процессов: {summary['workers']})")
+    print(f"Пропущено как уже добавленные: {summary['skipped']}")
+    print(f"Добавлено строк: {summary['rows']}")
+    if summary['needs_review']:
+        print(f"Требуют проверки (см. лог): {summary['needs_review']}")
+    errors = summary["errors"]
+    errors_file = errors.save(args.errors or invoice_preflight.error_report_path(args.report))
+    if errors:
+        print(f"Не обработаны из-за ошибок: {summary['failed']} (отчет об ошибках: {errors_file})")
+        errors.log_entries(print)
+    print(f"Кэш: попаданий {summary['cache_hits']}, промахов {summary['cache_misses']}")
+    print(f"Время: {summary['seconds']:.2f} с ({rate:.1f} файлов/с)")
+    if metrics_file:
+        print(metrics.summary_table())
+        metrics.write(metrics_file)
+        print(f"Метрики: {metrics_file}")
+    if profile_file:
+        print(f"Профиль: {profile_file}")
+    return 1 if errors else 0
+
+
+def preflight_command(args, invoice_files: List[str], config: Dict) -> int:
+    """Only check the files; the status is 1 when some of them are broken"""
+    checked = invoice_preflight.preflight(invoice_files, config, args.workers)
+    checked.log_summary(print)
+    if checked.broken:
+        errors = invoice_preflight.ErrorReport()
+        errors.add_preflight(checked)
+        if args.errors:
+            print(f"Отчет об ошибках: {errors.write(args.errors)}")
+        return 1
+    return 0
+
+
+def store_command(args, config: Dict) -> int:
+    """Export the report from its row store and/or print totals from it"""
+    if not Path(f"{args.report}{invoice_store.STORE_SUFFIX}").exists() and not Path(args.report).exists():
+        print(f"Нет ни отчета, ни хранилища строк: {args.report}", file=sys.stderr)
+        return 2
+    store = invoice_store.open_store(args.report, dict(config, report_store=True), print)
+    try:
+        if args.export_full:
+            store.export_report(args.report, print)
+        elif args.export:
+            report_writer = config.get('report_writer', invoice_core.DEFAULT_CONFIG['report_writer'])
+            print(f"Выгружено строк из хранилища: {store.export_pending(args.report, print, report_writer)}")
+        if args.totals:
+            print(f"{'группа':<40} {'счетов':>8} {'строк':>8} {'вес':>14} {'сумма':>16}")
+            for group, invoices, rows, weight, price in store.totals(args.totals):
+                print(f"{str(group or '-'):<40} {invoices:>8} {rows:>8} {weight:>14.3f} {price:>16.2f}")
+    finally:
+        store.close()
+    return 0
+
+
+def summary_command(args, invoice_files: List[str], config: Dict) -> int:
+    """Write the report totals, and the reconciliation of invoice_files with --reconcile"""
+    if not Path(args.report).exists():
+        print(f"Отчет не найден: {args.report}", file=sys.stderr)
+        return 2
+    started = time.perf_counter()
+    try:
+        tables = invoice_summary.summarize(args.report, print)
+        if args.reconcile:
+            cache = None if args.no_cache else invoice_cache.open_cache(config)
+            workers = args.workers if args.workers is not None else invoice_core.resolve_parse_workers(
+                config, len(invoice_files)
+            )
+            # Parsing messages go to the log as in a batch run; the outcome is printed
+            reconciliation = invoice_summary.reconcile(tables["invoices"], invoice_files, config, workers, cache)
+            tables["reconciliation"] = reconciliation
+            for status, count in reconciliation["status"].value_counts().items():
+                print(f"Сверка: {status} — {count}")
+        invoice_summary.write_summary(tables, args.summary, print)
+    except Exception as e:
+        print(f"Ошибка при подготовке сводки: {e}", file=sys.stderr)
+        return 1
+    print(f"Время: {time.perf_counter() - started:.2f} с")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,1045 @@
+"""Invoice extraction and report row building shared by the GUI, the CLI and worker processes.
+
+This module must not import tkinter: worker processes of the parsing pool import it
+on every platform, including those that spawn instead of fork, and the CLI has to
+start on machines without a display.
+"""
+import copy
+import fnmatch
+import hashlib
+import json
+import logging
+import math
+import numbers
+import os
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import date, datetime
+from functools import lru_cache
+from pathlib import Path
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+import openpyxl
+import pandas as pd
+
+import invoice_dates
+
+CONFIG_FILE = "invoice_config.json"
+
+DEFAULT_CONFIG = {
+    "contractor_cell": "R9C6",
+    "number_cell": "R2C9",
+    "date_cell": "R2C10",
+    "items_start_cell": "R20C3",
+    "items_cell_text_part": "C",
+    "items_cell_numeric_part": "C",
+    "items_cell_weight": "R",
+    "items_cell_price": "T",
+    "show_review_dialog": True,
+    "review_mode": "anomalies",
+    "review_max_items": 500,
+    "review_page_size": 50,
+    "batch_append": True,
+    "commit_every": 50,
+    "parse_workers": 0,
+    "preflight": True,
+    "extraction_backend": "pandas",
+    "invoice_sheets": "",
+    "profiles": {},
+    "cache_enabled": True,
+    "cache_dir": "",
+    "cache_max_mb": 200,
+    "ledger_enabled": True,
+    "report_store": True,
+    "report_export": "each_commit",
+    "log_level": "INFO",
+    "log_file": "",
+    "log_file_max_kb": 1024,
+    "log_file_backups": 3,
+    "gui_log_lines": 2000,
+    "report_writer": "append",
+    "watch_poll_seconds": 2,
+    "watch_settle_seconds": 3,
+    "watch_batch_size": 20,
+    "metrics_file": "",
+    "metrics_trace_memory": True,
+    "profile_file": ""
+}
+
+# Bump when extract_invoice_data starts returning different data for the same
+# file and settings, so that cached results of older versions are not used
+EXTRACTION_VERSION = 5
+
+# Cell layout of an invoice; a layout profile can override any of these
+LAYOUT_KEYS = (
+    "contractor_cell",
+    "number_cell",
+    "date_cell",
+    "items_start_cell",
+    "items_cell_text_part",
+    "items_cell_numeric_part",
+    "items_cell_weight",
+    "items_cell_price",
+)
+
+# Config keys that change what extract_invoice_data returns
+EXTRACTION_KEYS = LAYOUT_KEYS + (
+    "extraction_backend",
+    "invoice_sheets",
+    "profiles",
+)
+
+# "invoice_sheets" value that selects every sheet of the workbook; an empty value
+# selects the first sheet, anything else is a comma-separated list of sheet names
+ALL_SHEETS = "*"
+
+# Item names are split into text and numeric parts at the first run of digits
+ITEM_NAME_SPLIT_RE = re.compile(r'(\d+)')
+# Digit runs of file names for natural sorting
+NATURAL_SPLIT_RE = re.compile(r'(\d+)')
+# Spaces between digit groups of numbers written as text: "1 250,50"
+NUMBER_SPACING_RE = re.compile(r'\s')
+
+logger = logging.getLogger(__name__)
+
+
+def extraction_settings(config: Dict) -> Dict:
+    """Return only the config values that affect extraction"""
+    return {key: config.get(key, DEFAULT_CONFIG[key]) for key in EXTRACTION_KEYS}
+
+
+def extract_invoice_number_from_filename(filename: str) -> str:
+    # Extract numbers from filename
+    numbers = re.findall(r'\d+', Path(filename).stem)
+    return numbers[0] if numbers else ""
+
+
+def natural_key(text: str) -> Tuple:
+    """Sort key comparing runs of digits as numbers: "счет 9" < "счет 10" """
+    return tuple(
+        (0, int(part)) if part.isdigit() else (1, part.casefold())
+        for part in NATURAL_SPLIT_RE.split(text) if part
+    )
+
+
+def invoice_sort_key(filename: str) -> Tuple:
+    """
+    Processing order of invoice files: by the first number of the file name as a
+    number, then by the natural order of the whole name. Files without a number
+    come first; the path itself breaks the remaining ties, so the order is total.
+    """
+    number = extract_invoice_number_from_filename(filename)
+    return int(number) if number else -1, natural_key(Path(filename).name), filename
+
+
+def excel_cell_to_index(cell_location, log: Optional[Callable[[str], None]] = None):
+    """Convert Excel cell reference to DataFrame indices"""
+    log = log or logger.info
+    try:
+        if 'R' in cell_location and 'C' in cell_location:
+            parts = cell_location.upper().split('C')
+            row_index = int(parts[0].replace('R', '')) - 1
+            col_index = int(parts[1]) - 1
+        else:
+            column_letter = ''.join(filter(str.isalpha, cell_location.upper()))
+            row_number = int(''.join(filter(str.isdigit, cell_location)))
+            col_index = 0
+            for letter in column_letter:
+                col_index = col_index * 26 + (ord(letter) - ord('A') + 1)
+            row_index = row_number - 1
+            col_index -= 1
+        return row_index, col_index
+    except Exception as e:
+        log(f"Ошибка при преобразовании адреса ячейки {cell_location}: {e}")
+        return None, None
+
+
+def get_cell_value(df, cell_location, log: Optional[Callable[[str], None]] = None):
+    """Get value from cell in DataFrame"""
+    log = log or logger.info
+    row_index, col_index = excel_cell_to_index(cell_location, log)
+    return read_cell(df, row_index, col_index, cell_location, log)
+
+
+def read_cell(df, row_index, col_index, cell_location, log: Callable[[str], None]) -> str:
+    """Like get_cell_value, for an address that is already converted to indices"""
+    cell_value = read_raw_cell(df, row_index, col_index, cell_location, log)
+    return "" if cell_value is None else str(cell_value)
+
+
+def read_raw_cell(df, row_index, col_index, cell_location, log: Callable[[str], None]):
+    """The cell value as the reader returned it (datetime, number or text), None when empty"""
+    try:
+        if row_index >= 0 and col_index >= 0:
+            cell_value = df.iloc[row_index, col_index]
+            return None if pd.isna(cell_value) else cell_value
+        return None
+    except (IndexError, ValueError, TypeError) as e:
+        log(f"Ошибка при чтении ячейки {cell_location}: {e}")
+        return None
+
+
+def cell_text(value) -> str:
+    return str(value) if not pd.isna(value) else ""
+
+
+class ExtractionPlan:
+    """
+    Cell settings of the config converted to numeric indices once.
+    Header cells are (address, row_index, col_index), item columns (letter, col_index).
+    """
+
+    def __init__(self, settings: Dict):
+        self.contractor = self.compile_cell(settings['contractor_cell'])
+        self.number = self.compile_cell(settings['number_cell'])
+        self.date = self.compile_cell(settings['date_cell'])
+        self.items_start_cell = settings['items_start_cell']
+        self.items_start_row = excel_cell_to_index(self.items_start_cell)[0]
+        self.item_name = self.compile_column(settings['items_cell_text_part'])
+        self.item_weight = self.compile_column(settings['items_cell_weight'])
+        self.item_price = self.compile_column(settings['items_cell_price'])
+
+    @staticmethod
+    def compile_cell(cell_location: str) -> Tuple[str, Optional[int], Optional[int]]:
+        row_index, col_index = excel_cell_to_index(cell_location)
+        return cell_location, row_index, col_index
+
+    @staticmethod
+    def compile_column(column_letter: str) -> Tuple[str, Optional[int]]:
+        return column_letter, excel_cell_to_index(f"{column_letter}1")[1]
+
+    def header_cells(self) -> List[Tuple[int, int]]:
+        cells = [cell[1:] for cell in (self.contractor, self.number, self.date)]
+        return [(row, col) for row, col in cells if row is not None and col is not None and row >= 0 and col >= 0]
+
+    def item_columns(self) -> List[int]:
+        columns = [column[1] for column in (self.item_name, self.item_weight, self.item_price)]
+        return [col for col in columns if col is not None and col >= 0]
+
+
+@lru_cache(maxsize=64)
+def compile_extraction_plan(settings: Tuple[Tuple[str, object], ...]) -> ExtractionPlan:
+    return ExtractionPlan(dict(settings))
+
+
+def get_extraction_plan(config: Dict) -> ExtractionPlan:
+    """
+    Compiled plan for the config. Plans are cached by the values of the cell settings,
+    so a config changed by the review dialog gets a new plan and stale ones are never used.
+    """
+    return compile_extraction_plan(tuple((key, config.get(key, DEFAULT_CONFIG[key])) for key in LAYOUT_KEYS))
+
+
+def normalize_anchor(value) -> str:
+    """Text compared by profile anchors: the part in quotes if there is one, ignoring case and spacing"""
+    text = "" if value is None else cell_text(value)
+    quotes_match = re.search(r'"([^"]+)"', text)
+    if quotes_match:
+        text = quotes_match.group(1)
+    return " ".join(text.split()).casefold()
+
+
+class ProfileIndex:
+    """
+    Layout profiles of the "profiles" setting compiled for automatic selection.
+
+    A profile is a dict of LAYOUT_KEYS overrides with optional "match" rules:
+    "filename" (a glob pattern or a list of them) and "anchors" (cell -> expected
+    text). It matches an invoice when all of its rules do; a profile without rules
+    is never chosen automatically. Anchor cells are looked up in a dict keyed by
+    (row, col, text), so a sheet costs one lookup per anchor cell however many
+    profiles there are. The match with the most rules wins, then the first in the config.
+    """
+
+    def __init__(self, profiles: Dict):
+        self.filename_patterns: Dict[str, re.Pattern] = {}
+        self.rule_counts: Dict[str, int] = {}
+        self.anchor_counts: Dict[str, int] = {}
+        self.by_anchor: Dict[Tuple[int, int, str], List[str]] = {}
+        self.order = {name: position for position, name in enumerate(profiles)}
+        anchor_cells = set()
+        for name, profile in profiles.items():
+            match = profile.get('match') or {}
+            patterns = match.get('filename') or []
+            if isinstance(patterns, str):
+                patterns = [patterns]
+            if patterns:
+                self.filename_patterns[name] = re.compile(
+                    "|".join(fnmatch.translate(pattern.casefold()) for pattern in patterns)
+                )
+            anchors = 0
+            for cell_location, text in (match.get('anchors') or {}).items():
+                row_index, col_index = excel_cell_to_index(cell_location)
+                expected = normalize_anchor(text)
+                if row_index is None or row_index < 0 or col_index < 0 or not expected:
+                    continue
+                self.by_anchor.setdefault((row_index, col_index, expected), []).append(name)
+                anchor_cells.add((row_index, col_index))
+                anchors += 1
+            self.anchor_counts[name] = anchors
+            self.rule_counts[name] = anchors + (1 if patterns else 0)
+        self.anchor_cells = sorted(anchor_cells)
+
+    def select(self, file_name: str, read_anchor: Callable[[int, int], object]) -> Optional[str]:
+        """Name of the best matching profile, or None; read_anchor(row, col) returns a cell value"""
+        anchor_hits: Dict[str, int] = {}
+        for row_index, col_index in self.anchor_cells:
+            key = (row_index, col_index, normalize_anchor(read_anchor(row_index, col_index)))
+            for name in self.by_anchor.get(key, ()):
+                anchor_hits[name] = anchor_hits.get(name, 0) + 1
+        file_name = file_name.casefold()
+        candidates = set(anchor_hits)
+        candidates.update(name for name, pattern in self.filename_patterns.items() if pattern.match(file_name))
+        matched = [
+            name for name in candidates
+            if anchor_hits.get(name, 0) == self.anchor_counts[name]
+            and (name not in self.filename_patterns or self.filename_patterns[name].match(file_name))
+        ]
+        if not matched:
+            return None
+        return min(matched, key=lambda name: (-self.rule_counts[name], self.order[name]))
+
+
+@lru_cache(maxsize=8)
+def compile_profiles(profiles_json: str) -> ProfileIndex:
+    return ProfileIndex(json.loads(profiles_json))
+
+
+def get_profile_index(config: Dict) -> Optional[ProfileIndex]:
+    """Compiled index of the configured profiles, None when there are none"""
+    profiles = config.get('profiles') or {}
+    if not profiles:
+        return None
+    # Profile order decides ties, so the key keeps it
+    return compile_profiles(json.dumps(profiles, ensure_ascii=False))
+
+
+def profile_config(config: Dict, profile: Optional[str]) -> Dict:
+    """The config with the cell layout of the named profile applied"""
+    layout = (config.get('profiles') or {}).get(profile) if profile else None
+    if not layout:
+        return config
+    return dict(config, **{key: layout[key] for key in LAYOUT_KEYS if layout.get(key)})
+
+
+def update_profile_layout(config: Dict, profile: str, layout_changes: Dict,
+                          contractor_anchor: Optional[Tuple[str, str]] = None) -> Dict:
+    """
+    Copy of the config with corrected cells stored in the named profile, or in the
+    common layout when profile is empty. A new profile is matched by contractor_anchor,
+    the (cell, contractor) the invoice was read with, so the next invoice of the same
+    supplier selects it automatically.
+    """
+    updated_config = dict(config)
+    if not profile:
+        updated_config.update(layout_changes)
+        return updated_config
+    profiles = copy.deepcopy(config.get('profiles') or {})
+    layout = profiles.setdefault(profile, {})
+    if not layout.get('match') and contractor_anchor and contractor_anchor[1]:
+        layout['match'] = {'anchors': {contractor_anchor[0]: contractor_anchor[1]}}
+    layout.update(layout_changes)
+    updated_config['profiles'] = profiles
+    return updated_config
+
+
+def read_item_columns(source, plan: ExtractionPlan, log: Callable[[str], None]) -> Tuple[List, List, List]:
+    """
+    Raw name, weight and price values of the item block: from items_start_cell down to
+    the first empty name. DataFrame columns are taken as whole slices.
+    """
+    start_row = plan.items_start_row
+    name_col = plan.item_name[1]
+    if start_row is None or start_row < 0 or name_col is None or name_col < 0:
+        return [], [], []
+
+    if isinstance(source, InvoiceCells):
+        return source.item_columns(start_row, name_col, plan.item_weight[1], plan.item_price[1])
+
+    row_count, col_count = source.shape
+    if name_col >= col_count or start_row >= row_count:
+        return [], [], []
+    names = source.iloc[start_row:, name_col]
+    empty = (names.isna() | (names == '')).to_numpy()
+    block_size = int(empty.argmax()) if empty.any() else len(names)
+    stop_row = start_row + block_size
+
+    def column_slice(column):
+        letter, col_index = column
+        if col_index is None or col_index < 0 or col_index >= col_count:
+            if block_size:
+                log(f"Ошибка при чтении столбца {letter}: столбец вне таблицы")
+            return [""] * block_size
+        return source.iloc[start_row:stop_row, col_index].tolist()
+
+    return names.iloc[:block_size].tolist(), column_slice(plan.item_weight), column_slice(plan.item_price)
+
+
+def split_item_names(names: List[str]) -> Tuple[List[str], List[str]]:
+    """
+    Split the whole name column at the first run of digits of each name:
+    "Болт М12 x 40" -> ("Болт М", "12x 40"). Same result as re.split(r'(\\d+)', name, 1)
+    with the text part stripped and the digits joined to the stripped remainder.
+    """
+    split = ITEM_NAME_SPLIT_RE.split
+    parts = [split(name, 1) for name in names]
+    text_parts = [part[0].strip() for part in parts]
+    numeric_parts = [part[1].strip() + part[2].strip() if len(part) > 1 else "" for part in parts]
+    return text_parts, numeric_parts
+
+
+def column_text(values: List) -> List[str]:
+    """cell_text for a whole column, with the missing-value check done as one array operation"""
+    missing = pd.isna(np.asarray(values, dtype=object))
+    return ["" if is_missing else str(value) for value, is_missing in zip(values, missing)]
+
+
+def item_number(value):
+    """
+    Weight or price of an item: a float when the cell holds a number, also written
+    as text with a decimal comma or spaces between digit groups, otherwise the cell
+    text, so that validation can report it. Empty cells become "".
+    """
+    if value is None or (not isinstance(value, str) and pd.isna(value)):
+        return ""
+    if isinstance(value, numbers.Real) and not isinstance(value, (bool, np.bool_)):
+        return float(value) if math.isfinite(value) else str(value)
+    text = str(value)
+    try:
+        number = float(NUMBER_SPACING_RE.sub('', text).replace(',', '.'))
+    except ValueError:
+        return text
+    return number if math.isfinite(number) else text
+
+
+# Item fields in report order
+ITEM_FIELDS = ('text_part', 'numeric_part', 'weight', 'price')
+
+
+class InvoiceItem:
+    """One invoice item: the two parts of its name, weight and price (see item_number)"""
+    __slots__ = ITEM_FIELDS
+
+    def __init__(self, text_part: str, numeric_part: str, weight, price):
+        self.text_part = text_part
+        self.numeric_part = numeric_part
+        self.weight = weight
+        self.price = price
+
+    def __repr__(self):
+        return f"InvoiceItem({self.text_part!r}, {self.numeric_part!r}, {self.weight!r}, {self.price!r})"
+
+
+class InvoiceItems:
+    """
+    Items of one invoice kept as columns, one list per field, instead of a dict per
+    item. Where a value came from is kept once per field: item i was read from row
+    first_row + i of the column letter in columns[field].
+    """
+    __slots__ = ('text_parts', 'numeric_parts', 'weights', 'prices', 'first_row', 'columns')
+
+    def __init__(self, text_parts: List[str], numeric_parts: List[str], weights: List, prices: List,
+                 first_row: int = 1, columns: Optional[Dict[str, str]] = None):
+        self.text_parts = text_parts
+        self.numeric_parts = numeric_parts
+        self.weights = weights
+        self.prices = prices
+        self.first_row = first_row
+        self.columns = columns or {}
+
+    def __len__(self) -> int:
+        return len(self.text_parts)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self.item(position) for position in range(*index.indices(len(self)))]
+        return self.item(index)
+
+    def __iter__(self) -> Iterator[InvoiceItem]:
+        return map(InvoiceItem, self.text_parts, self.numeric_parts, self.weights, self.prices)
+
+    def item(self, index: int) -> InvoiceItem:
+        return InvoiceItem(self.text_parts[index], self.numeric_parts[index], self.weights[index], self.prices[index])
+
+    def column(self, field: str) -> List:
+        return getattr(self, f"{field}s")
+
+    def cell(self, field: str, index: int) -> str:
+        """Address of the cell the field of item index was read from"""
+        return f"{self.columns.get(field, '')}{self.first_row + index}"
+
+    def numeric_mask(self, field: str) -> np.ndarray:
+        """True for items whose weight or price is a number"""
+        column = self.column(field)
+        return np.fromiter((isinstance(value, float) for value in column), dtype=bool, count=len(column))
+
+    def with_columns(self, columns: Dict[str, str]) -> "InvoiceItems":
+        """The same items attributed to other column letters"""
+        return InvoiceItems(self.text_parts, self.numeric_parts, self.weights, self.prices,
+                            self.first_row, dict(self.columns, **columns))
+
+
+def log_level(config: Dict) -> int:
+    """Numeric logging level of the "log_level" setting (a name such as "DEBUG"), INFO when unknown"""
+    level = logging.getLevelName(str(config.get('log_level', DEFAULT_CONFIG['log_level'])).upper())
+    return level if isinstance(level, int) else logging.INFO
+
+
+def extract_invoice_data(invoice_df, config: Dict, log: Optional[Callable[[str], None]] = None, profile: str = ""):
+    log = log or logger.info
+    # One line per item is only worth formatting when the log shows DEBUG messages
+    log_items = log_level(config) <= logging.DEBUG
+    extracted_data = {
+        'contractor': {'value': "", 'cell': ""},
+        'number': {'value': "", 'cell': ""},
+        'date': {'value': None, 'cell': ""},
+        'items': InvoiceItems([], [], [], []),
+        'profile': profile
+    }
+
+    plan = get_extraction_plan(config)
+
+    # Extract contractor name
+    contractor_cell_location, row_index, col_index = plan.contractor
+    contractor_name_cell = read_cell(invoice_df, row_index, col_index, contractor_cell_location, log)
+    if contractor_name_cell:
+        # Extract text between quotes if present
+        quotes_match = re.search(r'"([^"]+)"', str(contractor_name_cell))
+        if quotes_match:
+            extracted_data['contractor']['value'] = quotes_match.group(1).strip()
+        else:
+            extracted_data['contractor']['value'] = str(contractor_name_cell).strip()
+        extracted_data['contractor']['cell'] = contractor_cell_location
+    log(f"Извлечен контрагент: {extracted_data['contractor']['value']} (ячейка: {contractor_cell_location})")
+
+    # Extract invoice number
+    invoice_number_cell_location, row_index, col_index = plan.number
+    invoice_number_cell = read_cell(invoice_df, row_index, col_index, invoice_number_cell_location, log)
+    if invoice_number_cell:
+        extracted_data['number']['value'] = str(invoice_number_cell).strip()
+        extracted_data['number']['cell'] = invoice_number_cell_location
+    log(f"Извлечен номер счета-фактуры: {extracted_data['number']['value']} (ячейка: {invoice_number_cell_location})")
+
+    # Extract date
+    invoice_date_cell_location, row_index, col_index = plan.date
+    # Date cells and serial numbers are parsed as they are, text with the format that worked for the profile before
+    invoice_date_cell = read_raw_cell(invoice_df, row_index, col_index, invoice_date_cell_location, log)
+    if invoice_date_cell is not None and str(invoice_date_cell).strip():
+        invoice_date = invoice_dates.parse_date(invoice_date_cell, profile)
+        if invoice_date is not None:
+            extracted_data['date']['value'] = invoice_date
+        else:
+            extracted_data['date']['value'] = str(invoice_date_cell).strip()
+            log(f"Предупреждение: Формат даты не распознан в ячейке {invoice_date_cell_location}. Данные сохранены как текст.")
+    extracted_data['date']['cell'] = invoice_date_cell_location
+    log(f"Извлечена дата счета-фактуры: {extracted_data['date']['value']} (ячейка: {invoice_date_cell_location})")
+
+    # Extract items
+    names, weights, prices = read_item_columns(invoice_df, plan, log)
+    name_letter = plan.item_name[0]
+    first_row = (plan.items_start_row or 0) + 1
+    names = column_text(names)
+    text_parts, numeric_parts = split_item_names(names)
+    if log_items:
+        for offset, item_name_full in enumerate(names):
+            log(f"Чтение позиции из ячейки {name_letter}{first_row + offset}: Значение = '{item_name_full}'")
+    items = InvoiceItems(
+        text_parts, numeric_parts, [item_number(value) for value in weights], [item_number(value) for value in prices],
+        first_row,
+        {'text_part': name_letter, 'numeric_part': name_letter, 'weight': plan.item_weight[0], 'price': plan.item_price[0]}
+    )
+
+    log(f"Извлечено позиций: {len(items)}")
+    extracted_data['items'] = items
+    return extracted_data
+
+
+def item_positions(mask: np.ndarray, limit: int = 5) -> str:
+    """Item numbers (1-based) where mask is False, the first few of them"""
+    positions = (np.flatnonzero(~mask) + 1).tolist()
+    listed = ", ".join(str(position) for position in positions[:limit])
+    return listed + (f" и еще {len(positions) - limit}" if len(positions) > limit else "")
+
+
+def validate_invoice(extracted_data: Dict, config: Dict) -> List[str]:
+    """
+    Problems that make an extracted invoice worth a manual review: missing contractor
+    or number, a date none of the formats recognised, no items or suspiciously many,
+    non-numeric weights or prices. An empty list means the invoice can be written as is.
+    """
+    problems = []
+    if not str(extracted_data['contractor']['value']).strip():
+        problems.append("не найден контрагент")
+    if not str(extracted_data['number']['value']).strip():
+        problems.append("не найден номер")
+    invoice_date = extracted_data['date']['value']
+    if not isinstance(invoice_date, date):
+        problems.append(f"дата не распознана: {invoice_date}" if invoice_date else "не найдена дата")
+
+    items = extracted_data['items']
+    max_items = int(config.get('review_max_items', DEFAULT_CONFIG['review_max_items']))
+    if not items:
+        problems.append("нет позиций")
+    elif max_items and len(items) > max_items:
+        problems.append(f"позиций больше {max_items}: {len(items)}")
+    for key, title in (('weight', "вес"), ('price', "цена")):
+        mask = items.numeric_mask(key)
+        if not mask.all():
+            problems.append(f"{title} не число в позициях {item_positions(mask)}")
+    return problems
+
+
+def format_invoice_date(value) -> str:
+    """Invoice date as it is written to the report (columns 2 and 11)"""
+    return value.strftime('%d.%m.%Y') if isinstance(value, datetime) else str(value)
+
+
+def invoice_key(extracted_data) -> Tuple[str, str, str]:
+    """(number, contractor, date) identifying an invoice in the report"""
+    return (
+        str(extracted_data['number']['value']),
+        str(extracted_data['contractor']['value']),
+        format_invoice_date(extracted_data['date']['value']),
+    )
+
+
+def file_digest(file_path: str) -> str:
+    """SHA-256 of the file content"""
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def build_invoice_rows(extracted_data) -> pd.DataFrame:
+    """
+    Create DataFrame with report rows for one invoice, built column by column from the items.
+    Invoice fields go to the first row only; numeric weights and prices stay numbers.
+    """
+    items = extracted_data['items']
+    count = len(items)
+    if not count:
+        return pd.DataFrame()
+    invoice_date = format_invoice_date(extracted_data['date']['value'])
+    blank = [''] * count
+
+    def first_row(value):
+        return [value] + blank[1:]
+
+    return pd.DataFrame({
+        0: first_row(extracted_data['number']['value']),
+        1: first_row(extracted_data['contractor']['value']),
+        2: first_row(invoice_date),
+        3: first_row('Э'),
+        4: items.text_parts,
+        5: blank,
+        6: items.numeric_parts,
+        7: items.weights,
+        8: items.prices,
+        9: blank,
+        10: blank,
+        11: first_row(f"{extracted_data['number']['value']} от {invoice_date}"),
+    })
+
+
+def load_config(config_path: str = CONFIG_FILE, log: Optional[Callable[[str], None]] = None) -> Dict:
+    log = log or logger.info
+    try:
+        with open(config_path, 'r') as f:
+            config = json.load(f)
+            log(f"Конфигурация загружена из файла: {config_path}")
+            return config
+    except FileNotFoundError:
+        log(f"Файл конфигурации не найден: {config_path}. Используется конфигурация по умолчанию. Файл будет создан при сохранении.")
+        return DEFAULT_CONFIG.copy()
+    except json.JSONDecodeError:
+        log(f"Файл конфигурации поврежден: {config_path}. Конфигурация сброшена к значениям по умолчанию.")
+        return DEFAULT_CONFIG.copy()
+    except Exception as e:
+        log(f"Непредвиденная ошибка при загрузке конфигурации: {str(e)}. Используется конфигурация по умолчанию.")
+        return DEFAULT_CONFIG.copy()
+
+
+class InvoiceCells:
+    """
+    Sparse invoice cells read by read_invoice_cells. Indexed like DataFrame.iloc
+    with (row_index, col_index), so extract_invoice_data works on it unchanged.
+    """
+
+    def __init__(self, values: Dict[Tuple[int, int], object]):
+        self.values = values
+
+    @property
+    def iloc(self):
+        return self
+
+    def __getitem__(self, key: Tuple[int, int]):
+        return self.values.get(key)
+
+    def item_columns(self, start_row: int, name_col: int, weight_col: Optional[int],
+                     price_col: Optional[int]) -> Tuple[List, List, List]:
+        names, weights, prices = [], [], []
+        row_index = start_row
+        while True:
+            name = self.values.get((row_index, name_col))
+            if name is None or name == '' or pd.isna(name):
+                return names, weights, prices
+            names.append(name)
+            weights.append(self.values.get((row_index, weight_col)))
+            prices.append(self.values.get((row_index, price_col)))
+            row_index += 1
+
+
+def convert_cell_value(value):
+    """Convert a cell value the way pandas does when reading xlsx: whole floats become int"""
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    return value
+
+
+def is_numeric_cell_value(value) -> bool:
+    if isinstance(value, bool):
+        return False
+    if isinstance(value, (int, float)):
+        return True
+    if isinstance(value, str):
+        try:
+            float(value)
+            return True
+        except ValueError:
+            return False
+    return False
+
+
+def infer_column_types(values: Dict[Tuple[int, int], object], text_columns: set):
+    """
+    Repeat the column type inference of pd.read_excel: a column without any
+    non-numeric text holds floats, so its numbers (and numeric text) become float.
+    """
+    for key, value in values.items():
+        if key[1] not in text_columns and value is not None and value != '' and is_numeric_cell_value(value):
+            values[key] = float(value)
+
+
+def read_invoice_cells(invoice_file: str, config: Dict) -> InvoiceCells:
+    """
+    Read only the configured cells of the first sheet in read-only (streaming) mode.
+    Header cells are taken from their rows, item cells from items_start_cell down to
+    the first row with an empty item name, and reading stops there.
+
+    pandas infers column types from the whole column, here only from the rows down to
+    the end of the item block. The result is the same unless the only text in a column
+    is below the item block (pandas gives "3" there, this reader "3.0").
+    """
+    book = openpyxl.load_workbook(invoice_file, read_only=True, data_only=True, keep_links=False)
+    try:
+        return read_sheet_cells(book.worksheets[0], get_extraction_plan(config))
+    finally:
+        book.close()
+
+
+def read_sheet_cells(sheet, plan: ExtractionPlan) -> InvoiceCells:
+    """The cells of plan from one read-only worksheet, see read_invoice_cells"""
+    header_cells = plan.header_cells()
+    item_cols = plan.item_columns()
+    items_start_row, name_col = plan.items_start_row, plan.item_name[1]
+    if items_start_row is None or name_col is None or name_col < 0:
+        items_start_row = None
+
+    max_col = max([col for _, col in header_cells] + item_cols + [0]) + 1
+    last_header_row = max([row for row, _ in header_cells] + [-1])
+
+    needed_cols = set(col for _, col in header_cells) | set(item_cols)
+    values = {}
+    text_columns = set()
+    # Dimensions written by some programs are wrong, so do not trust them (as pandas does)
+    sheet.reset_dimensions()
+    items_done = items_start_row is None
+    for row_index, row in enumerate(sheet.iter_rows(min_row=1, max_col=max_col, values_only=True)):
+        for col in needed_cols:
+            if col < len(row) and isinstance(row[col], str) and row[col] and not is_numeric_cell_value(row[col]):
+                text_columns.add(col)
+        for header_row, header_col in header_cells:
+            if header_row == row_index and header_col < len(row):
+                values[(header_row, header_col)] = convert_cell_value(row[header_col])
+        if not items_done and row_index >= items_start_row:
+            name = row[name_col] if name_col < len(row) else None
+            if name is None or name == '':
+                items_done = True
+            else:
+                for col in item_cols:
+                    if col < len(row):
+                        values[(row_index, col)] = convert_cell_value(row[col])
+        if items_done and row_index >= last_header_row:
+            break
+    infer_column_types(values, text_columns)
+    return InvoiceCells(values)
+
+
+def select_sheets(sheet_names: List[str], config: Dict, log: Callable[[str], None]) -> List[str]:
+    """Sheets of the workbook chosen by "invoice_sheets", in workbook order"""
+    selection = str(config.get('invoice_sheets', DEFAULT_CONFIG['invoice_sheets']) or "").strip()
+    if not selection:
+        return sheet_names[:1]
+    if selection == ALL_SHEETS:
+        return list(sheet_names)
+    wanted = [name.strip() for name in selection.split(",") if name.strip()]
+    missing = [name for name in wanted if name not in sheet_names]
+    if missing:
+        log(f"В книге нет листов: {', '.join(missing)}")
+    selected = [name for name in sheet_names if name in wanted]
+    if not selected:
+        raise ValueError(f"В книге нет ни одного из листов: {selection}")
+    return selected
+
+
+def read_invoice_sheets(invoice_file: str, config: Dict,
+                        log: Optional[Callable[[str], None]] = None) -> List[Tuple[str, object, Optional[str]]]:
+    """
+    Open the workbook once and read every sheet selected by "invoice_sheets" with the
+    configured backend and the layout profile chosen for it (see ProfileIndex).
+    Returns (sheet_name, sheet_data, profile) in workbook order; profile is None
+    when no profile matched and the common layout is used.
+    """
+    log = log or logger.info
+    profiles = get_profile_index(config)
+    file_name = Path(invoice_file).name
+    if config.get('extraction_backend', DEFAULT_CONFIG['extraction_backend']) == 'openpyxl':
+        book = openpyxl.load_workbook(invoice_file, read_only=True, data_only=True, keep_links=False)
+        try:
+            sheets = []
+            for name in select_sheets(book.sheetnames, config, log):
+                sheet = book[name]
+                profile = None
+                if profiles is not None:
+                    anchors = read_anchor_cells(sheet, profiles.anchor_cells)
+                    profile = profiles.select(file_name, lambda row, col: anchors.get((row, col)))
+                sheets.append((name, read_sheet_cells(sheet, get_extraction_plan(profile_config(config, profile))), profile))
+            return sheets
+        finally:
+            book.close()
+
+    with pd.ExcelFile(invoice_file) as book:
+        sheets = []
+        for name in select_sheets(book.sheet_names, config, log):
+            sheet_df = book.parse(name, header=None)
+            profile = None
+            if profiles is not None:
+                profile = profiles.select(file_name, lambda row, col: (
+                    sheet_df.iat[row, col] if row < sheet_df.shape[0] and col < sheet_df.shape[1] else None
+                ))
+            sheets.append((name, sheet_df, profile))
+        return sheets
+
+
+def read_anchor_cells(sheet, anchor_cells: List[Tuple[int, int]]) -> Dict[Tuple[int, int], object]:
+    """Values of the anchor cells of a read-only worksheet, reading only the rows down to the last one"""
+    if not anchor_cells:
+        return {}
+    wanted = set(anchor_cells)
+    last_row = max(row for row, _ in anchor_cells)
+    max_col = max(col for _, col in anchor_cells) + 1
+    values = {}
+    sheet.reset_dimensions()
+    for row_index, row in enumerate(sheet.iter_rows(min_row=1, max_row=last_row + 1, max_col=max_col, values_only=True)):
+        for col_index, value in enumerate(row):
+            if (row_index, col_index) in wanted:
+                values[(row_index, col_index)] = value
+    return values
+
+
+def is_invoice_sheet(extracted_data: Dict) -> bool:
+    """False for a sheet with neither an invoice number nor items, such as a cover or summary sheet"""
+    return bool(extracted_data['number']['value'] or extracted_data['items'])
+
+
+def invoice_label(invoice_file: str, sheet: Optional[str] = None) -> str:
+    """File name for log messages, with the sheet for invoices taken from a multi-invoice workbook"""
+    name = Path(invoice_file).name
+    return f"{name} [{sheet}]" if sheet else name
+
+
+def read_invoice(invoice_file: str, config: Dict):
+    """Read an invoice with the configured backend: a full DataFrame or only the needed cells"""
+    if config.get('extraction_backend', DEFAULT_CONFIG['extraction_backend']) == 'openpyxl':
+        return read_invoice_cells(invoice_file, config)
+    return pd.read_excel(invoice_file, header=None)
+
+
+def parse_invoice_file(invoice_file: str, config: Dict) -> Tuple[Dict, List[str]]:
+    """
+    Read and extract one invoice. Runs in a worker process, so log messages are
+    collected and returned together with the extracted data.
+    """
+    extracted_data, messages, _ = parse_invoice_file_timed(invoice_file, config)
+    return extracted_data, messages
+
+
+def parse_invoice_file_timed(invoice_file: str, config: Dict) -> Tuple[Dict, List[str], Dict[str, float]]:
+    """parse_invoice_file that also returns the seconds spent in the "read" and "extract" stages"""
+    messages: List[str] = []
+    started = time.perf_counter()
+    invoice_df = read_invoice(invoice_file, config)
+    read_done = time.perf_counter()
+    extracted_data = extract_invoice_data(invoice_df, config, messages.append)
+    return extracted_data, messages, {"read": read_done - started, "extract": time.perf_counter() - read_done}
+
+
+def parse_workbook_timed(invoice_file: str,
+                         config: Dict) -> Tuple[List[Tuple[Optional[str], Dict]], List[str], Dict[str, float]]:
+    """
+    Read the workbook once and extract one invoice block per sheet selected by
+    "invoice_sheets", each with the layout profile chosen for it. Returns
+    ([(sheet, extracted_data), ...], log_messages, stage_seconds); sheet is None when
+    only the first sheet is read. Sheets without an invoice are left out.
+    extracted_data["profile"] is the name of the profile used, "" for the common layout.
+    """
+    messages: List[str] = []
+    started = time.perf_counter()
+    multiple_sheets = bool(config.get('invoice_sheets', DEFAULT_CONFIG['invoice_sheets']))
+    sheets = read_invoice_sheets(invoice_file, config, messages.append)
+    read_done = time.perf_counter()
+    blocks = []
+    for sheet, sheet_data, profile in sheets:
+        label = invoice_label(invoice_file, sheet if multiple_sheets else None)
+        if multiple_sheets:
+            messages.append(f"Лист {sheet}:")
+        if profile:
+            messages.append(f"Профиль разметки «{profile}»: {label}")
+        elif config.get('profiles'):
+            messages.append(f"Профиль разметки не найден, используется общая разметка: {label}")
+        extracted_data = extract_invoice_data(sheet_data, profile_config(config, profile), messages.append, profile or "")
+        if not multiple_sheets:
+            blocks.append((None, extracted_data))
+        elif is_invoice_sheet(extracted_data):
+            blocks.append((sheet, extracted_data))
+        else:
+            messages.append(f"На листе нет счета-фактуры, пропущен: {label}")
+    return blocks, messages, {"read": read_done - started, "extract": time.perf_counter() - read_done}
+
+
+def error_text(error: Exception) -> str:
+    """Message of an exception, its type for exceptions without one"""
+    return str(error) or type(error).__name__
+
+
+def resolve_parse_workers(config: Dict, file_count: int) -> int:
+    """Number of worker processes: 0 in the config means one per CPU"""
+    workers = int(config.get('parse_workers', DEFAULT_CONFIG['parse_workers']) or 0)
+    if workers <= 0:
+        workers = os.cpu_count() or 1
+    return max(1, min(workers, file_count))
+
+
+def parse_invoices(invoice_files: List[str], config: Dict, workers: Optional[int] = None,
+                   cache=None, digests: Optional[Dict[str, str]] = None, metrics=None,
+                   failures: Optional[Dict[str, str]] = None
+                   ) -> Iterator[Tuple[str, List[Tuple[Optional[str], Dict]], List[str]]]:
+    """
+    Parse invoices in a pool of worker processes and yield
+    (invoice_file, blocks, log_messages) in the order of invoice_files, where blocks
+    holds one (sheet, extracted_data) pair per invoice of the workbook (see parse_workbook_timed).
+    Results are yielded as soon as the next one in order is ready, so the caller
+    can review or save early invoices while later ones are still being parsed.
+    With an InvoiceCache, unchanged invoices are served from it and never parsed;
+    digests (file -> SHA-256) already computed by the caller save hashing the files again.
+    Stage times of every invoice are recorded in metrics (an invoice_metrics.BatchMetrics).
+    With a failures dict, a file that cannot be read does not stop the run: its
+    error goes to failures[invoice_file] and it is yielded without blocks.
+    """
+    settings = extraction_settings(config)
+
+    cache_keys = {}
+    cached = {}
+    cache_seconds = {}
+    if cache is not None:
+        for invoice_file in invoice_files:
+            started = time.perf_counter()
+            try:
+                key = cache.key(invoice_file, settings, (digests or {}).get(invoice_file))
+            except OSError:
+                # Unreadable files are left to the parser, which reports the error in order
+                continue
+            blocks = cache.load(key)
+            if blocks is None:
+                cache_keys[invoice_file] = key
+            else:
+                cached[invoice_file] = blocks
+            cache_seconds[invoice_file] = time.perf_counter() - started
+
+    files_to_parse = [invoice_file for invoice_file in invoice_files if invoice_file not in cached]
+    if workers is None:
+        workers = resolve_parse_workers(config, len(files_to_parse))
+    # The log level only decides which messages workers produce, so it is kept out of the cache key
+    worker_settings = dict(settings, log_level=config.get('log_level', DEFAULT_CONFIG['log_level']))
+    parsed = parse_in_pool(files_to_parse, worker_settings, workers, failures)
+    try:
+        for invoice_file in invoice_files:
+            stage_seconds = {"cache": cache_seconds[invoice_file]} if invoice_file in cache_seconds else {}
+            if invoice_file in cached:
+                if metrics is not None:
+                    metrics.record_invoice(invoice_file, stage_seconds)
+                yield invoice_file, cached[invoice_file], [f"Данные взяты из кэша: {Path(invoice_file).name}"]
+                continue
+            _, blocks, messages, parse_seconds = next(parsed)
+            if failures is not None and invoice_file in failures:
+                if metrics is not None:
+                    metrics.record_invoice(invoice_file, stage_seconds)
+                yield invoice_file, [], [f"Ошибка чтения файла {Path(invoice_file).name}: {failures[invoice_file]}"]
+                continue
+            if invoice_file in cache_keys:
+                started = time.perf_counter()
+                cache.store(cache_keys[invoice_file], blocks)
+                stage_seconds["cache"] = stage_seconds.get("cache", 0.0) + time.perf_counter() - started
+            if metrics is not None:
+                metrics.record_invoice(invoice_file, {**stage_seconds, **parse_seconds})
+            yield invoice_file, blocks, messages
+    finally:
+        parsed.close()
+        if cache is not None:
+            cache.evict()
+
+
+def parse_in_pool(invoice_files: List[str], settings: Dict, workers: int,
+                  failures: Optional[Dict[str, str]] = None
+                  ) -> Iterator[Tuple[str, List[Tuple[Optional[str], Dict]], List[str], Dict[str, float]]]:
+    """
+    Parse invoices in worker processes (or in process for a single worker) and yield
+    (invoice_file, blocks, log_messages, stage_seconds) in order. Each workbook is
+    opened once by one worker, which extracts all of its sheets. With a failures
+    dict, the error of a file that cannot be parsed is stored there instead of raised.
+    """
+    if workers <= 1 or len(invoice_files) <= 1:
+        for invoice_file in invoice_files:
+            try:
+                result = parse_workbook_timed(invoice_file, settings)
+            except Exception as e:
+                if failures is None:
+                    raise
+                failures[invoice_file] = error_text(e)
+                result = [], [], {}
+            yield (invoice_file, *result)
+        return
+
+    with ProcessPoolExecutor(max_workers=min(workers, len(invoice_files))) as executor:
+        futures = [executor.submit(parse_workbook_timed, invoice_file, settings) for invoice_file in invoice_files]
+        try:
+            for invoice_file, future in zip(invoice_files, futures):
+                try:
+                    result = future.result()
+                except BrokenProcessPool:
+                    # A worker that died takes the whole pool down, that is not a problem of one file
+                    raise
+                except Exception as e:
+                    if failures is None:
+                        raise
+                    failures[invoice_file] = error_text(e)
+                    result = [], [], {}
+                yield (invoice_file, *result)
+        finally:
+            for future in futures:
+                future.cancel()
@@ -0,0 +1,152 @@
+"""Invoice date normalization independent of the process locale.
+
+Dates come as datetime cells, Excel serial numbers or text in several formats:
+"15.03.2024", "2024-03-15", "15 марта 2024 г.", "«15» марта 2024 года". Text is
+matched against a fixed list of formats with a built-in table of Russian (and
+English) month names, so the result does not depend on the locale the way
+strptime("%B") does. DateParser remembers the format that last succeeded for
+each layout profile and tries it first.
+"""
+import re
+from datetime import date, datetime, timedelta
+from numbers import Real
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+# Month names in the genitive ("15 марта") and nominative ("март 2024") case,
+# their usual abbreviations, and English names for dates strptime("%B") used to read
+RUSSIAN_MONTHS = {
+    "января": 1, "январь": 1, "янв": 1,
+    "февраля": 2, "февраль": 2, "фев": 2, "февр": 2,
+    "марта": 3, "март": 3, "мар": 3,
+    "апреля": 4, "апрель": 4, "апр": 4,
+    "мая": 5, "май": 5,
+    "июня": 6, "июнь": 6, "июн": 6,
+    "июля": 7, "июль": 7, "июл": 7,
+    "августа": 8, "август": 8, "авг": 8,
+    "сентября": 9, "сентябрь": 9, "сен": 9, "сент": 9,
+    "октября": 10, "октябрь": 10, "окт": 10,
+    "ноября": 11, "ноябрь": 11, "ноя": 11, "нояб": 11,
+    "декабря": 12, "декабрь": 12, "дек": 12,
+}
+ENGLISH_MONTHS = {
+    name: number for number, names in enumerate((
+        ("january", "jan"), ("february", "feb"), ("march", "mar"), ("april", "apr"), ("may",),
+        ("june", "jun"), ("july", "jul"), ("august", "aug"), ("september", "sep", "sept"),
+        ("october", "oct"), ("november", "nov"), ("december", "dec"),
+    ), start=1) for name in names
+}
+MONTHS = {**ENGLISH_MONTHS, **RUSSIAN_MONTHS}
+
+# Day 0 of Excel serial dates (the 1900 leap year bug is absorbed by starting on Dec 30)
+EXCEL_EPOCH = date(1899, 12, 30)
+# Serial numbers accepted as dates: 1950-01-01 .. 2099-12-31; other numbers are not dates
+EXCEL_SERIAL_RANGE = (18264, 73415)
+
+# Quotes around the day and the trailing "г." / "года" of Russian dates
+DECORATION_RE = re.compile(r'[«»"\']|\s*(?:г\.?|года?)\s*$', re.IGNORECASE)
+
+SERIAL_TEXT_RE = re.compile(r'\d{5}(?:\.\d+)?')
+
+DateFormat = Tuple[str, re.Pattern, Callable[[re.Match], date]]
+
+
+def two_digit_year(year: str) -> int:
+    return int(year) + 2000 if len(year) == 2 else int(year)
+
+
+def month_number(name: str) -> int:
+    return MONTHS[name.lower().rstrip(".")]
+
+
+# Tried in this order unless the profile has a preferred format
+DATE_FORMATS: List[DateFormat] = [
+    ("dd.mm.yyyy", re.compile(r'(\d{1,2})[./-](\d{1,2})[./-](\d{4}|\d{2})'),
+     lambda m: date(two_digit_year(m.group(3)), int(m.group(2)), int(m.group(1)))),
+    ("yyyy-mm-dd", re.compile(r'(\d{4})-(\d{1,2})-(\d{1,2})(?:[ T]\d{1,2}:\d{2}(?::\d{2}(?:\.\d+)?)?)?'),
+     lambda m: date(int(m.group(1)), int(m.group(2)), int(m.group(3)))),
+    ("dd month yyyy", re.compile(r'(\d{1,2})\s*([^\W\d_]+\.?)\s*(\d{4})'),
+     lambda m: date(int(m.group(3)), month_number(m.group(2)), int(m.group(1)))),
+]
+
+# DATE_FORMATS with each format moved to the front
+FORMATS_PREFERRING = {
+    name: sorted(DATE_FORMATS, key=lambda date_format: date_format[0] != name) for name, _, _ in DATE_FORMATS
+}
+
+
+def excel_serial_date(value) -> Optional[date]:
+    """Date of an Excel serial number, None for numbers outside the plausible range"""
+    if not EXCEL_SERIAL_RANGE[0] <= value <= EXCEL_SERIAL_RANGE[1]:
+        return None
+    return EXCEL_EPOCH + timedelta(days=int(value))
+
+
+class DateParser:
+    def __init__(self):
+        # profile -> name of the format that last parsed one of its dates
+        self.preferred: Dict[str, str] = {}
+
+    def parse(self, value, profile: str = "") -> Optional[date]:
+        """The date of a cell value, or None when it is empty or not a date"""
+        if value is None:
+            return None
+        # pandas Timestamp is a datetime; NaT is one too, but has no valid date
+        if isinstance(value, datetime):
+            return None if value != value else value.date()
+        if isinstance(value, date):
+            return value
+        if isinstance(value, Real) and not isinstance(value, bool):
+            if value != value:
+                return None
+            return excel_serial_date(value)
+        return self.parse_text(str(value), profile)
+
+    def parse_text(self, text: str, profile: str = "") -> Optional[date]:
+        text = DECORATION_RE.sub("", text.strip()).strip()
+        if not text:
+            return None
+        # A serial number that went through str() somewhere on the way
+        if SERIAL_TEXT_RE.fullmatch(text):
+            return excel_serial_date(float(text))
+        formats = FORMATS_PREFERRING.get(self.preferred.get(profile), DATE_FORMATS)
+        for name, pattern, build in formats:
+            match = pattern.fullmatch(text)
+            if match is None:
+                continue
+            try:
+                parsed = build(match)
+            except (KeyError, ValueError):
+                # Unknown month name or an impossible day such as 31.02
+                continue
+            self.preferred[profile] = name
+            return parsed
+        return None
+
+
+# One parser per process: worker processes learn the formats of the profiles they parse
+default_parser = DateParser()
+
+
+def parse_date(value, profile: str = "") -> Optional[date]:
+    return default_parser.parse(value, profile)
+
+
+def normalize_date_column(values: Iterable) -> List[Optional[date]]:
+    """
+    Dates of a whole column (such as column 2 of the report) for sorting and
+    aggregation. Each distinct value is parsed once, so a column of a few
+    thousand invoices repeated over many item rows costs a dict lookup per row.
+    """
+    parser = DateParser()
+    parsed: Dict[object, Optional[date]] = {}
+    result = []
+    for value in values:
+        try:
+            result.append(parsed[value])
+        except KeyError:
+            parsed[value] = parser.parse(value)
+            result.append(parsed[value])
+        except TypeError:
+            # Unhashable cell values are parsed every time
+            result.append(parser.parse(value))
+    return result
@@ -0,0 +1,305 @@
+"""Ledger of invoices already written to a report.
+
+The ledger is a SQLite file next to the report ("<report>.ledger.sqlite"). It
+records every invoice appended to the report by (number, contractor, date) and
+by the SHA-256 of its file. Files seen before are skipped without being parsed,
+and an invoice that reaches the report from a different file is skipped by its
+key, so the same invoice is never appended twice.
+
+Invoices are committed in blocks (PendingBatch). Before a block is saved its
+entries go to a write-ahead journal ("<report>.journal.json"); after the save
+they move to the ledger. If the process dies in between, the next run checks
+the report for the journaled invoices, so an interrupted batch resumes after
+the last saved block instead of starting over or appending it twice. With the
+report store (invoice_store) the rows go to the store before the report, and
+the store, not the report, tells which journaled invoices were saved.
+"""
+import json
+import logging
+import sqlite3
+from contextlib import nullcontext
+from datetime import datetime
+from pathlib import Path
+from typing import Callable, Iterable, Iterator, List, Optional, Tuple
+
+import openpyxl
+import pandas as pd
+
+import invoice_core
+import invoice_report
+
+LEDGER_SUFFIX = ".ledger.sqlite"
+JOURNAL_SUFFIX = ".journal.json"
+
+# Column 11 of the report holds "<number> от <date>"
+REFERENCE_SEPARATOR = " от "
+
+logger = logging.getLogger(__name__)
+
+
+class InvoiceLedger:
+    def __init__(self, ledger_path):
+        self.ledger_path = Path(ledger_path)
+        self.connection = sqlite3.connect(str(self.ledger_path))
+        self.connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS invoices (
+                number TEXT NOT NULL,
+                contractor TEXT NOT NULL,
+                invoice_date TEXT NOT NULL,
+                file_digest TEXT,
+                source_file TEXT,
+                processed_at TEXT NOT NULL,
+                PRIMARY KEY (number, contractor, invoice_date)
+            )
+            """
+        )
+        self.connection.execute("CREATE INDEX IF NOT EXISTS invoices_file_digest ON invoices (file_digest)")
+        self.connection.commit()
+
+    @classmethod
+    def for_report(cls, report_path: str) -> "InvoiceLedger":
+        return cls(f"{report_path}{LEDGER_SUFFIX}")
+
+    @property
+    def journal_path(self) -> Path:
+        return self.ledger_path.with_name(self.ledger_path.name[:-len(LEDGER_SUFFIX)] + JOURNAL_SUFFIX)
+
+    def close(self):
+        self.connection.close()
+
+    def count(self) -> int:
+        return self.connection.execute("SELECT COUNT(*) FROM invoices").fetchone()[0]
+
+    def contains_file(self, file_digest: str) -> bool:
+        row = self.connection.execute(
+            "SELECT 1 FROM invoices WHERE file_digest = ? LIMIT 1", (file_digest,)
+        ).fetchone()
+        return row is not None
+
+    def contains(self, key: Tuple[str, str, str]) -> bool:
+        row = self.connection.execute(
+            "SELECT 1 FROM invoices WHERE number = ? AND contractor = ? AND invoice_date = ?", key
+        ).fetchone()
+        return row is not None
+
+    def record_many(self, entries: Iterable[Tuple[Tuple[str, str, str], Optional[str], Optional[str]]]):
+        """Record (key, file_digest, source_file) entries once their rows are saved to the report"""
+        processed_at = datetime.now().isoformat(timespec="seconds")
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO invoices VALUES (?, ?, ?, ?, ?, ?)",
+                [(*key, file_digest, source_file, processed_at) for key, file_digest, source_file in entries]
+            )
+
+    def rebuild(self, report_path: str) -> int:
+        """Replace the ledger contents with the invoices found in the report"""
+        entries = [(key, None, None) for key in report_keys(report_path)]
+        with self.connection:
+            self.connection.execute("DELETE FROM invoices")
+        self.record_many(entries)
+        return len(entries)
+
+    def begin(self, entries: List):
+        """Write the entries of a block that is about to be saved to the journal"""
+        payload = [
+            {"key": list(key), "file_digest": file_digest, "source_file": source_file}
+            for key, file_digest, source_file in entries
+        ]
+        with invoice_report.atomic_output(self.journal_path) as temp_path:
+            with open(temp_path, "w", encoding="utf-8") as f:
+                json.dump({"entries": payload}, f, ensure_ascii=False)
+
+    def commit(self, entries: List):
+        """Move the entries of a saved block from the journal to the ledger"""
+        self.record_many(entries)
+        self.journal_path.unlink(missing_ok=True)
+
+    def recover(self, report_path: str, log: Callable[[str], None], store=None) -> int:
+        """
+        Finish a block left in the journal by an interrupted run: entries whose invoice
+        is in the report (or in the report store, when there is one) were saved and go
+        to the ledger, the rest will be processed again.
+        """
+        try:
+            with open(self.journal_path, encoding="utf-8") as f:
+                payload = json.load(f)
+        except FileNotFoundError:
+            return 0
+        except (OSError, ValueError) as e:
+            log(f"Журнал незавершенной записи поврежден и удален: {e}")
+            self.journal_path.unlink(missing_ok=True)
+            return 0
+
+        entries = [
+            (tuple(entry["key"]), entry.get("file_digest"), entry.get("source_file"))
+            for entry in payload.get("entries", [])
+        ]
+        saved_keys = set()
+        if entries and store is not None:
+            saved_keys = {key for key, _, _ in entries if store.contains(key)}
+        elif entries and Path(report_path).exists():
+            journal_keys = {key for key, _, _ in entries}
+            saved_keys = {key for key in report_keys(report_path) if key in journal_keys}
+        committed = [entry for entry in entries if entry[0] in saved_keys]
+        self.commit(committed)
+        log(
+            f"Восстановление прерванной записи: сохранено счетов-фактур {len(committed)}, "
+            f"будут обработаны заново {len(entries) - len(committed)}"
+        )
+        return len(committed)
+
+
+def report_keys(report_path: str) -> Iterator[Tuple[str, str, str]]:
+    """
+    Invoice keys found in the report, read in one read-only pass. The key comes from
+    column 11 ("<number> от <date>") and column 1 (contractor) of the first row of each invoice block.
+    """
+    book = openpyxl.load_workbook(report_path, read_only=True, data_only=True)
+    try:
+        sheet = book.active
+        sheet.reset_dimensions()
+        for row in sheet.iter_rows(min_row=5, max_col=12, values_only=True):
+            if len(row) < 12 or row[11] is None:
+                continue
+            reference = str(row[11])
+            if REFERENCE_SEPARATOR not in reference:
+                continue
+            number, invoice_date = reference.rsplit(REFERENCE_SEPARATOR, 1)
+            contractor = "" if row[1] is None else str(row[1])
+            yield number, contractor, invoice_date
+    finally:
+        book.close()
+
+
+class PendingBatch:
+    """
+    Report rows and ledger entries of the invoices processed since the last save.
+    A block is committed every commit_every invoices (0 means once, at the end):
+    journal first, then the report store, then one report save, then the ledger.
+    With save=None (on-demand export) the rows go to the store only.
+    """
+
+    def __init__(self, ledger: Optional[InvoiceLedger], save: Optional[Callable[[pd.DataFrame], None]],
+                 commit_every: int = 0, metrics=None, store=None):
+        self.ledger = ledger
+        self.save = save
+        self.store = store
+        self.commit_every = commit_every
+        self.metrics = metrics
+        self.frames = []
+        self.entries = []
+        self.keys = set()
+        self.invoices_written = 0
+        self.rows_written = 0
+
+    def is_duplicate(self, key) -> bool:
+        """True when the invoice is already in the report or earlier in this run"""
+        if key is None or not key[0]:
+            return False
+        return key in self.keys or (self.ledger is not None and self.ledger.contains(key))
+
+    def add(self, new_df: pd.DataFrame, invoice_file: str, file_digest: Optional[str]) -> int:
+        """Queue the rows of one invoice; returns the number of invoices committed by this call"""
+        if new_df.empty:
+            return 0
+        key = rows_key(new_df)
+        self.frames.append(new_df)
+        if key is not None:
+            self.keys.add(key)
+            self.entries.append((key, file_digest, invoice_file))
+        if self.commit_every and len(self.frames) >= self.commit_every:
+            return self.commit()
+        return 0
+
+    def commit(self) -> int:
+        """Save the queued rows in one piece; returns the number of invoices written"""
+        if not self.frames:
+            return 0
+        combined_df = pd.concat(self.frames, ignore_index=True)
+        if self.ledger is not None:
+            with self.stage("journal"):
+                self.ledger.begin(self.entries)
+        if self.store is not None:
+            with self.stage("store"):
+                last_row_id = self.store.append(
+                    combined_df, {key: source_file for key, _, source_file in self.entries}
+                )
+        if self.save is not None:
+            with self.stage("save"):
+                self.save(combined_df)
+            if self.store is not None:
+                self.store.mark_exported(last_row_id)
+        if self.ledger is not None:
+            with self.stage("ledger"):
+                self.ledger.commit(self.entries)
+        if self.metrics is not None:
+            self.metrics.record_save(len(combined_df))
+        invoices = len(self.frames)
+        self.invoices_written += invoices
+        self.rows_written += len(combined_df)
+        self.frames = []
+        self.entries = []
+        return invoices
+
+    def stage(self, name: str):
+        return self.metrics.stage(name) if self.metrics is not None else nullcontext()
+
+
+def commit_interval(config) -> int:
+    """Invoices per saved block: 1 without batch_append, otherwise "commit_every" (0 = one save per run)"""
+    if not config.get("batch_append", invoice_core.DEFAULT_CONFIG["batch_append"]):
+        return 1
+    return max(0, int(config.get("commit_every", invoice_core.DEFAULT_CONFIG["commit_every"])))
+
+
+def rows_key(new_df) -> Optional[Tuple[str, str, str]]:
+    """Invoice key of report rows built by build_invoice_rows, None when the invoice number is empty"""
+    if new_df.empty or str(new_df.iloc[0][0]) == "":
+        return None
+    first_row = new_df.iloc[0]
+    return str(first_row[0]), str(first_row[1]), str(first_row[2])
+
+
+def skip_processed_files(ledger: Optional[InvoiceLedger], invoice_files, log=None):
+    """
+    Drop files whose content is already recorded in the ledger, before they are parsed.
+    Returns the remaining files and the content digests of all checked files.
+    """
+    log = log or logger.info
+    digests = {}
+    remaining = []
+    for invoice_file in invoice_files:
+        try:
+            digests[invoice_file] = invoice_core.file_digest(invoice_file)
+        except OSError:
+            # Unreadable files are left to the parser, which reports the error
+            remaining.append(invoice_file)
+            continue
+        if ledger is not None and ledger.contains_file(digests[invoice_file]):
+            log(f"Файл уже обработан ранее, пропущен: {Path(invoice_file).name}")
+        else:
+            remaining.append(invoice_file)
+    return remaining, digests
+
+
+def open_ledger(report_path: str, config, log=None, store=None) -> Optional[InvoiceLedger]:
+    """
+    Ledger of the report, or None when "ledger_enabled" is off. A missing ledger of an
+    existing report is built from the report first. Open the report store (if any)
+    before the ledger, so that an interrupted block is recovered against it.
+    """
+    log = log or logger.info
+    if not config.get("ledger_enabled", invoice_core.DEFAULT_CONFIG["ledger_enabled"]):
+        return None
+    ledger_exists = Path(f"{report_path}{LEDGER_SUFFIX}").exists()
+    try:
+        ledger = InvoiceLedger.for_report(report_path)
+    except sqlite3.Error as e:
+        log(f"Журнал обработанных счетов-фактур недоступен: {e}")
+        return None
+    if not ledger_exists and Path(report_path).exists():
+        count = ledger.rebuild(report_path)
+        log(f"Журнал обработанных счетов-фактур построен по отчету: {count} записей")
+    ledger.recover(report_path, log, store)
+    return ledger
@@ -0,0 +1,81 @@
+"""Logging setup shared by the GUI and the CLI, and the buffer that feeds the GUI log widget.
+
+The full log goes to a rotating file next to the script ("log_file" overrides the
+path). The GUI does not write each message into its Text widget: messages are
+collected in a LogBuffer from any thread and flushed on a Tk timer in one insert.
+"""
+import logging
+import threading
+from collections import deque
+from logging.handlers import RotatingFileHandler
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import invoice_core
+
+LOG_FILE = Path(__file__).resolve().parent / "invoice_processor.log"
+LOG_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+
+logger = logging.getLogger(__name__)
+
+
+def add_file_handler(config: Dict) -> Optional[RotatingFileHandler]:
+    """Attach a rotating file handler for the configured log file to the root logger"""
+    log_file = Path(config.get("log_file") or LOG_FILE)
+    root_logger = logging.getLogger()
+    for handler in root_logger.handlers:
+        if isinstance(handler, RotatingFileHandler) and Path(handler.baseFilename) == log_file.resolve():
+            return handler
+
+    max_kb = config.get("log_file_max_kb", invoice_core.DEFAULT_CONFIG["log_file_max_kb"])
+    backups = config.get("log_file_backups", invoice_core.DEFAULT_CONFIG["log_file_backups"])
+    try:
+        handler = RotatingFileHandler(log_file, maxBytes=int(max_kb * 1024), backupCount=int(backups),
+                                      encoding="utf-8")
+    except OSError as e:
+        logger.warning(f"Файл лога недоступен ({log_file}): {e}")
+        return None
+    handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    root_logger.addHandler(handler)
+    return handler
+
+
+def apply_log_level(config: Dict, console_level: Optional[int] = None):
+    """
+    Set the root logger to the configured level. The console can be quieter than
+    the file (console_level), the file always gets everything that is logged.
+    """
+    level = invoice_core.log_level(config)
+    root_logger = logging.getLogger()
+    root_logger.setLevel(level)
+    for handler in root_logger.handlers:
+        if not isinstance(handler, RotatingFileHandler):
+            handler.setLevel(max(level, console_level or level))
+
+
+class LogBuffer:
+    """Thread-safe buffer of log lines waiting for the GUI; only the last max_lines are kept"""
+
+    def __init__(self, max_lines: int):
+        self.lock = threading.Lock()
+        self.lines = deque(maxlen=max_lines)
+        self.dropped = 0
+
+    def set_max_lines(self, max_lines: int):
+        with self.lock:
+            self.lines = deque(self.lines, maxlen=max_lines)
+
+    def append(self, line: str):
+        with self.lock:
+            if len(self.lines) == self.lines.maxlen:
+                self.dropped += 1
+            self.lines.append(line)
+
+    def drain(self) -> Tuple[List[str], int]:
+        """Pending lines and the number of older lines dropped since the last drain"""
+        with self.lock:
+            lines = list(self.lines)
+            dropped = self.dropped
+            self.lines.clear()
+            self.dropped = 0
+        return lines, dropped
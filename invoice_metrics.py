@@ -0,0 +1,170 @@
+"""Per-stage timing of batch runs, a summary table and metrics files.
+
+BatchMetrics collects the time spent in each stage (ledger check, cache lookup,
+reading and extracting in the parse workers, row building, report save, ledger
+commit) for every invoice, the rows and bytes processed and, when enabled, the
+peak memory traced by tracemalloc in the main process. profiled() wraps a run
+in cProfile, or pyinstrument for an .html target when it is installed.
+"""
+import cProfile
+import csv
+import json
+import os
+import time
+import tracemalloc
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, List, Optional
+
+try:
+    from pyinstrument import Profiler as InstrumentProfiler
+except ImportError:
+    InstrumentProfiler = None
+
+
+class BatchMetrics:
+    def __init__(self, trace_memory: bool = False):
+        self.trace_memory = trace_memory
+        # stage -> [calls, total seconds, longest call in seconds]
+        self.stages: Dict[str, List[float]] = {}
+        self.invoices: List[Dict] = []
+        self.rows_written = 0
+        self.report_bytes = 0
+        self.peak_memory: Optional[int] = None
+        self.started = time.perf_counter()
+        self.seconds = 0.0
+        self._started_tracing = False
+
+    def start(self):
+        self.started = time.perf_counter()
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracing = True
+        elif tracemalloc.is_tracing():
+            tracemalloc.reset_peak()
+
+    def stop(self):
+        self.seconds = time.perf_counter() - self.started
+        if tracemalloc.is_tracing():
+            self.peak_memory = tracemalloc.get_traced_memory()[1]
+            if self._started_tracing:
+                tracemalloc.stop()
+                self._started_tracing = False
+
+    @contextmanager
+    def stage(self, name: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - started)
+
+    def add_time(self, name: str, seconds: float):
+        stage = self.stages.setdefault(name, [0, 0.0, 0.0])
+        stage[0] += 1
+        stage[1] += seconds
+        stage[2] = max(stage[2], seconds)
+
+    def record_invoice(self, invoice_file: str, stage_seconds: Dict[str, float]):
+        """Stage times measured for one invoice, which also go into the stage totals"""
+        for name, seconds in stage_seconds.items():
+            self.add_time(name, seconds)
+        try:
+            file_bytes = os.path.getsize(invoice_file)
+        except OSError:
+            file_bytes = 0
+        self.invoices.append({"file": str(invoice_file), "bytes": file_bytes, "rows": 0, **stage_seconds})
+
+    def add_invoice_time(self, invoice_file: str, name: str, seconds: float, rows: Optional[int] = None):
+        """Add a stage measured in the main process to the last record of invoice_file"""
+        self.add_time(name, seconds)
+        for record in reversed(self.invoices):
+            if record["file"] == str(invoice_file):
+                record[name] = record.get(name, 0.0) + seconds
+                if rows is not None:
+                    # Workbooks with several invoice sheets add the rows of each one
+                    record["rows"] += rows
+                break
+
+    def record_save(self, rows: int):
+        self.rows_written += rows
+
+    def record_report(self, report_file: str):
+        try:
+            self.report_bytes = os.path.getsize(report_file)
+        except OSError:
+            pass
+
+    def as_dict(self) -> Dict:
+        return {
+            "seconds": self.seconds,
+            "invoices": len(self.invoices),
+            "invoice_bytes": sum(record["bytes"] for record in self.invoices),
+            "rows_written": self.rows_written,
+            "report_bytes": self.report_bytes,
+            "peak_memory_bytes": self.peak_memory,
+            "stages": {
+                name: {"calls": calls, "seconds": total, "max_seconds": longest}
+                for name, (calls, total, longest) in self.stages.items()
+            },
+            "per_invoice": self.invoices,
+        }
+
+    def summary_table(self) -> str:
+        lines = [f"{'Этап':<14} {'вызовов':>8} {'всего, с':>9} {'ср., мс':>9} {'макс., мс':>10} {'доля':>6}"]
+        stage_total = sum(total for _, total, _ in self.stages.values()) or 1.0
+        for name, (calls, total, longest) in sorted(self.stages.items(), key=lambda item: -item[1][1]):
+            lines.append(
+                f"{name:<14} {calls:>8} {total:>9.3f} {total / calls * 1000:>9.1f} "
+                f"{longest * 1000:>10.1f} {total / stage_total:>6.1%}"
+            )
+        totals = self.as_dict()
+        lines.append(
+            f"Счетов-фактур: {totals['invoices']} ({totals['invoice_bytes'] / 1024:.0f} КБ), "
+            f"строк записано: {totals['rows_written']}, отчет: {totals['report_bytes'] / 1024:.0f} КБ, "
+            f"время: {self.seconds:.2f} с"
+        )
+        if self.peak_memory is not None:
+            lines.append(f"Пик памяти (tracemalloc, основной процесс): {self.peak_memory / 1024 / 1024:.1f} МБ")
+        return "\n".join(lines)
+
+    def write(self, metrics_file: str):
+        """Write the metrics as JSON, or one CSV row per invoice for a .csv file"""
+        path = Path(metrics_file)
+        if path.suffix.lower() == ".csv":
+            stage_names = sorted({key for record in self.invoices for key in record} - {"file", "bytes", "rows"})
+            with open(path, "w", newline="", encoding="utf-8") as f:
+                writer = csv.DictWriter(f, fieldnames=["file", "bytes", "rows", *stage_names])
+                writer.writeheader()
+                writer.writerows(self.invoices)
+        else:
+            with open(path, "w", encoding="utf-8") as f:
+                json.dump(self.as_dict(), f, ensure_ascii=False, indent=2)
+
+
+@contextmanager
+def profiled(profile_file: Optional[str]):
+    """
+    Profile the block into profile_file: pyinstrument HTML for an .html file when
+    pyinstrument is installed, otherwise cProfile stats for pstats/snakeviz.
+    Only the calling thread is profiled, parse worker processes are not.
+    """
+    if not profile_file:
+        yield
+        return
+    if Path(profile_file).suffix.lower() == ".html" and InstrumentProfiler is not None:
+        profiler = InstrumentProfiler()
+        profiler.start()
+        try:
+            yield
+        finally:
+            profiler.stop()
+            Path(profile_file).write_text(profiler.output_html(), encoding="utf-8")
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(profile_file)
@@ -0,0 +1,226 @@
+"""Pre-flight check of invoice files and the error report of a run.
+
+preflight() looks at every file before the real run, in worker processes: the
+file must be a zip archive with the parts of an xlsx workbook (only the zip
+directory is read), and only the configured header cells and the first item
+row of each invoice sheet are read in read-only mode. Each file ends up as
+"ok", "review" (it opens, but the number, contractor or date is missing, the
+date is not recognised, there are no items or the first one has no numeric
+weight or price; see invoice_core.validate_invoice) or "broken" (it cannot be
+read at all). Broken files are left out of the run instead of failing it
+halfway through.
+
+ErrorReport collects the files a run could not process, at the pre-flight
+check or later, so the run goes on with the other files and the failures are
+listed at the end and written to "<report>.errors.csv".
+"""
+import csv
+import logging
+import time
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+
+import openpyxl
+
+import invoice_core
+
+OK, REVIEW, BROKEN = "ok", "review", "broken"
+
+# Parts every xlsx workbook has
+REQUIRED_PARTS = ("[Content_Types].xml", "xl/workbook.xml")
+
+ERRORS_SUFFIX = ".errors.csv"
+
+# Stages of ErrorReport entries
+STAGE_PREFLIGHT = "проверка"
+STAGE_READ = "чтение"
+STAGE_PROCESS = "обработка"
+
+logger = logging.getLogger(__name__)
+
+
+def check_archive(invoice_file: str) -> Optional[str]:
+    """Why the file is not an xlsx workbook, or None; only the zip directory is read"""
+    try:
+        if not zipfile.is_zipfile(invoice_file):
+            return "файл не является книгой xlsx (не zip-архив)"
+        with zipfile.ZipFile(invoice_file) as archive:
+            names = set(archive.namelist())
+    except (OSError, zipfile.BadZipFile) as e:
+        return f"файл не читается: {invoice_core.error_text(e)}"
+    missing = [part for part in REQUIRED_PARTS if part not in names]
+    if missing:
+        return f"в архиве нет частей книги xlsx: {', '.join(missing)}"
+    return None
+
+
+def read_preflight_cells(sheet, plan: invoice_core.ExtractionPlan) -> invoice_core.InvoiceCells:
+    """The header cells of plan and its first item row, read from a read-only worksheet"""
+    cells = list(plan.header_cells())
+    if plan.items_start_row is not None and plan.items_start_row >= 0:
+        cells += [(plan.items_start_row, col) for col in plan.item_columns()]
+    values = invoice_core.read_anchor_cells(sheet, cells)
+    return invoice_core.InvoiceCells({key: invoice_core.convert_cell_value(value) for key, value in values.items()})
+
+
+def check_invoice_file(invoice_file: str, settings: Dict) -> Tuple[str, List[str]]:
+    """
+    Status of one file and its problems. Runs in a worker process; nothing is
+    raised, a file that cannot be read is "broken".
+    """
+    problem = check_archive(invoice_file)
+    if problem:
+        return BROKEN, [problem]
+    try:
+        book = openpyxl.load_workbook(invoice_file, read_only=True, data_only=True, keep_links=False)
+    except Exception as e:
+        return BROKEN, [f"книга не открывается: {invoice_core.error_text(e)}"]
+    try:
+        multiple_sheets = bool(settings.get('invoice_sheets'))
+        profiles = invoice_core.get_profile_index(settings)
+        file_name = Path(invoice_file).name
+        problems = []
+        invoices = 0
+        for name in invoice_core.select_sheets(book.sheetnames, settings, problems.append):
+            sheet = book[name]
+            profile = None
+            if profiles is not None:
+                anchors = invoice_core.read_anchor_cells(sheet, profiles.anchor_cells)
+                profile = profiles.select(file_name, lambda row, col: anchors.get((row, col)))
+            sheet_config = invoice_core.profile_config(settings, profile)
+            cells = read_preflight_cells(sheet, invoice_core.get_extraction_plan(sheet_config))
+            extracted_data = invoice_core.extract_invoice_data(cells, sheet_config, lambda message: None, profile or "")
+            if multiple_sheets and not invoice_core.is_invoice_sheet(extracted_data):
+                continue
+            invoices += 1
+            for found in invoice_core.validate_invoice(extracted_data, sheet_config):
+                problems.append(f"{name}: {found}" if multiple_sheets else found)
+        if multiple_sheets and not invoices:
+            problems.append("ни на одном листе нет счета-фактуры")
+    except Exception as e:
+        return BROKEN, [f"ошибка чтения книги: {invoice_core.error_text(e)}"]
+    finally:
+        book.close()
+    return (REVIEW if problems else OK), problems
+
+
+class PreflightResult:
+    """Files sorted by the pre-flight check; review and broken keep (file, problems)"""
+
+    def __init__(self):
+        self.ok: List[str] = []
+        self.review: List[Tuple[str, List[str]]] = []
+        self.broken: List[Tuple[str, List[str]]] = []
+        self.seconds = 0.0
+
+    def __len__(self) -> int:
+        return len(self.ok) + len(self.review) + len(self.broken)
+
+    def add(self, invoice_file: str, status: str, problems: List[str]):
+        if status == OK:
+            self.ok.append(invoice_file)
+        elif status == REVIEW:
+            self.review.append((invoice_file, problems))
+        else:
+            self.broken.append((invoice_file, problems))
+
+    def runnable(self, invoice_files: List[str]) -> List[str]:
+        """invoice_files without the broken ones, in their order"""
+        broken = {invoice_file for invoice_file, _ in self.broken}
+        return [invoice_file for invoice_file in invoice_files if invoice_file not in broken]
+
+    def log_summary(self, log: Callable[[str], None]):
+        log(
+            f"Предварительная проверка: файлов {len(self)}, в порядке {len(self.ok)}, "
+            f"требуют проверки {len(self.review)}, повреждены {len(self.broken)} ({self.seconds:.2f} с)"
+        )
+        for invoice_file, problems in self.broken:
+            log(f"Поврежден, пропущен {Path(invoice_file).name}: {'; '.join(problems)}")
+        for invoice_file, problems in self.review:
+            log(f"Требует проверки {Path(invoice_file).name}: {'; '.join(problems)}")
+
+
+def preflight_enabled(config: Dict) -> bool:
+    return bool(config.get('preflight', invoice_core.DEFAULT_CONFIG['preflight']))
+
+
+def preflight(invoice_files: List[str], config: Dict, workers: Optional[int] = None) -> PreflightResult:
+    """Check the files in worker processes (see check_invoice_file) and sort them by status"""
+    result = PreflightResult()
+    if not invoice_files:
+        return result
+    started = time.perf_counter()
+    settings = invoice_core.extraction_settings(config)
+    if workers is None:
+        workers = invoice_core.resolve_parse_workers(config, len(invoice_files))
+    if workers <= 1 or len(invoice_files) <= 1:
+        statuses = map(check_invoice_file, invoice_files, repeat(settings))
+        for invoice_file, (status, problems) in zip(invoice_files, statuses):
+            result.add(invoice_file, status, problems)
+    else:
+        workers = min(workers, len(invoice_files))
+        # A check takes milliseconds, so files go to the workers in chunks
+        chunksize = max(1, len(invoice_files) // (workers * 4))
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            statuses = executor.map(check_invoice_file, invoice_files, repeat(settings), chunksize=chunksize)
+            for invoice_file, (status, problems) in zip(invoice_files, statuses):
+                result.add(invoice_file, status, problems)
+    result.seconds = time.perf_counter() - started
+    return result
+
+
+class ErrorReport:
+    """Files (or sheets of them) a run could not process: (file, sheet, stage, error)"""
+
+    def __init__(self):
+        self.entries: List[Tuple[str, str, str, str]] = []
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def add(self, invoice_file: str, stage: str, error: str, sheet: Optional[str] = None):
+        self.entries.append((invoice_file, sheet or "", stage, error))
+
+    def add_preflight(self, result: PreflightResult):
+        for invoice_file, problems in result.broken:
+            self.add(invoice_file, STAGE_PREFLIGHT, "; ".join(problems))
+
+    def files(self) -> set:
+        return {invoice_file for invoice_file, _, _, _ in self.entries}
+
+    def log_summary(self, log: Callable[[str], None]):
+        if not self.entries:
+            return
+        log(f"Не обработано из-за ошибок: {len(self.entries)}")
+        self.log_entries(log)
+
+    def log_entries(self, log: Callable[[str], None]):
+        for invoice_file, sheet, stage, error in self.entries:
+            log(f"  {invoice_core.invoice_label(invoice_file, sheet or None)} ({stage}): {error}")
+
+    def write(self, errors_file) -> Path:
+        """Write the entries as CSV in the same dialect as the summary tables (invoice_summary)"""
+        path = Path(errors_file)
+        # utf-8-sig so that Excel opens the Cyrillic text correctly
+        with open(path, "w", newline="", encoding="utf-8-sig") as f:
+            writer = csv.writer(f, delimiter=";")
+            writer.writerow(["file", "sheet", "stage", "error"])
+            writer.writerows(self.entries)
+        return path
+
+    def save(self, errors_file) -> Optional[Path]:
+        """
+        Write the entries to errors_file, or, after a run without errors, remove the
+        report an earlier run left there, so it does not list files that are fine now
+        """
+        if self.entries:
+            return self.write(errors_file)
+        Path(errors_file).unlink(missing_ok=True)
+        return None
+
+
+def error_report_path(report_path: str) -> str:
+    return f"{report_path}{ERRORS_SUFFIX}"
@@ -0,0 +1,595 @@
+"""Report writer: appends invoice rows to the output workbook.
+
+Like invoice_core, this module does not import tkinter, so it can be used from
+scripts and worker processes.
+"""
+import logging
+import numbers
+import os
+import re
+import shutil
+import tempfile
+import zipfile
+from contextlib import contextmanager
+from copy import copy
+from pathlib import Path
+from typing import Callable, Iterable, Iterator, List, Optional, Tuple
+from xml.etree import ElementTree
+from xml.sax.saxutils import escape as xml_escape
+
+import numpy as np
+import openpyxl
+import pandas as pd
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.cell.cell import ILLEGAL_CHARACTERS_RE
+from openpyxl.utils import column_index_from_string, get_column_letter
+
+# Patterns for appending rows directly to the worksheet XML of the report
+SHEET_XML_MAIN_NS = "http://schemas.openxmlformats.org/spreadsheetml/2006/main"
+SHEET_XML_REL_NS = "http://schemas.openxmlformats.org/officeDocument/2006/relationships"
+SHEET_XML_ROW_RE = re.compile(r'<row\b[^>]*?\br="(\d+)"')
+SHEET_XML_CELL_RE = re.compile(r'<c\b[^>]*?\br="([A-Z]+)\d+"[^>]*?\bs="(\d+)"')
+SHEET_XML_VALUE_RE = re.compile(r'<(?:v|is|f)\b')
+SHEET_XML_DIMENSION_RE = re.compile(rb'<dimension ref="([A-Z]+\d+)(?::([A-Z]+)(\d+))?"\s*/>')
+
+# Rows 1-4 of the report are its header
+HEADER_ROWS = 4
+
+# Column labels pandas writes above the rows when save_with_formatting creates a new report
+COLUMN_LABELS_ROW = tuple(range(12))
+
+# Zero-based report column with the invoice date (see invoice_core.build_invoice_rows)
+DATE_COLUMN = 2
+
+# Cell style attributes copied by the streaming writer
+STYLE_ATTRIBUTES = ("font", "fill", "border", "alignment", "protection", "number_format")
+
+logger = logging.getLogger(__name__)
+
+
+def save_with_formatting(output_file, new_df, log: Optional[Callable[[str], None]] = None,
+                         report_writer: str = "append"):
+    """
+    Append new rows to the report without touching the rows already written.
+    With report_writer="stream" the report is instead rewritten row by row into a new
+    workbook (see rewrite_report_streaming), which keeps memory flat for very large reports.
+    """
+    log = log or logger.info
+    try:
+        if not Path(output_file).exists():
+            with atomic_output(output_file) as temp_path:
+                with pd.ExcelWriter(temp_path, engine='openpyxl') as writer:
+                    new_df.to_excel(writer, sheet_name='Sheet1', index=False, startrow=4)
+            return
+
+        if report_writer == "stream":
+            start_row = rewrite_report_streaming(output_file, new_df)
+            log(f"Отчет перезаписан потоково, добавлено строк: {len(new_df)} (начиная со строки {start_row})")
+            return
+
+        # Fast path: splice the rows into the sheet XML, so the cost does not depend on the report size
+        start_row = append_to_sheet_xml(output_file, new_df)
+        if start_row is None:
+            start_row = append_with_openpyxl(output_file, new_df)
+        log(f"Добавлено строк в отчет: {len(new_df)} (начиная со строки {start_row})")
+
+    except Exception as e:
+        log(f"Ошибка при сохранении файла: {str(e)}")
+        raise
+
+
+def append_with_openpyxl(output_file, new_df) -> int:
+    """Append rows through openpyxl, used when the sheet XML has an unusual layout"""
+    book = openpyxl.load_workbook(output_file)
+    sheet = book.active
+    start_row = get_last_number(sheet)
+
+    # New cells take the styles of the last data row instead of a whole-sheet snapshot
+    template_styles = {}
+    if start_row > 5:
+        for col in range(1, len(new_df.columns) + 1):
+            template_cell = sheet.cell(row=start_row - 1, column=col)
+            if template_cell.has_style:
+                template_styles[col] = template_cell._style
+
+    for row_offset, row in enumerate(new_df.itertuples(index=False)):
+        for col_index, value in enumerate(row):
+            cell = sheet.cell(row=start_row + row_offset, column=col_index + 1)
+            if col_index + 1 in template_styles and not cell.has_style:
+                cell._style = copy(template_styles[col_index + 1])
+            if pd.notna(value):
+                cell.value = value
+
+    with atomic_output(output_file) as temp_path:
+        book.save(temp_path)
+    return start_row
+
+
+def append_to_sheet_xml(output_file, new_df) -> Optional[int]:
+    """
+    Append rows directly to the XML of the active sheet.
+    Returns the first written row, or None if the sheet layout is not supported.
+    """
+    archive = zipfile.ZipFile(output_file)
+    try:
+        spliced = splice_sheet_rows(archive, new_df)
+        if spliced is None:
+            return None
+        sheet_path, sheet_xml, start_row = spliced
+
+        # Write the updated archive next to the report and swap it in
+        with atomic_output(output_file) as temp_path:
+            with zipfile.ZipFile(temp_path, 'w') as updated:
+                for item in archive.infolist():
+                    if item.filename == sheet_path:
+                        updated.writestr(item, sheet_xml)
+                    else:
+                        updated.writestr(item, archive.read(item.filename))
+            # Windows cannot replace a file that is still open, so the report is closed before the swap
+            archive.close()
+    finally:
+        archive.close()
+    return start_row
+
+
+def splice_sheet_rows(archive: zipfile.ZipFile, new_df) -> Optional[Tuple[str, bytes, int]]:
+    """
+    The active sheet of the report archive with the rows of new_df spliced in:
+    (sheet_path, sheet_xml, first written row), or None if the layout is not supported.
+    """
+    sheet_path = active_sheet_path(archive)
+    if sheet_path is None:
+        return None
+    sheet_xml = archive.read(sheet_path)
+
+    data_end = sheet_xml.rfind(b'</sheetData>')
+    last_row_start = sheet_xml.rfind(b'<row ', 0, data_end)
+    if data_end == -1 or last_row_start == -1:
+        return None
+
+    # Styled but empty rows at the bottom have to be filled in place
+    last_row_xml = sheet_xml[last_row_start:data_end].decode('utf-8')
+    if not SHEET_XML_VALUE_RE.search(last_row_xml):
+        return None
+    # Row numbers are optional in the format; without one the position is left to openpyxl
+    row_match = SHEET_XML_ROW_RE.match(last_row_xml)
+    if row_match is None:
+        return None
+    last_row = int(row_match.group(1))
+    start_row = max(last_row + 1, 5)
+
+    template_styles = {}
+    if start_row > 5:
+        for cell_match in SHEET_XML_CELL_RE.finditer(last_row_xml):
+            template_styles[column_index_from_string(cell_match.group(1))] = cell_match.group(2)
+
+    rows_xml = []
+    for row_offset, row in enumerate(new_df.itertuples(index=False)):
+        row_number = start_row + row_offset
+        cells_xml = []
+        for col_index, value in enumerate(row):
+            reference = f"{get_column_letter(col_index + 1)}{row_number}"
+            style = template_styles.get(col_index + 1)
+            style_attr = f' s="{style}"' if style else ''
+            if isinstance(value, (bool, np.bool_)):
+                cells_xml.append(f'<c r="{reference}"{style_attr} t="b"><v>{int(value)}</v></c>')
+            elif isinstance(value, numbers.Integral):
+                cells_xml.append(f'<c r="{reference}"{style_attr}><v>{int(value)}</v></c>')
+            elif isinstance(value, numbers.Number) and pd.notna(value):
+                cells_xml.append(f'<c r="{reference}"{style_attr}><v>{float(value)!r}</v></c>')
+            elif pd.notna(value) and value != '':
+                cells_xml.append(
+                    f'<c r="{reference}"{style_attr} t="inlineStr">'
+                    f'<is><t xml:space="preserve">{xml_text(value)}</t></is></c>'
+                )
+            elif style:
+                cells_xml.append(f'<c r="{reference}"{style_attr}/>')
+        rows_xml.append(f'<row r="{row_number}">{"".join(cells_xml)}</row>')
+
+    new_last_row = start_row + len(rows_xml) - 1
+    sheet_xml = sheet_xml[:data_end] + "".join(rows_xml).encode('utf-8') + sheet_xml[data_end:]
+    sheet_xml = SHEET_XML_DIMENSION_RE.sub(
+        lambda m: extend_dimension(m, new_last_row, len(new_df.columns)),
+        sheet_xml,
+        count=1
+    )
+    return sheet_path, sheet_xml, start_row
+
+
+def xml_text(value) -> str:
+    """Text of a cell for the sheet XML: control characters XML does not allow are dropped, the rest escaped"""
+    return xml_escape(ILLEGAL_CHARACTERS_RE.sub('', str(value)))
+
+
+def rewrite_report_streaming(output_file, new_df) -> int:
+    """
+    Rewrite the report with the new rows appended, streaming it from a read-only
+    workbook into a write-only one, so neither the old nor the new report is held
+    in memory. Header rows, cell styles, column widths and merged cells are kept;
+    the new file is written next to the report and swapped in atomically.
+    Returns the first row of the new rows.
+    """
+    output_path = Path(output_file)
+    source = openpyxl.load_workbook(output_path, read_only=True)
+    with atomic_output(output_path) as temp_path:
+        try:
+            book = openpyxl.Workbook(write_only=True)
+            start_row = None
+            with zipfile.ZipFile(output_path) as archive:
+                for source_sheet in source.worksheets:
+                    sheet = book.create_sheet(source_sheet.title)
+                    copy_sheet_layout(archive, source_sheet, sheet)
+                    if source_sheet is source.active:
+                        start_row = stream_sheet_rows(source_sheet, sheet, new_df)
+                    else:
+                        stream_sheet_rows(source_sheet, sheet, None)
+            book.active = source.index(source.active)
+            book.save(temp_path)
+        finally:
+            # The read-only workbook keeps the report open until it is closed
+            source.close()
+    return start_row
+
+
+def copy_sheet_layout(archive, source_sheet, sheet):
+    """
+    Copy column widths, header row heights and merged cells, which a read-only
+    worksheet does not expose, by scanning the sheet XML once without keeping it.
+    """
+    with archive.open(source_sheet._worksheet_path) as sheet_xml:
+        for _, element in ElementTree.iterparse(sheet_xml):
+            tag = element.tag.rpartition('}')[2]
+            if tag == 'col':
+                for column in range(int(element.get('min')), int(element.get('max')) + 1):
+                    dimension = sheet.column_dimensions[get_column_letter(column)]
+                    if element.get('width') is not None:
+                        dimension.width = float(element.get('width'))
+                    dimension.hidden = element.get('hidden') in ('1', 'true')
+            elif tag == 'row':
+                row = int(element.get('r', 0))
+                if row <= HEADER_ROWS and element.get('ht') is not None:
+                    sheet.row_dimensions[row].height = float(element.get('ht'))
+            elif tag == 'mergeCell':
+                sheet.merged_cells.add(element.get('ref'))
+            if tag in ('row', 'mergeCell', 'col'):
+                element.clear()
+
+
+def stream_sheet_rows(source_sheet, sheet, new_df) -> Optional[int]:
+    """
+    Copy the rows of a read-only sheet into a write-only one and append new_df
+    after the last row with data, as get_last_number does. Trailing empty rows
+    are held back (they are usually few) so that the new rows can fill them.
+    """
+    copied = cell_copier(sheet)
+    source_sheet.reset_dimensions()
+    empty_rows = []
+    template_row = None
+    row_number = 0
+    for row_number, row in enumerate(source_sheet.iter_rows(), start=1):
+        has_data = row_number <= HEADER_ROWS or any(cell.value not in (None, '') for cell in row)
+        if not has_data:
+            empty_rows.append(row)
+            continue
+        for empty_row in empty_rows:
+            sheet.append([copied(cell) for cell in empty_row])
+        empty_rows = []
+        sheet.append([copied(cell) for cell in row])
+        if row_number > HEADER_ROWS:
+            template_row = row
+    # Every row yielded so far is either written or held back in empty_rows
+    last_data_row = row_number - len(empty_rows)
+    if new_df is None:
+        for empty_row in empty_rows:
+            sheet.append([copied(cell) for cell in empty_row])
+        return None
+
+    # Header rows missing from the source are written empty, so data starts at row 5
+    for _ in range(last_data_row, HEADER_ROWS):
+        sheet.append([])
+    start_row = max(last_data_row + 1, HEADER_ROWS + 1)
+
+    template_cells = {}
+    if template_row is not None:
+        template_cells = {index: cell for index, cell in enumerate(template_row) if has_style(cell)}
+    for row_offset, values in enumerate(new_df.itertuples(index=False)):
+        filled_row = empty_rows[row_offset] if row_offset < len(empty_rows) else ()
+        cells = []
+        for col_index, value in enumerate(values):
+            # A pre-formatted empty row keeps its own style, otherwise the last data row is the template
+            style_cell = filled_row[col_index] if col_index < len(filled_row) else None
+            if style_cell is None or not has_style(style_cell):
+                style_cell = template_cells.get(col_index)
+            cell = copied(style_cell) if style_cell is not None else WriteOnlyCell(sheet)
+            cell.value = report_value(value)
+            cells.append(cell)
+        sheet.append(cells)
+    for empty_row in empty_rows[len(new_df):]:
+        sheet.append([copied(cell) for cell in empty_row])
+    return start_row
+
+
+def has_style(cell) -> bool:
+    # Gaps in a read-only row are EmptyCell placeholders without styles
+    return getattr(cell, 'has_style', False)
+
+
+def cell_copier(sheet) -> Callable:
+    """Function copying a read-only cell with its style into a write-only cell of sheet"""
+    styles = {}
+
+    def copied(cell):
+        if cell.value is None and not has_style(cell):
+            return None
+        new_cell = WriteOnlyCell(sheet, value=cell.value)
+        if has_style(cell):
+            if cell._style_id not in styles:
+                styles[cell._style_id] = {name: copy(getattr(cell, name)) for name in STYLE_ATTRIBUTES}
+            for name, value in styles[cell._style_id].items():
+                setattr(new_cell, name, value)
+        return new_cell
+
+    return copied
+
+
+def write_report_rows(output_file, rows: Iterable) -> int:
+    """
+    Write the report again with rows (iterables of report values) as its data,
+    streaming them into a write-only workbook. The header rows, column widths,
+    merged cells and other sheets of the current report are kept, and the data
+    rows take the styles of its first data row. Returns the number of data rows.
+    """
+    output_path = Path(output_file)
+    if not output_path.exists():
+        book = openpyxl.Workbook(write_only=True)
+        sheet = book.create_sheet('Sheet1')
+        for _ in range(HEADER_ROWS):
+            sheet.append([])
+        written = 0
+        for values in rows:
+            sheet.append([report_value(value) for value in values])
+            written += 1
+        with atomic_output(output_path) as temp_path:
+            book.save(temp_path)
+        return written
+
+    source = openpyxl.load_workbook(output_path, read_only=True)
+    with atomic_output(output_path) as temp_path:
+        try:
+            book = openpyxl.Workbook(write_only=True)
+            written = 0
+            with zipfile.ZipFile(output_path) as archive:
+                for source_sheet in source.worksheets:
+                    sheet = book.create_sheet(source_sheet.title)
+                    copy_sheet_layout(archive, source_sheet, sheet)
+                    if source_sheet is source.active:
+                        written = replace_sheet_rows(source_sheet, sheet, rows)
+                    else:
+                        stream_sheet_rows(source_sheet, sheet, None)
+            book.active = source.index(source.active)
+            book.save(temp_path)
+        finally:
+            source.close()
+    return written
+
+
+def replace_sheet_rows(source_sheet, sheet, rows: Iterable) -> int:
+    """Copy the header rows of a read-only sheet and write rows below them in the style of its first data row"""
+    copied = cell_copier(sheet)
+    source_sheet.reset_dimensions()
+    template_cells = {}
+    header_rows = 0
+    for row_number, row in enumerate(source_sheet.iter_rows(max_row=HEADER_ROWS + 1), start=1):
+        if row_number > HEADER_ROWS:
+            template_cells = {index: cell for index, cell in enumerate(row) if has_style(cell)}
+            break
+        sheet.append([copied(cell) for cell in row])
+        header_rows = row_number
+    for _ in range(header_rows, HEADER_ROWS):
+        sheet.append([])
+
+    written = 0
+    for values in rows:
+        cells = []
+        for col_index, value in enumerate(values):
+            style_cell = template_cells.get(col_index)
+            cell = copied(style_cell) if style_cell is not None else WriteOnlyCell(sheet)
+            cell.value = report_value(value)
+            cells.append(cell)
+        sheet.append(cells)
+        written += 1
+    return written
+
+
+def report_value(value):
+    """Plain Python value of a DataFrame cell as written to the report, None for empty cells"""
+    if isinstance(value, (bool, np.bool_)):
+        return bool(value)
+    if isinstance(value, numbers.Integral):
+        return int(value)
+    if isinstance(value, numbers.Number):
+        return float(value) if pd.notna(value) else None
+    if value is None or (not isinstance(value, str) and pd.isna(value)) or value == '':
+        return None
+    return value
+
+
+@contextmanager
+def atomic_output(output_file):
+    """
+    Yield a temporary path next to output_file. When the block succeeds the file is
+    flushed to disk and renamed over output_file, so a crash leaves either the old
+    or the new report, never a partly written one. On errors the temp file is removed.
+    """
+    output_path = Path(output_file)
+    temp_fd, temp_path = tempfile.mkstemp(prefix=f".{output_path.stem}.", suffix=output_path.suffix,
+                                          dir=output_path.parent)
+    os.close(temp_fd)
+    try:
+        yield temp_path
+        # mkstemp creates the file readable by the owner only
+        if output_path.exists():
+            shutil.copymode(output_path, temp_path)
+        else:
+            umask = os.umask(0)
+            os.umask(umask)
+            os.chmod(temp_path, 0o666 & ~umask)
+        with open(temp_path, 'r+b') as f:
+            os.fsync(f.fileno())
+        os.replace(temp_path, output_path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    fsync_directory(output_path.parent)
+
+
+def fsync_directory(directory):
+    """Persist a rename in the directory entry; not possible (or needed) on Windows"""
+    if os.name == 'nt':
+        return
+    dir_fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+
+def active_sheet_path(archive) -> Optional[str]:
+    """Find the archive path of the active worksheet from workbook.xml and its relationships"""
+    try:
+        workbook = ElementTree.fromstring(archive.read('xl/workbook.xml'))
+        relationships = ElementTree.fromstring(archive.read('xl/_rels/workbook.xml.rels'))
+    except KeyError:
+        return None
+
+    view = workbook.find(f'{{{SHEET_XML_MAIN_NS}}}bookViews/{{{SHEET_XML_MAIN_NS}}}workbookView')
+    active_index = int(view.get('activeTab', 0)) if view is not None else 0
+    sheets = workbook.findall(f'{{{SHEET_XML_MAIN_NS}}}sheets/{{{SHEET_XML_MAIN_NS}}}sheet')
+    if active_index >= len(sheets):
+        return None
+    relation_id = sheets[active_index].get(f'{{{SHEET_XML_REL_NS}}}id')
+
+    for relation in relationships:
+        if relation.get('Id') == relation_id:
+            target = relation.get('Target')
+            if not target.endswith('.xml') or 'worksheets/' not in target:
+                return None
+            return target.lstrip('/') if target.startswith('/') else f"xl/{target}"
+    return None
+
+
+def iter_report_rows(output_file, column_count: int = 12) -> Iterator[Tuple[int, Tuple]]:
+    """
+    (row number, values of the first column_count columns) of the data rows of the
+    report, streamed straight from the sheet XML, which is several times faster than
+    a read-only openpyxl workbook on large reports. Styles are not read, so a cell
+    formatted as a date comes as its serial number. Falls back to openpyxl for
+    sheets whose layout the XML reader does not know.
+    """
+    with zipfile.ZipFile(output_file) as archive:
+        sheet_path = active_sheet_path(archive)
+        if sheet_path is not None:
+            yield from iter_sheet_xml_rows(archive, sheet_path, column_count)
+            return
+    book = openpyxl.load_workbook(output_file, read_only=True, data_only=True)
+    try:
+        sheet = book.active
+        sheet.reset_dimensions()
+        for row_number, row in enumerate(
+            sheet.iter_rows(min_row=HEADER_ROWS + 1, max_col=column_count, values_only=True), start=HEADER_ROWS + 1
+        ):
+            yield row_number, tuple(row) + (None,) * (column_count - len(row))
+    finally:
+        book.close()
+
+
+def iter_sheet_xml_rows(archive, sheet_path: str, column_count: int) -> Iterator[Tuple[int, Tuple]]:
+    shared_strings = read_shared_strings(archive)
+    row_tag = f'{{{SHEET_XML_MAIN_NS}}}row'
+    value_tag = f'{{{SHEET_XML_MAIN_NS}}}v'
+    column_indices = {}
+    row_number = 0
+    with archive.open(sheet_path) as sheet_xml:
+        for _, element in ElementTree.iterparse(sheet_xml):
+            if element.tag != row_tag:
+                continue
+            row_number = int(element.get('r', row_number + 1))
+            if row_number <= HEADER_ROWS:
+                element.clear()
+                continue
+            values = [None] * column_count
+            col_index = -1
+            for cell in element:
+                reference = cell.get('r')
+                if reference is None:
+                    col_index += 1
+                else:
+                    letters = reference.rstrip('0123456789')
+                    if letters not in column_indices:
+                        column_indices[letters] = column_index_from_string(letters) - 1
+                    col_index = column_indices[letters]
+                if col_index >= column_count:
+                    continue
+                cell_type = cell.get('t')
+                if cell_type == 'inlineStr':
+                    values[col_index] = ''.join(cell.itertext())
+                    continue
+                value = cell.find(value_tag)
+                if value is None or value.text is None:
+                    continue
+                if cell_type == 's':
+                    values[col_index] = shared_strings[int(value.text)]
+                elif cell_type == 'b':
+                    values[col_index] = value.text == '1'
+                elif cell_type in ('str', 'e'):
+                    values[col_index] = value.text
+                else:
+                    number = float(value.text)
+                    values[col_index] = int(number) if number.is_integer() and '.' not in value.text else number
+            element.clear()
+            yield row_number, tuple(values)
+
+
+def read_shared_strings(archive) -> List[str]:
+    try:
+        strings_xml = archive.open('xl/sharedStrings.xml')
+    except KeyError:
+        return []
+    item_tag = f'{{{SHEET_XML_MAIN_NS}}}si'
+    phonetic_tag = f'{{{SHEET_XML_MAIN_NS}}}rPh'
+    strings = []
+    with strings_xml:
+        for _, element in ElementTree.iterparse(strings_xml):
+            if element.tag == item_tag:
+                # Phonetic runs (<rPh>) are annotations, not part of the text
+                for phonetic in element.findall(phonetic_tag):
+                    element.remove(phonetic)
+                strings.append(''.join(element.itertext()))
+                element.clear()
+    return strings
+
+
+def extend_dimension(match, last_row: int, column_count: int) -> bytes:
+    """Grow the <dimension ref="..."> of the sheet to cover the appended rows"""
+    first_cell, last_column, last_dim_row = (
+        group.decode('ascii') if group else None for group in match.groups()
+    )
+    if last_column is None:
+        last_column = ''.join(filter(str.isalpha, first_cell))
+        last_dim_row = ''.join(filter(str.isdigit, first_cell))
+    last_column = get_column_letter(max(column_index_from_string(last_column), column_count))
+    return f'<dimension ref="{first_cell}:{last_column}{max(int(last_dim_row), last_row)}"/>'.encode('ascii')
+
+
+def get_last_number(sheet) -> int:
+    """
+    Получает номер первой пустой строки (нумерация Excel) для вставки новой счет-фактуры.
+    Строки просматриваются снизу вверх, пока не встретится строка с данными.
+    Строки заголовка 1-4 не учитываются, поэтому для пустого отчета возвращается 5.
+    """
+    for row in range(sheet.max_row, 4, -1):
+        for col in range(1, sheet.max_column + 1):
+            if sheet.cell(row=row, column=col).value not in (None, ''):
+                return row + 1
+    return 5
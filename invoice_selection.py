@@ -0,0 +1,121 @@
+"""Selected invoice files, kept in processing order for the invoice list of the GUI.
+
+InvoiceSelection holds the paths sorted by invoice_core.invoice_sort_key, which
+is also the order of the list widget, with a set for the duplicate check. Adding
+files inserts them in place (or merges a large batch in one pass) and returns
+the positions they took, so the widget is updated with the new rows only and
+removing rows by their position in the widget removes the right files.
+
+walk_invoice_files lists a directory tree by name only: nothing is opened or
+stat'ed while files are added, so thousands of files are listed quickly and
+their content is only read when they are processed.
+"""
+import heapq
+import os
+from bisect import bisect_left
+from typing import Callable, Iterable, Iterator, List, Optional
+
+import invoice_core
+
+
+class InvoiceSelection:
+    def __init__(self, paths: Iterable[str] = ()):
+        self.keys: List[tuple] = []
+        self.paths: List[str] = []
+        self.members = set()
+        self.add_many(paths)
+
+    def __len__(self) -> int:
+        return len(self.paths)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.paths)
+
+    def __getitem__(self, index: int) -> str:
+        return self.paths[index]
+
+    def __contains__(self, path: str) -> bool:
+        return self.member_key(path) in self.members
+
+    @staticmethod
+    def member_key(path: str) -> str:
+        # The same file reached through "dir/./a.xlsx" or in another letter case on Windows
+        return os.path.normcase(os.path.normpath(path))
+
+    def add(self, path: str) -> Optional[int]:
+        """Insert one file; returns its position, or None when it is already selected"""
+        positions = self.add_many([path])
+        return positions[0] if positions else None
+
+    def add_many(self, paths: Iterable[str]) -> List[int]:
+        """Insert files not selected yet; returns the positions they took, in ascending order"""
+        new = []
+        for path in paths:
+            member_key = self.member_key(path)
+            if member_key not in self.members:
+                self.members.add(member_key)
+                new.append((invoice_core.invoice_sort_key(path), path))
+        if not new:
+            return []
+        new.sort()
+        if len(new) > len(self.paths):
+            # Merging a batch larger than the selection is linear, inserting one by one is not
+            merged = list(heapq.merge(zip(self.keys, self.paths), new))
+            self.keys = [key for key, _ in merged]
+            self.paths = [path for _, path in merged]
+            return [bisect_left(self.keys, key) for key, _ in new]
+        positions = []
+        # Ascending keys go in ascending positions, so every position is final once taken
+        for key, path in new:
+            index = bisect_left(self.keys, key)
+            self.keys.insert(index, key)
+            self.paths.insert(index, path)
+            positions.append(index)
+        return positions
+
+    def remove_indices(self, indices: Iterable[int]) -> List[str]:
+        """Remove the files at the given positions (as shown in the list); returns them"""
+        removed = []
+        for index in sorted(set(indices), reverse=True):
+            path = self.paths.pop(index)
+            del self.keys[index]
+            self.members.discard(self.member_key(path))
+            removed.append(path)
+        removed.reverse()
+        return removed
+
+    def clear(self):
+        self.keys.clear()
+        self.paths.clear()
+        self.members.clear()
+
+
+def is_invoice_file_name(name: str) -> bool:
+    # Excel lock files (~$name.xlsx) of workbooks that are open are not invoices
+    return name.lower().endswith(".xlsx") and not name.startswith("~$")
+
+
+def walk_invoice_files(directory: str, recursive: bool = True,
+                       on_error: Optional[Callable[[OSError], None]] = None) -> Iterator[str]:
+    """
+    Invoice files (*.xlsx) of the directory, and of its subdirectories when recursive.
+    Folders that cannot be read are passed to on_error (as with os.walk) and skipped.
+    """
+    pending = [directory]
+    while pending:
+        try:
+            entries = os.scandir(pending.pop())
+        except OSError as e:
+            if on_error is not None:
+                on_error(e)
+            continue
+        with entries:
+            subdirectories = []
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    if recursive:
+                        subdirectories.append(entry.path)
+                elif is_invoice_file_name(entry.name) and entry.is_file():
+                    yield entry.path
+            # Walked depth first in name order, so the files arrive grouped by folder
+            pending.extend(sorted(subdirectories, reverse=True))
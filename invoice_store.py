@@ -0,0 +1,265 @@
+"""Indexed SQLite store of the report rows; the xlsx report is an export of it.
+
+The store is a SQLite file next to the report ("<report>.store.sqlite") with one
+row per report row: the twelve report columns exactly as written, plus the
+invoice key on every row of the invoice, the normalized invoice date and numeric
+weight and price for queries. Appends insert only the new rows and queries such
+as totals per contractor or per month run on indexes, so neither depends on the
+size of the workbook.
+
+Committed rows reach the xlsx either with every commit ("report_export":
+"each_commit") or only when exported ("on_demand", see export_pending and
+export_report). The store remembers the last row exported to the xlsx; rows a
+crash kept from reaching the workbook are exported when the store is opened again.
+Edits made to the xlsx by hand are not seen by the store; rebuild it from the
+report afterwards (invoice_cli --rebuild-store).
+"""
+import logging
+import sqlite3
+from datetime import date, datetime
+from pathlib import Path
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+import openpyxl
+import pandas as pd
+
+import invoice_core
+import invoice_dates
+import invoice_report
+
+STORE_SUFFIX = ".store.sqlite"
+
+# Names of the twelve report columns built by invoice_core.build_invoice_rows
+REPORT_COLUMNS = (
+    "number", "contractor", "invoice_date", "kind", "text_part", "column_5",
+    "numeric_part", "weight", "price", "column_9", "column_10", "reference",
+)
+
+# Grouping expressions of totals()
+TOTALS_GROUPS = {
+    "contractor": "key_contractor",
+    "month": "substr(invoice_day, 1, 7)",
+    "day": "invoice_day",
+}
+
+INSERT_ROW = (
+    f"INSERT INTO report_rows ({', '.join(REPORT_COLUMNS)}, key_number, key_contractor, key_date, "
+    f"invoice_day, weight_value, price_value, source_file, added_at) "
+    f"VALUES ({', '.join('?' * (len(REPORT_COLUMNS) + 8))})"
+)
+
+logger = logging.getLogger(__name__)
+
+
+class ReportStore:
+    def __init__(self, store_path):
+        self.store_path = Path(store_path)
+        self.connection = sqlite3.connect(str(self.store_path))
+        self.connection.executescript(
+            f"""
+            CREATE TABLE IF NOT EXISTS report_rows (
+                row_id INTEGER PRIMARY KEY,
+                {", ".join(REPORT_COLUMNS)},
+                key_number TEXT NOT NULL,
+                key_contractor TEXT NOT NULL,
+                key_date TEXT NOT NULL,
+                invoice_day TEXT,
+                weight_value REAL,
+                price_value REAL,
+                source_file TEXT,
+                added_at TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS report_rows_key ON report_rows (key_number, key_contractor, key_date);
+            CREATE INDEX IF NOT EXISTS report_rows_contractor ON report_rows (key_contractor);
+            CREATE INDEX IF NOT EXISTS report_rows_day ON report_rows (invoice_day);
+            CREATE TABLE IF NOT EXISTS export_state (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                exported_row_id INTEGER NOT NULL
+            );
+            INSERT OR IGNORE INTO export_state VALUES (1, 0);
+            """
+        )
+        self.connection.commit()
+
+    @classmethod
+    def for_report(cls, report_path: str) -> "ReportStore":
+        return cls(f"{report_path}{STORE_SUFFIX}")
+
+    def close(self):
+        self.connection.close()
+
+    def count(self) -> int:
+        return self.connection.execute("SELECT COUNT(*) FROM report_rows").fetchone()[0]
+
+    def contains(self, key: Tuple[str, str, str]) -> bool:
+        row = self.connection.execute(
+            "SELECT 1 FROM report_rows WHERE key_number = ? AND key_contractor = ? AND key_date = ? LIMIT 1", key
+        ).fetchone()
+        return row is not None
+
+    def exported_row_id(self) -> int:
+        return self.connection.execute("SELECT exported_row_id FROM export_state").fetchone()[0]
+
+    def last_row_id(self) -> int:
+        return self.connection.execute("SELECT COALESCE(MAX(row_id), 0) FROM report_rows").fetchone()[0]
+
+    def append(self, new_df: pd.DataFrame, source_files: Optional[Dict[Tuple[str, str, str], str]] = None) -> int:
+        """Insert the rows of new_df (one or more invoices) in one transaction; returns the last row id"""
+        records = store_records(new_df.itertuples(index=False), source_files or {})
+        with self.connection:
+            self.connection.executemany(
+                INSERT_ROW,
+                records
+            )
+        return self.last_row_id()
+
+    def mark_exported(self, row_id: Optional[int] = None):
+        """Record that the rows up to row_id (all rows by default) are in the xlsx report"""
+        with self.connection:
+            self.connection.execute(
+                "UPDATE export_state SET exported_row_id = ?", (self.last_row_id() if row_id is None else row_id,)
+            )
+
+    def rows(self, after_row_id: int = 0) -> Iterator[Tuple]:
+        """The report columns of the stored rows after after_row_id, in report order"""
+        yield from self.connection.execute(
+            f"SELECT {', '.join(REPORT_COLUMNS)} FROM report_rows WHERE row_id > ? ORDER BY row_id", (after_row_id,)
+        )
+
+    def pending_frame(self) -> Tuple[pd.DataFrame, int]:
+        """Rows not yet in the xlsx report as a build_invoice_rows-like DataFrame, and the last of their ids"""
+        exported = self.exported_row_id()
+        last = self.last_row_id()
+        frame = pd.DataFrame(list(self.rows(exported)), columns=range(len(REPORT_COLUMNS)))
+        return frame.fillna(""), last
+
+    def export_pending(self, report_path: str, log: Optional[Callable[[str], None]] = None,
+                       report_writer: str = "append") -> int:
+        """Append the rows not yet exported to the xlsx report in one save; returns their number"""
+        new_df, last = self.pending_frame()
+        if not new_df.empty:
+            invoice_report.save_with_formatting(report_path, new_df, log, report_writer)
+        self.mark_exported(last)
+        return len(new_df)
+
+    def export_report(self, report_path: str, log: Optional[Callable[[str], None]] = None) -> int:
+        """Write the whole report again from the store, keeping the header and styles of the current one"""
+        log = log or logger.info
+        last = self.last_row_id()
+        rows = invoice_report.write_report_rows(report_path, self.rows())
+        self.mark_exported(last)
+        log(f"Отчет выгружен из хранилища: {rows} строк")
+        return rows
+
+    def rebuild(self, report_path: str) -> int:
+        """Replace the store contents with the data rows of the xlsx report"""
+        book = openpyxl.load_workbook(report_path, read_only=True, data_only=True)
+        try:
+            sheet = book.active
+            sheet.reset_dimensions()
+            column_count = len(REPORT_COLUMNS)
+            padded_rows = (
+                tuple(row[:column_count]) + (None,) * (column_count - len(row))
+                for row in sheet.iter_rows(min_row=invoice_report.HEADER_ROWS + 1, max_col=column_count,
+                                           values_only=True)
+            )
+            # The column labels of a report created by save_with_formatting are not an invoice
+            report_rows = (
+                row for row in padded_rows
+                if row != invoice_report.COLUMN_LABELS_ROW and any(value not in (None, '') for value in row)
+            )
+            records = store_records(report_rows, {})
+            with self.connection:
+                self.connection.execute("DELETE FROM report_rows")
+                self.connection.executemany(
+                    INSERT_ROW,
+                    records
+                )
+        finally:
+            book.close()
+        self.mark_exported()
+        return self.count()
+
+    def totals(self, group_by: str = "contractor") -> List[Tuple]:
+        """(group, invoices, rows, total weight, total price) per contractor, month or day"""
+        group = TOTALS_GROUPS[group_by]
+        return self.connection.execute(
+            f"""
+            SELECT {group} AS grp,
+                   COUNT(DISTINCT key_number || char(31) || key_contractor || char(31) || key_date),
+                   COUNT(*), COALESCE(SUM(weight_value), 0), COALESCE(SUM(price_value), 0)
+            FROM report_rows GROUP BY grp ORDER BY grp
+            """
+        ).fetchall()
+
+
+def store_records(report_rows, source_files: Dict[Tuple[str, str, str], str]) -> Iterator[Tuple]:
+    """
+    Store records of report rows: the row values, the key of the invoice the row
+    belongs to (the first row of an invoice has the number, later ones are blank),
+    the normalized date and numeric weight and price.
+    """
+    added_at = datetime.now().isoformat(timespec="seconds")
+    dates = invoice_dates.DateParser()
+    key = ("", "", "")
+    invoice_day = None
+    for row in report_rows:
+        values = [store_value(value) for value in row]
+        values += [None] * (len(REPORT_COLUMNS) - len(values))
+        if values[0] is not None or values[3] is not None:
+            key = tuple("" if value is None else str(value) for value in values[:3])
+            parsed = dates.parse(values[2])
+            invoice_day = parsed.isoformat() if parsed is not None else None
+        yield (
+            *values, *key, invoice_day, number_value(values[7]), number_value(values[8]),
+            source_files.get(key), added_at,
+        )
+
+
+def store_value(value):
+    """Report value as stored: dates (datetime cells of a rebuilt report) become ISO text"""
+    value = invoice_report.report_value(value)
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    return value
+
+
+def number_value(value) -> Optional[float]:
+    """Numeric value of a weight or price cell, None for text that is not a number"""
+    if value is None or isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    try:
+        return float(str(value).replace(" ", "").replace(" ", "").replace(",", "."))
+    except ValueError:
+        return None
+
+
+def export_on_commit(config: Dict) -> bool:
+    """Whether every commit also writes the xlsx report ("report_export": "each_commit")"""
+    return config.get("report_export", invoice_core.DEFAULT_CONFIG["report_export"]) != "on_demand"
+
+
+def open_store(report_path: str, config: Dict, log: Optional[Callable[[str], None]] = None) -> Optional[ReportStore]:
+    """
+    Store of the report, or None when "report_store" is off. A missing store of an
+    existing report is built from the report; with "each_commit" export, rows an
+    interrupted run committed to the store but not to the workbook are exported now.
+    """
+    log = log or logger.info
+    if not config.get("report_store", invoice_core.DEFAULT_CONFIG["report_store"]):
+        return None
+    store_exists = Path(f"{report_path}{STORE_SUFFIX}").exists()
+    try:
+        store = ReportStore.for_report(report_path)
+    except sqlite3.Error as e:
+        log(f"Хранилище строк отчета недоступно: {e}")
+        return None
+    if not store_exists and Path(report_path).exists():
+        log(f"Хранилище строк отчета построено по отчету: {store.rebuild(report_path)} строк")
+    elif export_on_commit(config) and store.last_row_id() > store.exported_row_id():
+        report_writer = config.get("report_writer", invoice_core.DEFAULT_CONFIG["report_writer"])
+        exported = store.export_pending(report_path, log, report_writer)
+        log(f"Восстановление: в отчет выгружено строк из хранилища: {exported}")
+    return store
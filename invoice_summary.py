@@ -0,0 +1,226 @@
+"""Totals of the report per contractor, invoice and month, and reconciliation with the invoice files.
+
+The report rows (columns 0-11 as built by invoice_core.build_invoice_rows) are
+streamed once from the sheet XML. The number, contractor and date are written on
+the first row of each invoice block only, so every row is attributed to the
+invoice block it belongs to; weights and prices (numbers, or text with a decimal
+comma in older reports) are summed per invoice in one grouped operation, and the
+per-contractor and per-month totals are rolled up from the invoice totals.
+
+reconcile() compares the invoice totals with the invoice files themselves, so
+invoices missing from the report or changed after they were added stand out.
+The tables go to a separate workbook (one sheet each) or to CSV files.
+"""
+import logging
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+import pandas as pd
+
+import invoice_core
+import invoice_dates
+import invoice_report
+
+# Zero-based report columns (see invoice_core.build_invoice_rows)
+NUMBER_COLUMN, CONTRACTOR_COLUMN, DATE_COLUMN, KIND_COLUMN = 0, 1, invoice_report.DATE_COLUMN, 3
+WEIGHT_COLUMN, PRICE_COLUMN = 7, 8
+
+# Weights and prices that differ by less than this are the same
+RECONCILE_TOLERANCE = 0.005
+
+# Table name -> sheet name of the summary workbook
+SUMMARY_SHEETS = {
+    "contractors": "Контрагенты",
+    "invoices": "Счета",
+    "months": "Месяцы",
+    "reconciliation": "Сверка",
+}
+
+logger = logging.getLogger(__name__)
+
+
+def numeric_column(values: pd.Series) -> pd.Series:
+    """Numbers of a weight or price column; text is read with a decimal comma and spaces removed, the rest is NaN"""
+    numbers = pd.to_numeric(values, errors='coerce')
+    text = values[numbers.isna() & values.notna()]
+    if len(text):
+        numbers[text.index] = pd.to_numeric(
+            text.astype(str).str.replace(r'\s', '', regex=True).str.replace(',', '.'), errors='coerce'
+        )
+    return numbers.astype(float)
+
+
+def read_report_frame(output_file) -> pd.DataFrame:
+    """The data rows of the report as a DataFrame with columns 0-11, indexed by report row number"""
+    row_numbers = []
+    rows = []
+    for row_number, values in invoice_report.iter_report_rows(output_file):
+        if values != invoice_report.COLUMN_LABELS_ROW and any(value is not None and value != '' for value in values):
+            row_numbers.append(row_number)
+            rows.append(values)
+    return pd.DataFrame.from_records(rows, index=row_numbers, columns=range(12)) if rows else pd.DataFrame(
+        columns=range(12)
+    )
+
+
+def invoice_totals(frame: pd.DataFrame) -> pd.DataFrame:
+    """
+    One row per invoice block of the report: number, contractor, date as written,
+    the parsed date and its month, the first report row, the number of rows, total
+    weight and price, and how many weights and prices are not numbers.
+    """
+    blank = frame.isna() | (frame == '')
+    # A block starts at a row with the invoice number or the "Э" marker
+    starts = ~blank[NUMBER_COLUMN] | ~blank[KIND_COLUMN]
+    block = starts.cumsum().to_numpy()
+
+    weights = numeric_column(frame[WEIGHT_COLUMN].where(~blank[WEIGHT_COLUMN]))
+    prices = numeric_column(frame[PRICE_COLUMN].where(~blank[PRICE_COLUMN]))
+    grouped = pd.DataFrame({
+        "block": block,
+        "weight": weights.to_numpy(),
+        "price": prices.to_numpy(),
+        "bad": ((weights.isna() & ~blank[WEIGHT_COLUMN]) | (prices.isna() & ~blank[PRICE_COLUMN])).to_numpy(),
+    }).groupby("block").agg(
+        rows=("weight", "size"), weight=("weight", "sum"), price=("price", "sum"), non_numeric=("bad", "sum")
+    )
+
+    headers = frame.loc[starts, [NUMBER_COLUMN, CONTRACTOR_COLUMN, DATE_COLUMN]]
+    invoices = pd.DataFrame({
+        "number": [text_value(value) for value in headers[NUMBER_COLUMN]],
+        "contractor": [text_value(value) for value in headers[CONTRACTOR_COLUMN]],
+        "date": [text_value(value) for value in headers[DATE_COLUMN]],
+        "day": invoice_dates.normalize_date_column(headers[DATE_COLUMN]),
+        "first_row": headers.index,
+    }, index=pd.RangeIndex(1, len(headers) + 1))
+    # Rows above the first invoice (block 0) have no invoice to belong to
+    if len(block) and block[0] == 0:
+        invoices.loc[0] = ["", "", "", None, frame.index[0]]
+        invoices = invoices.sort_index()
+    invoices["month"] = [day.strftime('%Y-%m') if day is not None else "" for day in invoices["day"]]
+    invoices = invoices.join(grouped)
+    invoices[["rows", "non_numeric"]] = invoices[["rows", "non_numeric"]].fillna(0).astype(int)
+    return invoices.reset_index(drop=True)
+
+
+def text_value(value) -> str:
+    if value is None or (not isinstance(value, str) and pd.isna(value)):
+        return ""
+    return str(value)
+
+
+def rollup(invoices: pd.DataFrame, by: str) -> pd.DataFrame:
+    """Totals of the invoice table per contractor or month"""
+    return invoices.groupby(by, sort=True).agg(
+        invoices=("rows", "size"), rows=("rows", "sum"), weight=("weight", "sum"),
+        price=("price", "sum"), non_numeric=("non_numeric", "sum"),
+    ).reset_index()
+
+
+def summarize(output_file, log: Optional[Callable[[str], None]] = None) -> Dict[str, pd.DataFrame]:
+    """Tables "invoices", "contractors" and "months" of the report"""
+    log = log or logger.info
+    frame = read_report_frame(output_file)
+    invoices = invoice_totals(frame)
+    log(f"Сводка по отчету: строк {len(frame)}, счетов-фактур {len(invoices)}")
+    return {
+        "contractors": rollup(invoices, "contractor"),
+        "invoices": invoices,
+        "months": rollup(invoices, "month"),
+    }
+
+
+def reconcile_key(number, contractor, day, date_text) -> tuple:
+    """Invoices are matched by number, contractor and the date itself, however the report spells it"""
+    return str(number), str(contractor), day.isoformat() if day is not None else str(date_text)
+
+
+def reconcile(invoices: pd.DataFrame, invoice_files: List[str], config: Dict, workers: Optional[int] = None,
+              cache=None, log: Optional[Callable[[str], None]] = None) -> pd.DataFrame:
+    """
+    Compare every invoice of the files with its block in the report: the number of
+    items, total weight and total price. Status is "совпадает", "расхождение" or
+    "нет в отчете"; a file that cannot be read gets one row with "ошибка чтения".
+    """
+    log = log or logger.info
+    report_index = {
+        reconcile_key(row.number, row.contractor, row.day, row.date): row
+        for row in invoices.itertuples(index=False)
+    }
+    records = []
+    failures = {}
+    for invoice_file, blocks, messages in invoice_core.parse_invoices(
+        invoice_files, config, workers, cache, failures=failures
+    ):
+        for message in messages:
+            log(message)
+        if invoice_file in failures:
+            records.append({"file": Path(invoice_file).name, "sheet": "", "status": "ошибка чтения"})
+        for sheet, extracted_data in blocks:
+            items = extracted_data['items']
+            number = extracted_data['number']['value']
+            contractor = extracted_data['contractor']['value']
+            invoice_date = extracted_data['date']['value']
+            day = invoice_dates.parse_date(invoice_date)
+            # Values that are not numbers count as zero, as they do in the report totals
+            weight = sum(value for value in items.weights if isinstance(value, float))
+            price = sum(value for value in items.prices if isinstance(value, float))
+            found = report_index.get(reconcile_key(number, contractor, day, invoice_core.format_invoice_date(invoice_date)))
+            if found is None:
+                status = "нет в отчете"
+            elif (found.rows == len(items) and abs(found.weight - weight) < RECONCILE_TOLERANCE
+                    and abs(found.price - price) < RECONCILE_TOLERANCE):
+                status = "совпадает"
+            else:
+                status = "расхождение"
+            records.append({
+                "file": Path(invoice_file).name,
+                "sheet": sheet or "",
+                "number": number,
+                "contractor": contractor,
+                "date": invoice_core.format_invoice_date(invoice_date),
+                "file_rows": len(items),
+                "report_rows": found.rows if found is not None else None,
+                "file_weight": weight,
+                "report_weight": found.weight if found is not None else None,
+                "file_price": price,
+                "report_price": found.price if found is not None else None,
+                "report_row": found.first_row if found is not None else None,
+                "status": status,
+            })
+    table = pd.DataFrame.from_records(records, columns=[
+        "file", "sheet", "number", "contractor", "date", "file_rows", "report_rows", "file_weight",
+        "report_weight", "file_price", "report_price", "report_row", "status",
+    ])
+    # Counts of invoices missing from the report stay empty instead of turning the columns into floats
+    table[["file_rows", "report_rows", "report_row"]] = table[["file_rows", "report_rows", "report_row"]].astype("Int64")
+    mismatched = int((table["status"] != "совпадает").sum())
+    log(f"Сверка: счетов-фактур {len(table)}, расхождений и отсутствующих в отчете {mismatched}")
+    return table
+
+
+def write_summary(tables: Dict[str, pd.DataFrame], summary_file, log: Optional[Callable[[str], None]] = None):
+    """
+    Write the tables to a workbook with one sheet per table (.xlsx), or to one CSV
+    file per table next to summary_file, named "<name>_<table>.csv".
+    """
+    log = log or logger.info
+    summary_path = Path(summary_file)
+    if summary_path.suffix.lower() == '.csv':
+        for name, table in tables.items():
+            table_path = summary_path.with_name(f"{summary_path.stem}_{name}.csv")
+            with invoice_report.atomic_output(table_path) as temp_path:
+                # utf-8-sig so that Excel opens the Cyrillic text correctly
+                export_table(table).to_csv(temp_path, index=False, encoding='utf-8-sig', sep=';', decimal=',')
+            log(f"Сводка записана: {table_path}")
+        return
+    with invoice_report.atomic_output(summary_path) as temp_path:
+        with pd.ExcelWriter(temp_path, engine='openpyxl') as writer:
+            for name, table in tables.items():
+                export_table(table).to_excel(writer, sheet_name=SUMMARY_SHEETS.get(name, name), index=False)
+    log(f"Сводка записана: {summary_path}")
+
+
+def export_table(table: pd.DataFrame) -> pd.DataFrame:
+    # Parsed dates are only needed for grouping and matching
+    return table.drop(columns=["day"], errors="ignore")
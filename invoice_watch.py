@@ -0,0 +1,258 @@
+"""Watch an inbox folder and append incoming invoices to the report.
+
+Usage:
+    python invoice_watch.py REPORT.xlsx INBOX [--config PATH] [--interval S] [--settle S] [--batch-size N]
+
+New *.xlsx files in INBOX are picked up once their size and modification time
+have stopped changing for --settle seconds and they are complete zip archives,
+so files still being copied are left alone. Ready files are processed in
+micro-batches through the same pipeline as invoice_cli (the review dialog is
+never shown) and moved to INBOX/done or INBOX/failed. The folder is polled;
+when the optional watchdog package is installed, file system events wake the
+poller early. Stop with Ctrl+C.
+"""
+import argparse
+import logging
+import os
+import shutil
+import sys
+import threading
+import time
+import zipfile
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+import invoice_cli
+import invoice_core
+import invoice_log
+
+try:
+    from watchdog.events import FileSystemEventHandler
+    from watchdog.observers import Observer
+except ImportError:
+    FileSystemEventHandler = object
+    Observer = None
+
+DONE_DIR = "done"
+FAILED_DIR = "failed"
+
+# A file that stays incomplete this many settle periods is treated as broken
+INCOMPLETE_SETTLE_PERIODS = 10
+
+logger = logging.getLogger("invoice_watch")
+
+
+class WakeHandler(FileSystemEventHandler):
+    """watchdog handler that only wakes the poll loop"""
+
+    def __init__(self, wake: threading.Event):
+        super().__init__()
+        self.wake = wake
+
+    def on_any_event(self, event):
+        self.wake.set()
+
+
+class InboxWatcher:
+    def __init__(self, output_file: str, inbox: str, config: Dict,
+                 log: Optional[Callable[[str], None]] = None, poll_seconds: Optional[float] = None,
+                 settle_seconds: Optional[float] = None, batch_size: Optional[int] = None):
+        self.output_file = output_file
+        self.inbox = Path(inbox)
+        self.config = config
+        self.log = log or logger.info
+        self.poll_seconds = poll_seconds or config.get('watch_poll_seconds', invoice_core.DEFAULT_CONFIG['watch_poll_seconds'])
+        self.settle_seconds = settle_seconds if settle_seconds is not None else config.get(
+            'watch_settle_seconds', invoice_core.DEFAULT_CONFIG['watch_settle_seconds']
+        )
+        self.batch_size = batch_size or config.get('watch_batch_size', invoice_core.DEFAULT_CONFIG['watch_batch_size'])
+        self.done_dir = self.inbox / DONE_DIR
+        self.failed_dir = self.inbox / FAILED_DIR
+        self.wake = threading.Event()
+
+        # path -> (size, mtime, time the file was first seen with this size and mtime)
+        self.pending: Dict[str, tuple] = {}
+        self.started = time.monotonic()
+        self.received = 0
+        self.processed = 0
+        self.failed = 0
+        self.batches = 0
+        self.last_batch_rate = 0.0
+
+    def scan(self) -> List[str]:
+        """Update the pending files from the inbox and return those ready to process"""
+        now = time.monotonic()
+        seen = set()
+        ready = []
+        with os.scandir(self.inbox) as entries:
+            for entry in entries:
+                name = entry.name
+                if not entry.is_file() or not name.lower().endswith('.xlsx') or name.startswith(('~$', '.')):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                seen.add(entry.path)
+                previous = self.pending.get(entry.path)
+                if previous is None:
+                    self.received += 1
+                if previous is None or previous[:2] != (stat.st_size, stat.st_mtime):
+                    self.pending[entry.path] = (stat.st_size, stat.st_mtime, now)
+                    continue
+                stable_for = now - previous[2]
+                if stable_for < self.settle_seconds:
+                    continue
+                if zipfile.is_zipfile(entry.path):
+                    ready.append(entry.path)
+                elif stable_for >= self.settle_seconds * INCOMPLETE_SETTLE_PERIODS:
+                    self.log(f"Файл не является книгой Excel: {name}")
+                    self.finish(entry.path, self.failed_dir)
+                    self.failed += 1
+
+        # Files removed from the inbox by someone else are forgotten
+        for path in list(self.pending):
+            if path not in seen:
+                del self.pending[path]
+        return sorted(ready, key=invoice_core.invoice_sort_key)
+
+    def process_batch(self, invoice_files: List[str]):
+        """
+        Append a micro-batch; files the batch could not read or build are moved to failed.
+        If the batch itself fails (the report cannot be written), retry file by file.
+        """
+        started = time.perf_counter()
+        try:
+            summary = invoice_cli.run_batch(self.output_file, invoice_files, self.config, log=self.log)
+            failed = summary["errors"].files()
+            outcomes = {invoice_file: invoice_file not in failed for invoice_file in invoice_files}
+        except Exception as e:
+            if len(invoice_files) == 1:
+                self.log(f"Ошибка обработки файла {Path(invoice_files[0]).name}: {e}")
+                retry_files = []
+                outcomes = {invoice_files[0]: False}
+            else:
+                self.log(f"Ошибка пакета из {len(invoice_files)} файлов, обработка по одному: {e}")
+                retry_files = invoice_files
+                outcomes = {}
+            for invoice_file in retry_files:
+                try:
+                    # Invoices of the batch already saved are skipped by the ledger
+                    summary = invoice_cli.run_batch(self.output_file, [invoice_file], self.config, log=self.log)
+                    outcomes[invoice_file] = not summary["errors"]
+                except Exception as file_error:
+                    self.log(f"Ошибка обработки файла {Path(invoice_file).name}: {file_error}")
+                    outcomes[invoice_file] = False
+
+        for invoice_file, succeeded in outcomes.items():
+            self.finish(invoice_file, self.done_dir if succeeded else self.failed_dir)
+            if succeeded:
+                self.processed += 1
+            else:
+                self.failed += 1
+        elapsed = time.perf_counter() - started
+        self.batches += 1
+        self.last_batch_rate = len(invoice_files) / elapsed if elapsed > 0 else 0.0
+
+    def finish(self, invoice_file: str, folder: Path):
+        """Move a handled file out of the inbox, keeping earlier files of the same name"""
+        self.pending.pop(invoice_file, None)
+        folder.mkdir(exist_ok=True)
+        source = Path(invoice_file)
+        target = folder / source.name
+        counter = 1
+        while target.exists():
+            target = folder / f"{source.stem}_{counter}{source.suffix}"
+            counter += 1
+        try:
+            shutil.move(str(source), str(target))
+        except OSError as e:
+            self.log(f"Не удалось переместить {source.name} в {folder.name}: {e}")
+
+    def stats(self) -> Dict:
+        elapsed = time.monotonic() - self.started
+        return {
+            "received": self.received,
+            "processed": self.processed,
+            "failed": self.failed,
+            "batches": self.batches,
+            "queue_depth": len(self.pending),
+            "files_per_second": self.processed / elapsed if elapsed > 0 else 0.0,
+            "last_batch_files_per_second": self.last_batch_rate,
+        }
+
+    def status(self) -> str:
+        stats = self.stats()
+        return (
+            f"В очереди: {stats['queue_depth']}, обработано: {stats['processed']}, "
+            f"ошибок: {stats['failed']}, пакетов: {stats['batches']}, "
+            f"скорость: {stats['files_per_second']:.2f} файлов/с "
+            f"(последний пакет {stats['last_batch_files_per_second']:.1f} файлов/с)"
+        )
+
+    def run(self, stop: Optional[threading.Event] = None, status_seconds: float = 60.0):
+        """Poll the inbox until stop is set, processing ready files in micro-batches"""
+        stop = stop or threading.Event()
+        observer = None
+        if Observer is not None:
+            observer = Observer()
+            observer.schedule(WakeHandler(self.wake), str(self.inbox), recursive=False)
+            observer.start()
+        self.log(f"Наблюдение за папкой {self.inbox} ({'watchdog' if observer else 'опрос'}), отчет: {self.output_file}")
+
+        last_status = time.monotonic()
+        try:
+            while not stop.is_set():
+                ready = self.scan()
+                for start in range(0, len(ready), self.batch_size):
+                    if stop.is_set():
+                        break
+                    self.process_batch(ready[start:start + self.batch_size])
+                if time.monotonic() - last_status >= status_seconds:
+                    self.log(self.status())
+                    last_status = time.monotonic()
+                # Files still settling are checked again after the poll interval even without events
+                self.wake.wait(self.poll_seconds)
+                self.wake.clear()
+        finally:
+            if observer is not None:
+                observer.stop()
+                observer.join()
+            self.log(self.status())
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Обработка счетов-фактур, поступающих в папку")
+    parser.add_argument("report", help="файл отчета (.xlsx), создается при отсутствии")
+    parser.add_argument("inbox", help="папка, в которую поступают счета-фактуры")
+    parser.add_argument("--config", default=str(Path(__file__).resolve().parent / invoice_core.CONFIG_FILE),
+                        help="файл настроек ячеек (по умолчанию invoice_config.json рядом со скриптом)")
+    parser.add_argument("--interval", type=float, default=None,
+                        help="период опроса папки, с (по умолчанию watch_poll_seconds из настроек)")
+    parser.add_argument("--settle", type=float, default=None,
+                        help="сколько секунд файл не должен меняться, прежде чем его обработать")
+    parser.add_argument("--batch-size", type=int, default=None, help="наибольшее число файлов в пакете")
+    parser.add_argument("--status-interval", type=float, default=60.0, help="период вывода счетчиков, с")
+    args = parser.parse_args(argv)
+
+    # A long-running service reports batches and counters on the console at the configured level
+    logging.basicConfig(level=logging.INFO, format=invoice_log.LOG_FORMAT)
+    config = invoice_core.load_config(args.config)
+    invoice_log.add_file_handler(config)
+    invoice_log.apply_log_level(config)
+
+    if not Path(args.inbox).is_dir():
+        print(f"Папка не найдена: {args.inbox}", file=sys.stderr)
+        return 2
+
+    watcher = InboxWatcher(args.report, args.inbox, config, poll_seconds=args.interval,
+                           settle_seconds=args.settle, batch_size=args.batch_size)
+    try:
+        watcher.run(status_seconds=args.status_interval)
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
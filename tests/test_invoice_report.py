@@ -0,0 +1,44 @@
+import os
+import zipfile
+
+import pandas as pd
+
+import invoice_report
+
+
+def report_rows(number: int) -> pd.DataFrame:
+    return pd.DataFrame({col: [number if col == 0 else f"значение {col}"] for col in range(12)})
+
+
+def test_xml_append_closes_report_before_replacing_it(tmp_path, monkeypatch):
+    report = tmp_path / "report.xlsx"
+    invoice_report.save_with_formatting(report, report_rows(1), lambda message: None)
+
+    opened = []
+
+    class TrackedZipFile(zipfile.ZipFile):
+        def __init__(self, file, *args, **kwargs):
+            super().__init__(file, *args, **kwargs)
+            opened.append((os.fspath(file), self))
+
+    replaced = []
+    real_replace = os.replace
+
+    def checked_replace(source, target):
+        # Windows refuses to replace a file that is still open
+        still_open = [archive for path, archive in opened if path == os.fspath(target) and archive.fp is not None]
+        assert not still_open, "the report is still open when it is replaced"
+        replaced.append(target)
+        real_replace(source, target)
+
+    def no_fallback(output_file, new_df):
+        raise AssertionError("the XML append fell back to openpyxl")
+
+    monkeypatch.setattr(zipfile, "ZipFile", TrackedZipFile)
+    monkeypatch.setattr(invoice_report.os, "replace", checked_replace)
+    monkeypatch.setattr(invoice_report, "append_with_openpyxl", no_fallback)
+    invoice_report.save_with_formatting(report, report_rows(2), lambda message: None)
+
+    assert replaced == [report]
+    values = [row[0] for _, row in invoice_report.iter_report_rows(report)]
+    assert values[-2:] == [1, 2]
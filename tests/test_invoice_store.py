@@ -0,0 +1,33 @@
+from datetime import datetime
+
+import pandas as pd
+
+import invoice_core
+import invoice_report
+import invoice_store
+
+
+def make_invoice_rows(number: str, contractor: str) -> pd.DataFrame:
+    items = invoice_core.InvoiceItems(["Товар ", "Товар "], ["1", "2"], [1.5, 2.0], [10.0, 20.0], 20)
+    return invoice_core.build_invoice_rows({
+        'number': {'value': number, 'cell': ""},
+        'contractor': {'value': contractor, 'cell': ""},
+        'date': {'value': datetime(2024, 3, 15), 'cell': ""},
+        'items': items,
+    })
+
+
+def test_rebuild_skips_column_labels_of_new_report(tmp_path):
+    report = tmp_path / "report.xlsx"
+    # A new report gets the pandas column labels (0..11) above its first invoice
+    invoice_report.save_with_formatting(report, make_invoice_rows("1", "Альфа"), lambda message: None)
+    invoice_report.save_with_formatting(report, make_invoice_rows("2", "Бета"), lambda message: None)
+
+    store = invoice_store.ReportStore.for_report(str(report))
+    try:
+        assert store.rebuild(str(report)) == 4
+        assert not store.contains(("0", "1", "2"))
+        assert store.contains(("1", "Альфа", "15.03.2024"))
+        assert store.totals("contractor") == [("Альфа", 1, 2, 3.5, 30.0), ("Бета", 1, 2, 3.5, 30.0)]
+    finally:
+        store.close()